@@ -38,34 +38,50 @@
 # ///
 
 import argparse
+import atexit
 import base64
 import code
 import collections
+import concurrent.futures
 import contextlib
-import copy
+import contextvars
 import datetime
+import dis
+import email.utils
+import gc
+import hashlib
 import importlib
-import inspect
+import importlib.util
 import io
+import itertools
 import json
 import mimetypes
+import multiprocessing.connection
 import os
+import pickle
 import queue
 import random
 import re
 import shlex
+import shutil
+import signal
+import struct
 import subprocess
 import sys
 import textwrap
 import threading
 import time
+import types
+import urllib.parse
 import uuid
+import zlib
 from pathlib import Path
-from typing import Any, Literal, Tuple
+from typing import Any, Callable, Iterable, Iterator, Literal, Tuple
 
 import httpx
 import jinja2
 import logfire
+import logfire.propagate
 import openai
 import opentelemetry.trace
 import prompt_toolkit
@@ -118,6 +134,393 @@ logfire.instrument_requests()
 logfire.instrument_httpx()
 
 
+def env_flag(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# NOTE(hzuo-26-10-18-sun): All provider calls and helpers go through these shared clients so that
+# a multi-step turn reuses warm TCP+TLS connections instead of paying a handshake per request.
+# requests only speaks HTTP/1.1 (keep-alive); the OpenAI SDK client is httpx-based and can
+# optionally negotiate HTTP/2 (needs the "h2" package).
+_http_sessions: dict[str, requests.Session] = {}
+_http_sessions_lock = threading.Lock()
+_openai_http_client: httpx.Client | None = None
+
+http2_enabled = env_flag("PERSONALBOT_HTTP2", False)
+
+
+def http_session(url: str) -> requests.Session:
+    """Return the shared keep-alive session for the url's origin (scheme + host + port)."""
+    parts = urllib.parse.urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    with _http_sessions_lock:
+        session = _http_sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            _http_sessions[origin] = session
+        return session
+
+
+def openai_http_client() -> httpx.Client:
+    """Return the shared httpx client used by every openai.OpenAI instance."""
+    global _openai_http_client
+    with _http_sessions_lock:
+        if _openai_http_client is None:
+            http2 = http2_enabled
+            if http2 and importlib.util.find_spec("h2") is None:
+                console.print(
+                    "[yellow]PERSONALBOT_HTTP2 is set but the h2 package is not installed, using HTTP/1.1[/yellow]"
+                )
+                http2 = False
+            _openai_http_client = openai.DefaultHttpxClient(
+                transport=GzipTransport(
+                    "openai",
+                    # the same pool limits the sdk gives its default client
+                    httpx.HTTPTransport(
+                        http2=http2,
+                        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+                    ),
+                )
+            )
+        return _openai_http_client
+
+
+def http_warmup(urls: list[str]):
+    """
+    Open connections to the given endpoints on a background thread (e.g. while the user types
+    the first prompt), so the first real request finds a warm connection in the pool.
+    """
+
+    def warmup():
+        # The warmup requests are expected to 4xx, tag them so they can be filtered out.
+        with logfire.set_baggage(http_warmup="true"):
+            for url in urls:
+                try:
+                    if urllib.parse.urlsplit(url).netloc == "api.openai.com":
+                        openai_http_client().head(url, timeout=10)
+                    else:
+                        http_session(url).head(url, timeout=10)
+                except Exception as e:
+                    logfire.info("http warmup failed", url=url, error=str(e))
+
+    threading.Thread(target=warmup, name="http-warmup", daemon=True).start()
+
+
+# NOTE(hzuo-26-10-18-sun): One retry policy for every provider call and helper. Each error class has
+# its own budget, so a burst of 429s doesn't use up the retries for a dropped connection. The
+# server's Retry-After / retry-after-ms is honored when present; otherwise we back off with
+# decorrelated jitter (sleep = uniform(base, 3 * previous sleep), capped), which spreads
+# concurrent clients out without the fixed 30s floor the gemini loop used to have.
+# A per-provider circuit breaker opens after a run of failed attempts. While it is open, new
+# calls fail fast with CircuitOpenError instead of piling onto an unhealthy API. Retry loops
+# already in flight wait out the cooldown and become the half-open probe: the next success
+# closes the breaker and the next failure re-opens it.
+# A streamed call is retried as a whole (see call_stream_with_retry): an error event, a stalled
+# or a dropped stream is retried like a failed request, as long as none of the stream's output
+# has been shown yet.
+RETRY_BUDGETS: dict[str, tuple[int, float, float]] = {
+    # error class: (max retries, base delay seconds, max delay seconds)
+    "rate_limit": (8, 2.0, 120.0),
+    "overloaded": (6, 2.0, 60.0),
+    "server_error": (4, 1.0, 30.0),
+    "timeout": (3, 1.0, 30.0),
+    "connection": (4, 0.5, 20.0),
+}
+RETRY_AFTER_MAX_SECONDS = 600.0
+CIRCUIT_FAILURE_THRESHOLD = 6
+CIRCUIT_COOLDOWN_SECONDS = 60.0
+# retried for one provider only, on top of retry_error_class
+RETRY_PROVIDER_STATUS_CODES: dict[str, dict[int, str]] = {
+    # the gemini retry loop this policy replaced retried 413 too, kept so Gemini calls behave
+    # as they did
+    "gemini": {413: "server_error"},
+}
+
+
+class StreamError(RuntimeError):
+    """An error event in a streamed response, with the HTTP status it corresponds to (if any)."""
+
+    def __init__(self, message: str, status_code: int | None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StreamInterrupted(RuntimeError):
+    """A stream failed after some of its output was shown, so it isn't retried."""
+
+
+def retry_error_class(status_code: int | None, exc: BaseException | None = None) -> str | None:
+    """Return the RETRY_BUDGETS class of a failed attempt, or None if it shouldn't be retried."""
+    if exc is not None:
+        # the timeout checks come first: requests' ConnectTimeout is also a ConnectionError and
+        # openai's APITimeoutError is also an APIConnectionError
+        if isinstance(
+            exc,
+            (
+                requests.exceptions.Timeout,
+                httpx.TimeoutException,
+                openai.APITimeoutError,
+            ),
+        ):
+            return "timeout"
+        if isinstance(
+            exc,
+            (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                httpx.TransportError,
+                openai.APIConnectionError,
+            ),
+        ):
+            return "connection"
+        if not isinstance(exc, (openai.APIStatusError, StreamError)):
+            return None
+        status_code = exc.status_code
+    if status_code == 429:
+        return "rate_limit"
+    if status_code in (503, 529):
+        return "overloaded"
+    if status_code in (500, 502, 504):
+        return "server_error"
+    if status_code == 408:
+        return "timeout"
+    return None
+
+
+def retry_after_seconds(headers: Any) -> float | None:
+    """Parse retry-after-ms or Retry-After (seconds or an HTTP date) from response headers."""
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """Seconds left in the cooldown, 0 when closed or ready for a half-open probe."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + CIRCUIT_COOLDOWN_SECONDS - time.monotonic())
+
+    def check(self):
+        remaining = self.remaining()
+        if remaining > 0:
+            raise CircuitOpenError(
+                f"{self.provider} circuit breaker is open after {self.consecutive_failures} "
+                f"consecutive failed attempts, retry in {remaining:.0f}s"
+            )
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logfire.info("circuit breaker closed", provider=self.provider)
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                # (re-)open, a failed half-open probe starts a fresh cooldown
+                if self.opened_at is None:
+                    logfire.warn(
+                        "circuit breaker opened",
+                        provider=self.provider,
+                        consecutive_failures=self.consecutive_failures,
+                    )
+                self.opened_at = time.monotonic()
+
+
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def circuit_breaker(provider: str) -> CircuitBreaker:
+    with _http_sessions_lock:
+        breaker = _circuit_breakers.get(provider)
+        if breaker is None:
+            breaker = CircuitBreaker(provider)
+            _circuit_breakers[provider] = breaker
+        return breaker
+
+
+def call_with_retry(provider: str, send: Callable[[], Any]) -> Any:
+    """
+    Call send() until it succeeds or its error class runs out of retries.
+
+    send() makes one attempt. It either raises or returns a result; a requests.Response with a
+    retryable status counts as a failed attempt. Once the budget is spent, the last response is
+    returned (the caller reports it and calls raise_for_status) or the last exception re-raised.
+    """
+    breaker = circuit_breaker(provider)
+    breaker.check()
+    retries: collections.Counter[str] = collections.Counter()
+    previous_delays: dict[str, float] = {}
+    attempt = 0
+    while True:
+        hedge_attempt = hedge_attempt_var.get()
+        if hedge_attempt is not None:
+            # the other side of a hedge race already won, stop retrying
+            hedge_attempt.check()
+        attempt += 1
+        exhausted = any(retries[k] >= budget[0] for k, budget in RETRY_BUDGETS.items())
+        result = None
+        try:
+            # Set baggage while a failure would still be retried, so auto-instrumented HTTP errors are filterable
+            with logfire.set_baggage(
+                **({"is_retryable_attempt": "true"} if not exhausted else {})
+            ):
+                result = send()
+        except Exception as e:
+            error_class = retry_error_class(None, e)
+            if error_class is None:
+                raise
+            status_code = getattr(e, "status_code", None)
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            failure: Exception | None = e
+        else:
+            if not isinstance(result, requests.Response):
+                breaker.record_success()
+                return result
+            status_code = result.status_code
+            error_class = retry_error_class(status_code) or RETRY_PROVIDER_STATUS_CODES.get(
+                provider, {}
+            ).get(status_code)
+            if error_class is None:
+                if status_code < 500:
+                    breaker.record_success()
+                return result
+            headers = result.headers
+            failure = None
+
+        if hedge_attempt is not None:
+            # the failure of a cancelled attempt's closed response isn't the provider's
+            hedge_attempt.check()
+        breaker.record_failure()
+        max_retries, base_delay, max_delay = RETRY_BUDGETS[error_class]
+        if retries[error_class] >= max_retries:
+            if failure is not None:
+                raise failure
+            return result
+        retries[error_class] += 1
+
+        retry_after = retry_after_seconds(headers)
+        if retry_after is not None:
+            delay = min(retry_after, RETRY_AFTER_MAX_SECONDS)
+        else:
+            previous = previous_delays.get(error_class, base_delay)
+            delay = min(max_delay, random.uniform(base_delay, previous * 3))
+            previous_delays[error_class] = delay
+        delay = max(delay, breaker.remaining())
+        if result is not None:
+            # hand the connection back to the pool before sleeping
+            result.close()
+        with logfire.span(
+            "{provider} retryable error - sleeping",
+            provider=provider,
+            error_class=error_class,
+            status_code=status_code,
+            exception_type=type(failure).__name__ if failure else None,
+            exception_message=str(failure) if failure else None,
+            retry_after_seconds=retry_after,
+            delay_seconds=delay,
+            attempt=attempt,
+            class_retry=retries[error_class],
+            class_max_retries=max_retries,
+        ):
+            time.sleep(delay)
+
+
+class StreamOutput:
+    def __init__(self):
+        # whether any reasoning/text/tool block of the stream has been put on the DSP queue
+        self.shown = False
+
+
+# the stream the current thread is consuming under stream_output_guard, if any
+stream_output_var: contextvars.ContextVar[StreamOutput | None] = contextvars.ContextVar(
+    "stream_output", default=None
+)
+
+
+@contextlib.contextmanager
+def stream_output_guard(provider: str):
+    """
+    Consume a stream inside this for retries to stop once it has shown output: a failure after
+    that is raised as StreamInterrupted, which isn't retryable.
+    """
+    hedge_attempt = hedge_attempt_var.get()
+    if hedge_attempt is not None:
+        # events held back from a previous attempt's stream
+        hedge_attempt.pending.clear()
+    output = StreamOutput()
+    token = stream_output_var.set(output)
+    try:
+        yield output
+    except Exception as e:
+        if output.shown and retry_error_class(None, e) is not None:
+            raise StreamInterrupted(
+                f"{provider} stream failed after its output was shown: {e!r}"
+            ) from e
+        raise
+    finally:
+        stream_output_var.reset(token)
+
+
+def call_stream_with_retry(
+    provider: str,
+    send: Callable[[], requests.Response],
+    consume: Callable[[requests.Response], Any],
+) -> Any:
+    """
+    call_with_retry where an attempt is send() and then consume() of the response, so a
+    response that fails while it's being consumed is retried too. Once the stream has shown
+    output, its failure is raised as StreamInterrupted instead. Returns what consume() returns,
+    or the last failed response.
+    """
+
+    def attempt() -> Any:
+        response = send()
+        hedge_track(response)
+        if not response.ok:
+            return response
+        with stream_output_guard(provider):
+            return consume(response)
+
+    return call_with_retry(provider, attempt)
+
+
 SYSTEM_PROMPT = """
 You are Personal Bot, an advanced Agentic AI assisting the user for a variety of personal tasks.
 
@@ -484,17 +887,22 @@ class Helpers:
         api_key = os.environ.get("OPENAI_API_KEY")
         assert api_key, "OPENAI_API_KEY is not set"
         if not self.openai_client:
-            self.openai_client = openai.OpenAI(api_key=api_key)
-        response = self.openai_client.responses.create(
-            model=model,
-            instructions=instructions,
-            input=input,
-            reasoning={
-                "effort": reasoning_effort,
-                "summary": "detailed",
-            },
-            include=["reasoning.encrypted_content"],
-            previous_response_id=None,
+            self.openai_client = openai.OpenAI(
+                api_key=api_key, http_client=openai_http_client(), max_retries=0
+            )
+        response = call_with_retry(
+            "openai",
+            lambda: self.openai_client.responses.create(
+                model=model,
+                instructions=instructions,
+                input=input,
+                reasoning={
+                    "effort": reasoning_effort,
+                    "summary": "detailed",
+                },
+                include=["reasoning.encrypted_content"],
+                previous_response_id=None,
+            ),
         )
         return response.output_text
 
@@ -513,35 +921,38 @@ class Helpers:
         if not openai_api_key:
             raise RuntimeError("missing OPENAI_API_KEY")
 
-        response = requests.post(
-            "https://api.openai.com/v1/responses",
-            headers={
-                "Authorization": f"Bearer {openai_api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model,
-                "instructions": instructions,
-                "reasoning": {
-                    "effort": reasoning_effort,
-                    "summary": "detailed",
+        response = call_with_retry(
+            "openai",
+            lambda: http_session("https://api.openai.com").post(
+                "https://api.openai.com/v1/responses",
+                headers={
+                    "Authorization": f"Bearer {openai_api_key}",
+                    "Content-Type": "application/json",
                 },
-                "input": [
-                    {
-                        "role": "user",
-                        "content": input,
+                json={
+                    "model": model,
+                    "instructions": instructions,
+                    "reasoning": {
+                        "effort": reasoning_effort,
+                        "summary": "detailed",
+                    },
+                    "input": [
+                        {
+                            "role": "user",
+                            "content": input,
+                        },
+                    ],
+                    "text": {
+                        "format": {
+                            "type": "json_schema",
+                            "name": output_schema_name,
+                            "schema": output_schema,
+                            "strict": True,
+                        }
                     },
-                ],
-                "text": {
-                    "format": {
-                        "type": "json_schema",
-                        "name": output_schema_name,
-                        "schema": output_schema,
-                        "strict": True,
-                    }
                 },
-            },
-            timeout=360,
+                timeout=360,
+            ),
         )
 
         try:
@@ -592,36 +1003,39 @@ class Helpers:
 
         url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_id}:generateContent"
 
-        response = requests.post(
-            url,
-            headers={
-                "Content-Type": "application/json",
-                "x-goog-api-key": api_key,
-            },
-            json={
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [
-                            {
-                                "text": input,
-                            },
-                        ],
-                    },
-                ],
-                "generationConfig": {
-                    "thinkingConfig": {
-                        "thinkingLevel": "HIGH",
-                        "includeThoughts": True,
-                    },
+        response = call_with_retry(
+            "gemini",
+            lambda: http_session(url).post(
+                url,
+                headers={
+                    "Content-Type": "application/json",
+                    "x-goog-api-key": api_key,
                 },
-                "tools": [
-                    {
-                        "googleSearch": {},
+                json={
+                    "contents": [
+                        {
+                            "role": "user",
+                            "parts": [
+                                {
+                                    "text": input,
+                                },
+                            ],
+                        },
+                    ],
+                    "generationConfig": {
+                        "thinkingConfig": {
+                            "thinkingLevel": "HIGH",
+                            "includeThoughts": True,
+                        },
                     },
-                ],
-            },
-            timeout=180,
+                    "tools": [
+                        {
+                            "googleSearch": {},
+                        },
+                    ],
+                },
+                timeout=180,
+            ),
         )
 
         try:
@@ -650,7 +1064,7 @@ class Helpers:
         # Extract and resolve source URLs from groundingChunks
         def resolve_url(url: str) -> str:
             try:
-                resp = requests.head(url, allow_redirects=True, timeout=5)
+                resp = http_session(url).head(url, allow_redirects=True, timeout=5)
                 return resp.url
             except Exception as exc:
                 return f"{url} (failed to resolve: {exc})"
@@ -674,6 +1088,17 @@ class Helpers:
             return output_text + "\n\n" + "Sources:\n" + "\n".join(numbered_sources)
         return output_text
 
+    def kernel_memory(self) -> dict:
+        """
+        Report the kernel's memory: the process RSS, the ceiling (max_mb, None if there is none),
+        and the estimated size of each of your variables, largest first.
+        When the kernel goes over the ceiling, the least recently used large DataFrames are spilled
+        to Parquet (state "spilled"); values from a restored session that haven't been used yet
+        have state "snapshot". Both load back transparently the next time a cell uses them.
+        Delete what you no longer need with `del`.
+        """
+        return kernel_memory_manager.report()
+
     def load_local_lib(
         self,
         lib_name: str,
@@ -783,15 +1208,281 @@ class PythonExecResponse(BaseModel):
     image_attachments: list[Tuple[str, str]]
 
 
-def python_exec_impl(source: str) -> PythonExecResponse:
+# NOTE(hzuo-26-10-18-sun): contextlib.redirect_stdout swaps sys.stdout for the whole process, which
+# can't work for concurrent python_exec calls. Instead each call runs in a PythonExecContext
+# bound to its thread, and while any call is running sys.stdout/sys.stderr are proxies that
+# route each write to the context of the writing thread. Threads started by the code itself
+# have no context: their output goes to the running call when there's only one (as with
+# redirect_stdout) and to the real stream otherwise. The printer thread is never captured.
+# Image attachments are routed the same way, so each call gets back its own images.
+class PythonExecContext:
+    def __init__(self):
+        self.stdout: Any = None
+        self.stderr: Any = None
+        self.image_attachments: list[str] = []
+
+
+class ThreadRoutedStream:
+    def __init__(self, router: "PythonExecRouter", name: str, fallback: Any):
+        self.router = router
+        self.name = name
+        self.fallback = fallback
+
+    def target(self) -> Any:
+        context = self.router.current()
+        stream = getattr(context, self.name) if context is not None else None
+        return stream if stream is not None else self.fallback
+
+    def write(self, s: str) -> int:
+        return self.target().write(s)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name: str) -> Any:
+        # isatty(), encoding, etc. should describe wherever the output is actually going
+        return getattr(self.target(), name)
+
+
+class PythonExecRouter:
+    def __init__(self):
+        self.local = threading.local()
+        self.active: list[PythonExecContext] = []
+        self.lock = threading.Lock()
+        self.uncaptured_threads: set[int] = set()
+        self.saved_stdio: tuple[Any, Any] | None = None
+
+    def current(self) -> PythonExecContext | None:
+        context = getattr(self.local, "context", None)
+        if context is not None:
+            return context
+        active = self.active
+        if len(active) == 1 and threading.get_ident() not in self.uncaptured_threads:
+            return active[0]
+        return None
+
+    def never_capture_current_thread(self):
+        self.uncaptured_threads.add(threading.get_ident())
+
+    @contextlib.contextmanager
+    def context(self):
+        context = getattr(self.local, "context", None)
+        if context is not None:
+            yield context
+            return
+
+        context = PythonExecContext()
+        self.local.context = context
+        with self.lock:
+            if not self.active:
+                self.saved_stdio = (sys.stdout, sys.stderr)
+                sys.stdout = ThreadRoutedStream(self, "stdout", sys.stdout)
+                sys.stderr = ThreadRoutedStream(self, "stderr", sys.stderr)
+            self.active = [*self.active, context]
+        try:
+            yield context
+        finally:
+            self.local.context = None
+            with self.lock:
+                self.active = [c for c in self.active if c is not context]
+                if not self.active and self.saved_stdio is not None:
+                    sys.stdout, sys.stderr = self.saved_stdio
+                    self.saved_stdio = None
+
+    @contextlib.contextmanager
+    def capture(self, stdout: Any, stderr: Any):
+        with self.context() as context:
+            saved = context.stdout, context.stderr
+            context.stdout, context.stderr = stdout, stderr
+            try:
+                yield context
+            finally:
+                context.stdout, context.stderr = saved
+
+
+python_exec_router = PythonExecRouter()
+
+
+def _helpers_image_attachments(self: Helpers) -> list[str]:
+    context = python_exec_router.current()
+    if context is not None:
+        return context.image_attachments
+    return self.__dict__["image_attachments"]
+
+
+def _helpers_set_image_attachments(self: Helpers, value: list[str]):
+    context = python_exec_router.current()
+    if context is not None:
+        context.image_attachments = value
+    else:
+        self.__dict__["image_attachments"] = value
+
+
+# installed here rather than in Helpers itself to keep the helpers_def source (which is part
+# of the system prompt) unchanged
+Helpers.image_attachments = property(  # type: ignore[assignment]
+    _helpers_image_attachments, _helpers_set_image_attachments
+)
+
+
+# NOTE(hzuo-26-10-18-sun): python_exec output is captured into a bounded buffer: up to
+# python_exec_output_cap chars are returned verbatim. Beyond that the model gets the first and
+# last halves of the cap with a marker in between, and the full output is spilled to a file
+# next to the session, so a print(df) or a runaway loop can't blow up history, logfire or
+# later requests. Memory stays bounded too: only the head and a ring buffer of the tail are
+# kept in memory.
+python_exec_output_cap = int(os.environ.get("PERSONALBOT_PYTHON_EXEC_OUTPUT_CAP", "100000"))
+
+
+class BoundedOutputCapture(io.TextIOBase):
+    def __init__(
+        self, stream_name: str, cap: int, tee: Callable[[str, str], None] | None = None
+    ):
+        self.stream_name = stream_name
+        self.tee = tee
+        self.head_cap = cap // 2
+        self.tail_cap = cap - self.head_cap
+        self.head: list[str] = []
+        self.head_len = 0
+        self.tail: collections.deque[str] = collections.deque()
+        self.tail_len = 0
+        self.total = 0
+        self.spill_file = None
+        self.spill_path: Path | None = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        n = len(s)
+        if self.tee is not None:
+            self.tee(self.stream_name, s)
+        if self.spill_file is None and self.total + n > self.head_cap + self.tail_cap:
+            self.start_spill()
+        if self.spill_file is not None:
+            self.spill_file.write(s)
+        self.total += n
+
+        if self.head_len < self.head_cap:
+            take = s[: self.head_cap - self.head_len]
+            self.head.append(take)
+            self.head_len += len(take)
+            s = s[len(take) :]
+        if s:
+            self.tail.append(s)
+            self.tail_len += len(s)
+            # drop whole chunks that are entirely outside the last tail_cap chars (all of them
+            # when tail_cap is 0)
+            while self.tail and self.tail_len - len(self.tail[0]) >= self.tail_cap:
+                self.tail_len -= len(self.tail.popleft())
+        return n
+
+    def start_spill(self):
+        self.spill_path = (
+            SESSIONS_DIR
+            / f"{session_id}.outputs"
+            / f"{datetime.datetime.now().strftime('%y-%m-%d-%H%M%S')}-{uuid.uuid4().hex[:8]}-{self.stream_name}.txt"
+        )
+        self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+        self.spill_file = self.spill_path.open("w", encoding="utf-8", errors="replace")
+        # nothing has been dropped yet, so head + tail is everything so far
+        self.spill_file.write("".join(self.head))
+        self.spill_file.write("".join(self.tail))
+
+    def finish(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def getvalue(self) -> str:
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        if self.spill_path is None:
+            return head + tail
+        tail = tail[-self.tail_cap :]
+        omitted = self.total - len(head) - len(tail)
+        return (
+            f"{head}\n[... {omitted:,} chars omitted, the full {self.stream_name}"
+            f" ({self.total:,} chars) is saved at {self.spill_path} ...]\n{tail}"
+        )
+
+
+# NOTE(hzuo-26-10-18-sun): Live python_exec output. The captured output only reaches the console
+# with data-python-exec-call-end, so a long-running cell looks frozen until it's done. While a
+# call runs, a PythonExecOutputStreamer also gets every write, coalesces them and flushes at
+# most every PYTHON_EXEC_STREAM_INTERVAL_SECONDS as data-python-exec-stdout-delta events (with
+# a stream field, stdout or stderr). A flush carries at most PYTHON_EXEC_STREAM_MAX_CHARS per
+# stream: beyond that only the latest output is kept, behind a marker, so a flood of output
+# costs a bounded amount of rendering. The captured text for the model is unaffected.
+python_exec_streaming = env_flag("PERSONALBOT_PYTHON_EXEC_STREAMING", True)
+PYTHON_EXEC_STREAM_INTERVAL_SECONDS = 0.1
+PYTHON_EXEC_STREAM_MAX_CHARS = 8000
+
+
+class PythonExecOutputStreamer:
+    def __init__(self, emit: Callable[[str, str, int], None]):
+        """emit(stream_name, text, skipped_chars) is called from the streamer's own thread."""
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.pending: dict[str, list[str]] = {"stdout": [], "stderr": []}
+        self.pending_len = {"stdout": 0, "stderr": 0}
+        self.skipped = {"stdout": 0, "stderr": 0}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.loop, name="python-exec-output", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, stream_name: str, s: str):
+        with self.lock:
+            pending = self.pending[stream_name]
+            pending.append(s)
+            self.pending_len[stream_name] += len(s)
+            # only the latest output is worth rendering, drop whole chunks from the front
+            while self.pending_len[stream_name] - len(pending[0]) >= PYTHON_EXEC_STREAM_MAX_CHARS:
+                dropped = pending.pop(0)
+                self.pending_len[stream_name] -= len(dropped)
+                self.skipped[stream_name] += len(dropped)
+
+    def flush(self):
+        for stream_name in ("stdout", "stderr"):
+            with self.lock:
+                pending = self.pending[stream_name]
+                skipped = self.skipped[stream_name]
+                if not pending and not skipped:
+                    continue
+                text = "".join(pending)
+                self.pending[stream_name] = []
+                self.pending_len[stream_name] = 0
+                self.skipped[stream_name] = 0
+            if len(text) > PYTHON_EXEC_STREAM_MAX_CHARS:
+                skipped += len(text) - PYTHON_EXEC_STREAM_MAX_CHARS
+                text = text[-PYTHON_EXEC_STREAM_MAX_CHARS:]
+            if skipped:
+                text = f"[... {skipped:,} chars skipped ...]\n{text}"
+            self.emit(stream_name, text, skipped)
+
+    def loop(self):
+        while not self.stopped.wait(PYTHON_EXEC_STREAM_INTERVAL_SECONDS):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+
+def python_exec_impl(
+    source: str, tee: Callable[[str, str], None] | None = None
+) -> PythonExecResponse:
+    """tee(stream_name, text) also gets every write to stdout/stderr, e.g. to stream it live."""
     sandbox_globals["session_id"] = session_id
 
-    buf_out = io.StringIO()
-    buf_err = io.StringIO()
+    buf_out = BoundedOutputCapture("stdout", python_exec_output_cap, tee)
+    buf_err = BoundedOutputCapture("stderr", python_exec_output_cap, tee)
 
     status = "unknown"
     code = None
-    with contextlib.redirect_stdout(buf_out), contextlib.redirect_stderr(buf_err):
+    with python_exec_router.capture(buf_out, buf_err):
         try:
             code = sandbox.compile(source=source, filename="<input>", symbol="exec")
         except (OverflowError, SyntaxError, ValueError):
@@ -804,12 +1495,24 @@ def python_exec_impl(source: str) -> PythonExecResponse:
             status = "incomplete_code"
         else:
             try:
+                kernel_memory_manager.before_exec(code)
+                kernel_state_restore.load(code)
                 exec(code, globals=sandbox_globals, locals=None)
 
                 status = "ok"
             except Exception:
                 sandbox.showtraceback()
                 status = "runtime_error"
+            except KeyboardInterrupt:
+                # only the kernel process turns an interrupt into a result, see PythonExecKernel
+                if not kernel_process:
+                    raise
+                sandbox.showtraceback()
+                status = "interrupted"
+            kernel_memory_manager.after_exec(code)
+
+    buf_out.finish()
+    buf_err.finish()
 
     return PythonExecResponse(
         status=status,
@@ -819,92 +1522,1550 @@ def python_exec_impl(source: str) -> PythonExecResponse:
     )
 
 
-console = Console(stderr=True, soft_wrap=True)
-dspq = queue.Queue()
+# NOTE(hzuo-26-10-18-sun): Import pre-warming. The first python_exec of a session usually imports
+# duckdb/polars/pandas, which costs seconds on the critical path of the first step. At startup
+# the sandbox's process (the bot, or the kernel in subprocess mode) imports
+# PERSONALBOT_PREWARM_IMPORTS on a background thread while the first prompt is being written,
+# and binds each one in sandbox_globals under its usual alias (unless the name is already
+# taken). A cell that imports a module still being warmed just waits on the import lock for
+# the rest of it. The timings are logged with "python_exec imports prewarmed". An empty list
+# disables it.
+PREWARM_IMPORTS = os.environ.get(
+    "PERSONALBOT_PREWARM_IMPORTS",
+    "duckdb, polars as pl, pandas as pd, pyarrow as pa, matplotlib.pyplot as plt, fitdecode",
+)
 
-# NOTE(hzuo-25-12-10-wed): We buffer streaming content so we can render it with
-# Syntax(..., "markdown") at the end of each block. This is the simplest approach
-# that works uniformly across all providers (OpenAI streams incrementally, while
-# Anthropic/Gemini send complete blocks). During streaming we stay silent; the
-# user sees the opening tag and knows something is happening, then sees the
-# formatted output when the block completes.
-_dsp_buffers = {
-    "reasoning": "",
-    "text": "",
-    "tool-input": "",
-}
 
+def python_exec_prewarm():
+    """Import PREWARM_IMPORTS into sandbox_globals on a background thread."""
+    specs = [spec.split() for spec in PREWARM_IMPORTS.split(",") if spec.strip()]
+    if not specs:
+        return
 
-@logfire.instrument(extract_args=["code"], record_return=False)
-def python_exec(code: str) -> PythonExecResponse:
-    dspq.put(
-        {
-            "type": "data-python-exec-call-start",
-            "code": code,
-        }
-    )
-    # this join is important to ensure the queue is empty before we start python_exec_impl
-    # otherwise the printer thread's output will get captured by the contextlib calls made by python_exec_impl
-    dspq.join()
+    def prewarm():
+        t0 = time.perf_counter()
+        timings: dict[str, float] = {}
+        failed: dict[str, str] = {}
+        for spec in specs:
+            module_name = spec[0]
+            t1 = time.perf_counter()
+            try:
+                module = importlib.import_module(module_name)
+            except Exception as e:
+                failed[module_name] = f"{type(e).__name__}: {e}"[:200]
+                continue
+            timings[module_name] = round(time.perf_counter() - t1, 3)
+            if len(spec) == 3 and spec[1] == "as":
+                sandbox_globals.setdefault(spec[2], module)
+            else:
+                # like `import a.b`, which binds a
+                top = module_name.partition(".")[0]
+                sandbox_globals.setdefault(top, sys.modules[top])
+        logfire.info(
+            "python_exec imports prewarmed",
+            seconds=round(time.perf_counter() - t0, 3),
+            timings=timings,
+            failed=failed,
+        )
 
-    # Set baggage so all descendant spans (including auto-instrumented HTTP calls) are tagged.
-    # This allows alerts to filter out errors from sandbox code vs the bot's own code.
-    with logfire.set_baggage(python_exec="true"):
-        result = python_exec_impl(code)
+    threading.Thread(target=prewarm, name="python-exec-prewarm", daemon=True).start()
+
+
+# NOTE(hzuo-26-10-18-sun): Out-of-process python_exec kernel, opt-in with PERSONALBOT_KERNEL=subprocess.
+# The in-process sandbox shares the bot's interpreter: a heavy pandas/polars job holds the GIL
+# and stalls the printer thread, a segfault in a native library takes the whole session down,
+# and Ctrl-C can only abort the turn. In subprocess mode sandbox_globals live in a child
+# process (this file imported as a module, running kernel_main) that runs each call through
+# the same python_exec_impl and sends back the result fields and the image attachment paths,
+# so everything downstream (blobs, DSP events, history) is unchanged.
+# The protocol is pickled tuples over a socketpair (multiprocessing.connection framing):
+#   kernel -> bot: ("ready", pid) once, after startup
+#   ("exec", seq, code, session_id, trace_carrier)
+#     -> ("result", seq, status, stdout, stderr, image_files)
+#     preceded by any number of ("output", seq, stream_name, text, skipped_chars) while it runs
+#   ("eval", seq, expr) -> ("value", seq, value) or ("error", seq, message)
+#   ("call", seq, fn_name, args) -> ("value", seq, value) or ("error", seq, message), fn_name
+#     of this file
+# seq numbers the bot's requests, and replies to anything but the current one are dropped.
+# The kernel blocks SIGINT while it sends, so an interrupt can't truncate a message.
+# The kernel runs in its own session so the terminal's Ctrl-C only reaches the bot, which
+# forwards it to the running call as a SIGINT: the call returns status "interrupted" and the
+# turn goes on. A call over kernel_timeout_seconds is interrupted the same way (status
+# "timeout"), and a kernel over kernel_max_rss_mb is killed (status "memory_limit"). A kernel
+# that doesn't come back from an interrupt within KERNEL_INTERRUPT_GRACE_SECONDS is killed
+# too, and one that dies (segfault, os._exit, the OOM killer) reports status "kernel_died".
+# A killed or dead kernel is restarted on the next call, with fresh state; /restart-kernel
+# restarts it on demand. Calls are serialized, parallel tool calls run one at a time.
+python_exec_kernel_mode = os.environ.get("PERSONALBOT_KERNEL", "inprocess")
+assert python_exec_kernel_mode in ("inprocess", "subprocess"), (
+    f"PERSONALBOT_KERNEL must be inprocess or subprocess, got {python_exec_kernel_mode}"
+)
+# 0 disables the limit
+kernel_timeout_seconds = float(os.environ.get("PERSONALBOT_KERNEL_TIMEOUT_SECONDS", "0"))
+kernel_max_rss_mb = int(os.environ.get("PERSONALBOT_KERNEL_MAX_RSS_MB", "0"))
+KERNEL_INTERRUPT_GRACE_SECONDS = 10
+KERNEL_START_TIMEOUT_SECONDS = 120
+KERNEL_POLL_SECONDS = 0.5
+
+# set in the kernel process itself
+kernel_process = False
+
+KERNEL_BOOTSTRAP = """
+import importlib.util, json, sys
+path, fd, argv = sys.argv[1], int(sys.argv[2]), json.loads(sys.argv[3])
+# personalbot.py parses argv at import time to pick a model
+sys.argv = argv
+spec = importlib.util.spec_from_file_location("personalbot", path)
+mod = importlib.util.module_from_spec(spec)
+sys.modules["personalbot"] = mod
+spec.loader.exec_module(mod)
+mod.kernel_main(fd)
+"""
+
+
+class KernelDied(Exception):
+    pass
+
+
+def process_rss_bytes(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    # no procfs (macOS)
+    try:
+        out = subprocess.run(
+            ["ps", "-o", "rss=", "-p", str(pid)],
+            capture_output=True,
+            text=True,
+            timeout=5,
+        ).stdout
+        return int(out.strip()) * 1024
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+class PythonExecKernel:
+    def __init__(self):
+        self.process: subprocess.Popen | None = None
+        self.conn: multiprocessing.connection.Connection | None = None
+        self.ready = False
+        self.busy = False
+        self.lock = threading.Lock()
+        self.on_output: Callable[[str, str, int], None] | None = None
+        # every request is tagged with the next number, its replies echo it back
+        self.seq = 0
+
+    def start(self):
+        """Start the kernel process without waiting for it to be ready."""
+        if self.process is not None:
+            return
+        parent_conn, child_conn = multiprocessing.connection.Pipe()
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                KERNEL_BOOTSTRAP,
+                str(Path(__file__).resolve()),
+                str(child_conn.fileno()),
+                json.dumps(sys.argv),
+            ],
+            pass_fds=[child_conn.fileno()],
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        child_conn.close()
+        self.conn = parent_conn
+        self.ready = False
+        logfire.info("python_exec kernel started", pid=self.process.pid)
 
-    image_attachment_files = helpers.drain_image_attachments()
-    image_attachments = read_image_attachments(image_attachment_files)
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.conn.close()
+        # a killed kernel can't clean up after itself
+        for directory in SESSIONS_DIR.glob(f"*.spill-{self.process.pid}"):
+            shutil.rmtree(directory, ignore_errors=True)
+        logfire.info(
+            "python_exec kernel stopped",
+            pid=self.process.pid,
+            returncode=self.process.returncode,
+        )
+        self.process = None
+        self.conn = None
+        self.ready = False
+
+    def restart(self):
+        with self.lock:
+            self.stop()
+            self.start()
+
+    def interrupt(self):
+        process = self.process
+        if self.busy and process is not None and process.poll() is None:
+            os.kill(process.pid, signal.SIGINT)
+
+    def recv(self, timeout: float) -> Any:
+        """Wait for the next message, None on timeout."""
+        try:
+            if not self.conn.poll(timeout):
+                return None
+            return self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise KernelDied() from e
+
+    def request(self, message: tuple) -> tuple:
+        if self.process is not None and self.process.poll() is not None:
+            self.stop()
+        self.start()
+        deadline = time.monotonic() + KERNEL_START_TIMEOUT_SECONDS
+        while not self.ready:
+            reply = self.recv(KERNEL_POLL_SECONDS)
+            if reply is not None and reply[0] == "ready":
+                self.ready = True
+            elif self.process.poll() is not None:
+                raise KernelDied()
+            elif time.monotonic() > deadline:
+                self.stop()
+                raise RuntimeError("python_exec kernel failed to start")
+        self.seq += 1
+        try:
+            self.conn.send((message[0], self.seq, *message[1:]))
+        except OSError as e:
+            raise KernelDied() from e
+        return self.wait(self.seq)
+
+    def wait(self, seq: int) -> tuple:
+        """Wait for the reply to request seq, returned without its seq."""
+        started = time.monotonic()
+        interrupted_at = None
+        status = None
+        while True:
+            try:
+                reply = self.recv(KERNEL_POLL_SECONDS)
+            except KeyboardInterrupt:
+                # Ctrl-C cancels the running call, not the turn
+                self.interrupt()
+                interrupted_at = interrupted_at or time.monotonic()
+                continue
+            if reply is not None and reply[0] != "ready":
+                if reply[1] != seq:
+                    # e.g. the result of a call that was abandoned (by an exception in this
+                    # process) after it was sent, reading it as this call's would shift every
+                    # later reply by one
+                    logfire.warn(
+                        "dropping a stale python_exec kernel reply",
+                        kind=reply[0],
+                        seq=reply[1],
+                        expected_seq=seq,
+                    )
+                    continue
+                reply = (reply[0], *reply[2:])
+            if reply is not None and reply[0] == "output":
+                if self.on_output is not None:
+                    self.on_output(*reply[1:])
+            elif reply is not None:
+                if status is not None and reply[0] == "result":
+                    return (reply[0], status, *reply[2:])
+                return reply
+            if self.process.poll() is not None:
+                raise KernelDied()
+
+            now = time.monotonic()
+            if kernel_max_rss_mb > 0:
+                rss = process_rss_bytes(self.process.pid)
+                if rss is not None and rss > kernel_max_rss_mb * 1024 * 1024:
+                    logfire.warn(
+                        "python_exec kernel over memory limit, killing it",
+                        rss_mb=rss // (1024 * 1024),
+                        max_rss_mb=kernel_max_rss_mb,
+                    )
+                    self.stop()
+                    return (
+                        "result",
+                        "memory_limit",
+                        "",
+                        f"[kernel] the kernel's memory use ({rss // (1024 * 1024):,} MB) went over"
+                        f" the limit of {kernel_max_rss_mb:,} MB (PERSONALBOT_KERNEL_MAX_RSS_MB),"
+                        " so it was killed. All kernel state (variables, imports) was lost.\n",
+                        [],
+                    )
+            if (
+                kernel_timeout_seconds > 0
+                and interrupted_at is None
+                and now - started > kernel_timeout_seconds
+            ):
+                logfire.warn(
+                    "python_exec call timed out, interrupting it",
+                    timeout_seconds=kernel_timeout_seconds,
+                )
+                status = "timeout"
+                self.interrupt()
+                interrupted_at = now
+            if (
+                interrupted_at is not None
+                and now - interrupted_at > KERNEL_INTERRUPT_GRACE_SECONDS
+            ):
+                logfire.warn("python_exec kernel ignored the interrupt, killing it")
+                self.stop()
+                return (
+                    "result",
+                    status or "interrupted",
+                    "",
+                    "[kernel] the call didn't stop when interrupted, so the kernel was killed."
+                    " All kernel state (variables, imports) was lost.\n",
+                    [],
+                )
 
-    result.image_attachments = image_attachments
+    def exec(
+        self, code: str, on_output: Callable[[str, str, int], None] | None = None
+    ) -> tuple[PythonExecResponse, list[str]]:
+        """on_output(stream_name, text, skipped_chars) gets the live output, if streaming."""
+        carrier = logfire.propagate.get_context()
+        with self.lock:
+            self.busy = True
+            self.on_output = on_output
+            try:
+                _, status, stdout, stderr, image_files = self.request(
+                    ("exec", code, session_id, carrier)
+                )
+            except KernelDied:
+                returncode = self.process.wait()
+                self.stop()
+                name = (
+                    f" {signal.Signals(-returncode).name}"
+                    if -returncode in signal.valid_signals()
+                    else ""
+                )
+                status, stdout, image_files = "kernel_died", "", []
+                stderr = (
+                    f"[kernel] the kernel process died (exit code {returncode}{name}) during"
+                    " this call. All kernel state (variables, imports) was lost, it is"
+                    " restarted on the next call.\n"
+                )
+            finally:
+                self.busy = False
+                self.on_output = None
+        if status == "timeout":
+            stderr += (
+                f"[kernel] interrupted after the {kernel_timeout_seconds:g}s time limit"
+                " (PERSONALBOT_KERNEL_TIMEOUT_SECONDS).\n"
+            )
+        response = PythonExecResponse(
+            status=status, stdout=stdout, stderr=stderr, image_attachments=[]
+        )
+        return response, image_files
 
-    dspq.put(
-        {
-            "type": "data-python-exec-call-end",
-            "status": result.status,
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "image_attachments": image_attachments,
-        }
-    )
-    dspq.join()
+    def eval(self, expr: str) -> Any:
+        with self.lock:
+            reply = self.request(("eval", expr))
+        if reply[0] == "error":
+            raise RuntimeError(f"python_exec kernel eval failed: {reply[1]}")
+        return reply[1]
 
-    span = opentelemetry.trace.get_current_span()
-    span.set_attribute("len_code", len(code))
-    span.set_attribute("len_output", len(result.stdout) + len(result.stderr))
-    span.set_attribute("len_stdout", len(result.stdout))
-    span.set_attribute("len_stderr", len(result.stderr))
-    span.set_attribute("num_image_attachments", len(image_attachments))
-    span.set_attribute(
-        "sum_len_image_attachments",
-        sum(len(data_url) for _, data_url in image_attachments),
-    )
-    span.set_attribute(
-        "len_image_attachments",
-        json.dumps({path: len(data_url) for path, data_url in image_attachments}),
-    )
-    span.set_attribute("status", result.status)
-    span.set_attribute("stdout", result.stdout[:400000])
-    span.set_attribute("stderr", result.stderr[:400000])
+    def call(self, fn_name: str, *args) -> Any:
+        with self.lock:
+            reply = self.request(("call", fn_name, args))
+        if reply[0] == "error":
+            raise RuntimeError(f"python_exec kernel call {fn_name} failed: {reply[1]}")
+        return reply[1]
 
-    return result
 
+python_exec_kernel = (
+    PythonExecKernel() if python_exec_kernel_mode == "subprocess" else None
+)
+if python_exec_kernel is not None:
+    atexit.register(python_exec_kernel.stop)
 
-def read_image_attachments(image_attachment_files: list[str]) -> list[Tuple[str, str]]:
-    ret: list[Tuple[str, str]] = []
-    for file in image_attachment_files:
-        image_bytes = Path(file).read_bytes()
-        image_base64 = base64.b64encode(image_bytes).decode("ascii")
 
-        content_type, content_encoding = mimetypes.guess_type(file)
-        if not content_type:
-            console.print(f"[yellow]Unexpected image content_type: {file}[/yellow]")
-            continue
-        if content_encoding:
-            console.print(f"[yellow]Unexpected image content_encoding: {file}[/yellow]")
+def sandbox_eval(expr: str) -> Any:
+    """Evaluate an expression against sandbox_globals, in whichever process they live."""
+    if python_exec_kernel is not None:
+        return python_exec_kernel.eval(expr)
+    return eval(expr, sandbox_globals)
+
+
+def kernel_call(fn_name: str, *args) -> Any:
+    """Call a module-level function of this file in whichever process sandbox_globals live."""
+    if python_exec_kernel is not None:
+        return python_exec_kernel.call(fn_name, *args)
+    return globals()[fn_name](*args)
+
+
+def sandbox_update(name: str, values: dict):
+    """Merge values into the dict sandbox_globals[name], called through kernel_call."""
+    sandbox_globals[name].update(values)
+
+
+# NOTE(hzuo-26-10-18-sun): Kernel state snapshots. /continue used to bring back only the messages,
+# so the model spent its first steps rebuilding every DataFrame it had loaded. At the end of
+# every turn and on /fork, the user's kernel globals are saved next to the session, in
+# <session_id>.kernel/: pandas and polars DataFrames as Parquet (the fast path, with pickle as
+# the fallback), imported modules by name, and everything else that pickles. Values that
+# don't pickle (connections, functions and classes defined in a cell) or are larger than
+# kernel_snapshot_max_mb are skipped and listed in the manifest. /continue attaches the
+# continued session's snapshot, and each value is only loaded the first time a cell refers to
+# its name, so resuming is instant and a 2 GB DataFrame that's never touched is never read.
+# Values that are still unloaded when the next snapshot is taken are carried over as-is.
+# The end-of-turn snapshot runs in the background (python_exec waits for it), and only rewrites
+# what changed: a value no cell has loaded or stored since the last snapshot (directly or through
+# a function it called) is hard-linked from there, a skipped one stays skipped. A value only
+# changed through another name (an element of a list, say) keeps its old copy. Pickles are
+# written straight to the file and abandoned once over the limit. Only the snapshots of the
+# PERSONALBOT_KERNEL_SNAPSHOT_KEEP most recent sessions are kept.
+kernel_snapshots = env_flag("PERSONALBOT_KERNEL_SNAPSHOTS", True)
+kernel_snapshot_max_mb = int(os.environ.get("PERSONALBOT_KERNEL_SNAPSHOT_MAX_MB", "1024"))
+kernel_snapshot_keep = int(os.environ.get("PERSONALBOT_KERNEL_SNAPSHOT_KEEP", "20"))
+
+# the globals every kernel starts with, never part of a snapshot
+SANDBOX_BASE_GLOBALS = dict(sandbox_globals)
+
+
+def kernel_snapshot_dir(session: str) -> Path:
+    return SESSIONS_DIR / f"{session}.kernel"
+
+
+def dataframe_kind(value: Any) -> str | None:
+    """"pandas" or "polars" for a DataFrame, without importing either."""
+    pandas = sys.modules.get("pandas")
+    polars = sys.modules.get("polars")
+    if pandas is not None and isinstance(value, pandas.DataFrame):
+        return "pandas"
+    if polars is not None and isinstance(value, polars.DataFrame):
+        return "polars"
+    return None
+
+
+def dataframe_nbytes(value: Any, kind: str, deep: bool = False) -> int:
+    """deep also counts the Python objects in pandas object columns (slow on large frames)."""
+    if kind == "pandas":
+        return int(value.memory_usage(deep=deep).sum())
+    return int(value.estimated_size())
+
+
+def dataframe_write_parquet(value: Any, kind: str, path: Path) -> bool:
+    try:
+        if kind == "pandas":
+            value.to_parquet(path)
+        else:
+            value.write_parquet(path)
+        return True
+    except Exception:
+        # e.g. non-string column names, or no pyarrow
+        path.unlink(missing_ok=True)
+        return False
+
+
+class SizeLimitedWriter:
+    """Write to f, raising once more than max_bytes have been written."""
+
+    def __init__(self, f: Any, max_bytes: int):
+        self.f = f
+        self.max_bytes = max_bytes
+        self.written = 0
+
+    def write(self, data: Any) -> int:
+        self.written += len(data)
+        if self.written > self.max_bytes:
+            raise ValueError(f"too large (over {self.max_bytes // (1024 * 1024):,} MB)")
+        return self.f.write(data)
+
+
+def kernel_snapshot_value(name: str, value: Any, directory: Path) -> dict:
+    """Write one value into directory and return its manifest entry (raises if it can't be saved)."""
+    max_bytes = kernel_snapshot_max_mb * 1024 * 1024
+    if isinstance(value, types.ModuleType):
+        return {"kind": "module", "module": value.__name__}
+    kind = dataframe_kind(value)
+    if kind is not None:
+        size = dataframe_nbytes(value, kind)
+        if size > max_bytes:
+            raise ValueError(f"too large ({size // (1024 * 1024):,} MB)")
+        if dataframe_write_parquet(value, kind, directory / f"{name}.parquet"):
+            return {"kind": kind, "file": f"{name}.parquet"}
+    path = directory / f"{name}.pickle"
+    try:
+        with path.open("wb") as f:
+            pickle.dump(value, SizeLimitedWriter(f, max_bytes), protocol=pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return {"kind": "pickle", "file": f"{name}.pickle"}
+
+
+def kernel_snapshot_link(src: Path, dst: Path):
+    """Hard-link src to dst, copying where the filesystem can't link."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+# name -> (id of the value, snapshot directory, manifest entry or the reason it was skipped) as
+# of the last snapshot, taken after kernel_snapshot_clock cells had run
+kernel_snapshot_last: dict[str, tuple[int, Path, dict | str]] = {}
+kernel_snapshot_clock = 0
+
+
+def kernel_snapshot_reuse(name: str, value: Any, tmp: Path) -> dict | str | None:
+    """The last snapshot's entry for a value that hasn't changed since, linked into tmp."""
+    last = kernel_snapshot_last.get(name)
+    if (
+        last is None
+        or last[0] != id(value)
+        or kernel_memory_manager.last_used.get(name, 0) > kernel_snapshot_clock
+    ):
+        return None
+    _, directory, entry = last
+    if isinstance(entry, dict) and "file" in entry:
+        try:
+            kernel_snapshot_link(directory / entry["file"], tmp / entry["file"])
+        except OSError:
+            # e.g. that snapshot was pruned since
+            return None
+    return entry
+
+
+def kernel_snapshot_write(directory_str: str) -> dict:
+    """Snapshot the user's kernel globals into directory (replacing it), runs in the kernel."""
+    directory = Path(directory_str)
+    t0 = time.perf_counter()
+    tmp = directory.with_name(f"{directory.name}.tmp-{uuid.uuid4().hex[:8]}")
+    tmp.mkdir(parents=True)
+    values: dict[str, dict] = {}
+    skipped: dict[str, str] = {}
+    ids: dict[str, int] = {}
+    reused = 0
+    clock = kernel_memory_manager.clock
+    for name, value in list(sandbox_globals.items()):
+        if name.startswith("_") or name in SANDBOX_BASE_GLOBALS:
+            continue
+        ids[name] = id(value)
+        entry = kernel_snapshot_reuse(name, value, tmp)
+        if entry is not None:
+            reused += 1
+        else:
+            try:
+                entry = kernel_snapshot_value(name, value, tmp)
+            except Exception as e:
+                entry = f"{type(e).__name__}: {e}"[:200]
+        if isinstance(entry, str):
+            skipped[name] = entry
+        else:
+            values[name] = entry
+    if not values and not skipped and not kernel_state_restore.pending and not directory.exists():
+        # nothing to save, don't leave an empty snapshot behind every session
+        tmp.rmdir()
+        return {"values": 0, "skipped": {}, "bytes": 0, "seconds": 0}
+    # carry over what was restored from an earlier snapshot but hasn't been used (or replaced) yet
+    carried = {}
+    for name, (source, entry) in kernel_state_restore.pending.items():
+        if name in values or name in sandbox_globals:
+            continue
+        if "file" in entry:
+            kernel_snapshot_link(source / entry["file"], tmp / entry["file"])
+        values[name] = {key: value for key, value in entry.items() if key != "spilled"}
+        if not entry.get("spilled"):
+            carried[name] = values[name]
+    manifest = {
+        "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "values": values,
+        "skipped": skipped,
+    }
+    (tmp / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    if directory.exists():
+        old = directory.with_name(f"{directory.name}.old-{uuid.uuid4().hex[:8]}")
+        directory.rename(old)
+        tmp.rename(directory)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        tmp.rename(directory)
+    # unloaded values now load from this snapshot, so the one they came from can be pruned
+    for name, entry in carried.items():
+        kernel_state_restore.pending[name] = (directory, entry)
+    global kernel_snapshot_clock
+    kernel_snapshot_clock = clock
+    kernel_snapshot_last.clear()
+    for name, entry in itertools.chain(values.items(), skipped.items()):
+        if name in ids:
+            kernel_snapshot_last[name] = (ids[name], directory, entry)
+    return {
+        "values": len(values),
+        "reused": reused,
+        "skipped": skipped,
+        "bytes": sum(f.stat().st_size for f in directory.iterdir()),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+
+
+def kernel_snapshot_attach(directory_str: str) -> dict:
+    """Make a snapshot's values load on first use, runs in the kernel."""
+    directory = Path(directory_str)
+    manifest = json.loads((directory / "manifest.json").read_text())
+    for name in manifest["values"]:
+        # whatever the current session had under the same name is superseded
+        sandbox_globals.pop(name, None)
+        kernel_state_restore.pending[name] = (directory, manifest["values"][name])
+    return {"values": list(manifest["values"]), "skipped": manifest["skipped"]}
+
+
+class KernelStateRestore:
+    def __init__(self):
+        # name -> (snapshot directory, manifest entry), for values not loaded yet
+        self.pending: dict[str, tuple[Path, dict]] = {}
+
+    def load(self, code: types.CodeType):
+        """Load the pending values the code reads as globals, before it runs."""
+        if not self.pending:
+            return
+        # only loads count: co_names also has the names the code stores, deletes or uses as
+        # attributes (df.x would load a pending x), and misses what the functions it calls read
+        names = sandbox_transitive_loads(code_global_names(code)[0])
+        for name in names & self.pending.keys():
+            directory, entry = self.pending.pop(name)
+            if name in sandbox_globals:
+                continue
+            try:
+                kind = entry["kind"]
+                if kind == "module":
+                    value = importlib.import_module(entry["module"])
+                elif kind == "pandas":
+                    import pandas
+
+                    value = pandas.read_parquet(directory / entry["file"])
+                elif kind == "polars":
+                    import polars
+
+                    value = polars.read_parquet(directory / entry["file"])
+                else:
+                    value = pickle.loads((directory / entry["file"]).read_bytes())
+            except Exception as e:
+                print(
+                    f"[kernel snapshot] failed to restore {name}: {type(e).__name__}: {e}",
+                    file=sys.stderr,
+                )
+                continue
+            sandbox_globals[name] = value
+            if entry.get("spilled"):
+                (directory / entry["file"]).unlink(missing_ok=True)
+
+
+kernel_state_restore = KernelStateRestore()
+
+
+# the background snapshot in progress, see kernel_snapshot_wait
+kernel_snapshot_thread: threading.Thread | None = None
+
+
+def kernel_snapshot_wait():
+    """Wait for the background snapshot, if any, before anything else uses the kernel's globals."""
+    thread = kernel_snapshot_thread
+    if thread is not None:
+        thread.join()
+
+
+atexit.register(kernel_snapshot_wait)
+
+
+def snapshot_kernel_state(session: str, background: bool = False):
+    global kernel_snapshot_thread
+    if not kernel_snapshots:
+        return
+    kernel_snapshot_wait()
+
+    def run():
+        try:
+            summary = kernel_call("kernel_snapshot_write", str(kernel_snapshot_dir(session)))
+        except Exception:
+            logfire.exception("kernel snapshot failed")
+            return
+        logfire.info("kernel snapshot", session=session, **summary)
+        if background:
+            prune_kernel_snapshots(session)
+
+    if not background:
+        run()
+        return
+    kernel_snapshot_thread = threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(run,),
+        name="kernel-snapshot",
+        daemon=True,
+    )
+    kernel_snapshot_thread.start()
+
+
+def prune_kernel_snapshots(session: str):
+    """Keep the kernel_snapshot_keep most recent snapshots, and drop abandoned temporary dirs."""
+    snapshots = []
+    for path in SESSIONS_DIR.glob("*.kernel*"):
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            continue
+        if path.suffix == ".kernel":
+            if path != kernel_snapshot_dir(session):
+                snapshots.append((mtime, path))
+        elif time.time() - mtime > 3600:
+            # a .tmp-/.old- dir left behind by a process that died while writing
+            shutil.rmtree(path, ignore_errors=True)
+    snapshots.sort(reverse=True)
+    for _, path in snapshots[max(kernel_snapshot_keep - 1, 0) :]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def fork_kernel_snapshot(old_session: str, new_session: str):
+    """Give the forked session a copy of the kernel snapshot (hard links, no data copied)."""
+    snapshot_kernel_state(old_session)
+    source = kernel_snapshot_dir(old_session)
+    if not kernel_snapshots or not source.exists():
+        return
+    shutil.copytree(
+        source,
+        kernel_snapshot_dir(new_session),
+        copy_function=lambda src, dst: kernel_snapshot_link(Path(src), Path(dst)),
+    )
+
+
+def restore_kernel_state(session_file: Path):
+    """Attach the kernel snapshot saved next to session_file, if there is one."""
+    directory = session_file.with_suffix(".kernel")
+    if not kernel_snapshots or not (directory / "manifest.json").exists():
+        return
+    kernel_snapshot_wait()
+    try:
+        summary = kernel_call("kernel_snapshot_attach", str(directory))
+    except Exception:
+        logfire.exception("kernel snapshot attach failed")
+        console.print("[yellow]Failed to restore the kernel snapshot[/yellow]")
+        return
+    logfire.info("kernel snapshot attached", directory=str(directory), **summary)
+    names = ", ".join(summary["values"]) or "(none)"
+    console.print(
+        f"[green]Kernel state restored, loaded on first use: {names}[/green]",
+        highlight=False,
+    )
+    if summary["skipped"]:
+        console.print(
+            f"[yellow]Not in the snapshot: {', '.join(summary['skipped'])}[/yellow]",
+            highlight=False,
+        )
+
+
+# NOTE(hzuo-26-10-18-sun): Kernel memory manager. Long analysis sessions pile up DataFrames in
+# sandbox_globals until the box runs out of memory. helpers.kernel_memory() reports the
+# process RSS and an estimated size per variable. With PERSONALBOT_KERNEL_MEMORY_MAX_MB set and
+# PERSONALBOT_KERNEL=subprocess (in process the RSS is mostly the bot's own history and buffers,
+# which no spill would free, so there the ceiling is ignored), after every python_exec call
+# whose kernel RSS is over the ceiling, the least recently used pandas/polars DataFrames (of at
+# least KERNEL_SPILL_MIN_MB, not used by that call, and not also held by a container, closure or
+# object, otherwise spilling frees nothing and splits the aliases) are written to Parquet under
+# <session_id>.spill-<pid>/ in the sessions dir and dropped until the estimate is back under
+# the ceiling. A spilled DataFrame goes through the same lazy path as a restored snapshot: it
+# is read back the next time a cell refers to its name. That only sees the cell's own code, so
+# a DataFrame that a function or class defined in an earlier cell reads as a global is never
+# spilled. "Recently used" counts the cells that referred to the name, directly or through the
+# functions they call. Keep the ceiling below PERSONALBOT_KERNEL_MAX_RSS_MB, which kills the
+# kernel instead. Spill files are removed once read back, and the rest when the process exits.
+kernel_memory_max_mb = int(os.environ.get("PERSONALBOT_KERNEL_MEMORY_MAX_MB", "0"))
+KERNEL_SPILL_MIN_MB = 64
+# container elements measured for the size estimate, the rest is extrapolated
+KERNEL_MEMORY_SAMPLE = 1000
+
+
+def kernel_value_size(value: Any) -> int:
+    """Estimated bytes held by value (only the top level of containers, sampled)."""
+    kind = dataframe_kind(value)
+    if kind is not None:
+        return dataframe_nbytes(value, kind, deep=True)
+    pandas = sys.modules.get("pandas")
+    polars = sys.modules.get("polars")
+    if pandas is not None and isinstance(value, (pandas.Series, pandas.Index)):
+        return int(value.memory_usage(deep=True))
+    if polars is not None and isinstance(value, polars.Series):
+        return int(value.estimated_size())
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy arrays, pyarrow tables
+        return nbytes
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset, dict)) and value:
+        items = itertools.islice(
+            value.items() if isinstance(value, dict) else value, KERNEL_MEMORY_SAMPLE
+        )
+        sampled = [
+            sys.getsizeof(item[0]) + sys.getsizeof(item[1])
+            if isinstance(value, dict)
+            else sys.getsizeof(item)
+            for item in items
+        ]
+        size += sum(sampled) * len(value) // len(sampled)
+    return size
+
+
+class KernelMemoryManager:
+    def __init__(self):
+        # cells run so far, and the cell that last referred to each name
+        self.clock = 0
+        self.last_used: dict[str, int] = {}
+        self.spill_dirs: set[Path] = set()
+
+    def user_names(self) -> list[str]:
+        return [
+            name
+            for name in sandbox_globals
+            if not name.startswith("_") and name not in SANDBOX_BASE_GLOBALS
+        ]
+
+    def before_exec(self, code: types.CodeType):
+        self.clock += 1
+        loads, stores = code_global_names(code)
+        # stores too: kernel snapshots rewrite the values a cell could have changed
+        for name in sandbox_transitive_loads(loads) | stores:
+            self.last_used[name] = self.clock
+
+    def after_exec(self, code: types.CodeType):
+        if kernel_memory_max_mb > 0 and kernel_process:
+            try:
+                self.enforce()
+            except Exception:
+                logfire.exception("kernel memory enforcement failed")
+
+    def enforce(self):
+        rss = process_rss_bytes(os.getpid())
+        ceiling = kernel_memory_max_mb * 1024 * 1024
+        if rss is None or rss <= ceiling:
+            return
+        spilled = {}
+        held = []
+        # a function reading a spilled global would get a NameError, nothing loads it back
+        read_by_functions = set().union(
+            *(sandbox_value_loads(value) for value in list(sandbox_globals.values()))
+        )
+        # never what the cell that just ran used, it would only be read back right away
+        names = sorted(
+            (
+                name
+                for name in self.user_names()
+                if dataframe_kind(sandbox_globals[name])
+                and self.last_used.get(name, 0) < self.clock
+                and name not in read_by_functions
+            ),
+            key=lambda name: self.last_used.get(name, 0),
+        )
+        for name in names:
+            if rss <= ceiling:
+                break
+            value = sandbox_globals[name]
+            if any(
+                referrer is not sandbox_globals and not isinstance(referrer, types.FrameType)
+                for referrer in gc.get_referrers(value)
+            ):
+                held.append(name)
+                continue
+            size = kernel_value_size(value)
+            if size < KERNEL_SPILL_MIN_MB * 1024 * 1024 or not self.spill(name, value):
+                continue
+            del value
+            spilled[name] = size // (1024 * 1024)
+            rss -= size
+        if not spilled:
+            # info, not warn: a warning would print into the cell's captured output
+            logfire.info(
+                "kernel over its memory ceiling, nothing to spill",
+                rss_mb=process_rss_bytes(os.getpid()) // (1024 * 1024),
+                max_mb=kernel_memory_max_mb,
+                held_elsewhere=held,
+            )
+            return
+        gc.collect()
+        logfire.info(
+            "kernel memory spilled",
+            spilled_mb=spilled,
+            held_elsewhere=held,
+            rss_mb=(process_rss_bytes(os.getpid()) or 0) // (1024 * 1024),
+            max_mb=kernel_memory_max_mb,
+        )
+        print(
+            f"[kernel memory] over the {kernel_memory_max_mb:,} MB ceiling, spilled to Parquet"
+            f" (they load back when a cell uses them):"
+            f" {', '.join(f'{name} ({mb:,} MB)' for name, mb in spilled.items())}",
+            file=sys.stderr,
+        )
+
+    def spill(self, name: str, value: Any) -> bool:
+        directory = SESSIONS_DIR / f"{session_id}.spill-{os.getpid()}"
+        directory.mkdir(parents=True, exist_ok=True)
+        self.spill_dirs.add(directory)
+        # a unique name: an earlier spill file of the same name may be linked into a snapshot
+        file = f"{name}-{uuid.uuid4().hex[:8]}.parquet"
+        kind = dataframe_kind(value)
+        if not dataframe_write_parquet(value, kind, directory / file):
+            return False
+        del sandbox_globals[name]
+        kernel_state_restore.pending[name] = (
+            directory,
+            {"kind": kind, "file": file, "spilled": True},
+        )
+        return True
+
+    def report(self) -> dict:
+        variables = []
+        for name in self.user_names():
+            value = sandbox_globals[name]
+            if isinstance(value, types.ModuleType):
+                continue
+            variables.append(
+                {
+                    "name": name,
+                    "type": type(value).__name__,
+                    "size_mb": round(kernel_value_size(value) / (1024 * 1024), 1),
+                    "state": "resident",
+                    "cells_since_use": self.clock - self.last_used.get(name, 0),
+                }
+            )
+        for name, (directory, entry) in kernel_state_restore.pending.items():
+            if "file" not in entry:
+                continue
+            variables.append(
+                {
+                    "name": name,
+                    "type": entry["kind"],
+                    "size_mb": round(
+                        (directory / entry["file"]).stat().st_size / (1024 * 1024), 1
+                    ),
+                    "state": "spilled" if entry.get("spilled") else "snapshot",
+                    "cells_since_use": self.clock - self.last_used.get(name, 0),
+                }
+            )
+        variables.sort(key=lambda variable: variable["size_mb"], reverse=True)
+        return {
+            "rss_mb": (process_rss_bytes(os.getpid()) or 0) // (1024 * 1024),
+            "max_mb": (kernel_memory_max_mb or None) if kernel_process else None,
+            "variables": variables,
+        }
+
+    def cleanup(self):
+        for directory in self.spill_dirs:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+kernel_memory_manager = KernelMemoryManager()
+atexit.register(kernel_memory_manager.cleanup)
+
+
+def kernel_main(fd: int):
+    """The kernel process's loop, see PythonExecKernel."""
+    global kernel_process, python_exec_kernel, session_id
+    kernel_process = True
+    python_exec_kernel = None
+    conn = multiprocessing.connection.Connection(fd)
+    # the output streamer sends from its own thread
+    send_lock = threading.Lock()
+
+    def send(message: tuple):
+        # a Ctrl-C halfway through would leave a truncated message in the pipe, it's raised
+        # once the message is out (and then dropped by the except below)
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+        try:
+            with send_lock:
+                conn.send(message)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+    python_exec_prewarm()
+    send(("ready", os.getpid()))
+    while True:
+        try:
+            try:
+                message = conn.recv()
+            except EOFError:
+                return
+            kind, seq = message[:2]
+            if kind == "exec":
+                _, _, code, session_id, carrier = message
+                streamer = (
+                    PythonExecOutputStreamer(
+                        # bound now, a cell still running on another thread must not tag
+                        # its output with a later request's seq
+                        lambda *output, seq=seq: send(("output", seq, *output))
+                    )
+                    if python_exec_streaming
+                    else None
+                )
+                try:
+                    with (
+                        logfire.propagate.attach_context(carrier),
+                        logfire.set_baggage(python_exec="true"),
+                        python_exec_router.context(),
+                    ):
+                        result = python_exec_impl(
+                            code, streamer.write if streamer is not None else None
+                        )
+                        image_files = helpers.drain_image_attachments()
+                finally:
+                    if streamer is not None:
+                        streamer.close()
+                send(
+                    ("result", seq, result.status, result.stdout, result.stderr, image_files)
+                )
+            elif kind == "eval":
+                try:
+                    send(("value", seq, eval(message[2], sandbox_globals)))
+                except Exception as e:
+                    send(("error", seq, repr(e)))
+            elif kind == "call":
+                _, _, fn_name, args = message
+                try:
+                    send(("value", seq, globals()[fn_name](*args)))
+                except Exception as e:
+                    send(("error", seq, repr(e)))
+        except KeyboardInterrupt:
+            # an interrupt that landed between calls
+            pass
+
+
+console = Console(stderr=True, soft_wrap=True)
+
+# the hedge attempt (see HedgeRace) that the current thread is making a model call for, if any
+hedge_attempt_var: contextvars.ContextVar[Any] = contextvars.ContextVar(
+    "hedge_attempt", default=None
+)
+
+
+def hedge_track(response: Any):
+    """Let a cancelled hedge attempt close the response it's reading (anything with close())."""
+    attempt = hedge_attempt_var.get()
+    if attempt is not None:
+        attempt.track(response)
+
+
+class DspQueue(queue.Queue):
+    """The DSP event queue. Events from a hedge attempt pass its gate, so only the winner is shown."""
+
+    def put(self, item, block=True, timeout=None):
+        output = stream_output_var.get()
+        if output is not None and item.get("type") in HEDGE_FIRST_TOKEN_EVENTS:
+            output.shown = True
+        attempt = hedge_attempt_var.get()
+        if attempt is None:
+            super().put(item, block, timeout)
+        else:
+            attempt.gate(item, lambda event: queue.Queue.put(self, event, block, timeout))
+
+
+dspq = DspQueue()
+
+# NOTE(hzuo-25-12-10-wed): We buffer streaming content so we can render it with
+# Syntax(..., "markdown") at the end of each block. This is the simplest approach
+# that works uniformly across all providers (streaming OpenAI/Anthropic/Gemini send
+# incremental deltas, while the non-streaming fallbacks send complete blocks).
+# During streaming we stay silent; the user sees the opening tag and knows
+# something is happening, then sees the formatted output when the block completes.
+_dsp_buffers = {
+    "reasoning": "",
+    "text": "",
+    "tool-input": "",
+}
+
+# live python_exec output: call id -> chars shown per stream (None once any were skipped),
+# and which call printed last
+_dsp_live_output: dict[str, dict[str, int | None]] = {}
+_dsp_live_output_last: dict[str, Any] = {"id": None, "newline": True}
+
+
+@logfire.instrument(extract_args=["code"], record_return=False)
+def python_exec(code: str) -> PythonExecResponse:
+    # the end-of-turn snapshot may still be reading sandbox_globals
+    kernel_snapshot_wait()
+    call_id = uuid.uuid4().hex[:8]
+    dspq.put(
+        {
+            "type": "data-python-exec-call-start",
+            "id": call_id,
+            "code": code,
+        }
+    )
+    # this join makes sure the call is displayed before anything the code prints to the real
+    # stdout/stderr (the printer thread itself is never captured, see PythonExecRouter)
+    dspq.join()
+
+    # Set baggage so all descendant spans (including auto-instrumented HTTP calls) are tagged.
+    # This allows alerts to filter out errors from sandbox code vs the bot's own code.
+    def on_output(stream_name: str, text: str, skipped: int):
+        dspq.put(
+            {
+                "type": "data-python-exec-stdout-delta",
+                "id": call_id,
+                "stream": stream_name,
+                "delta": text,
+                "skipped": skipped,
+            }
+        )
+
+    if python_exec_kernel is not None:
+        # the kernel coalesces the output itself
+        result, image_attachment_files = python_exec_kernel.exec(
+            code, on_output if python_exec_streaming else None
+        )
+    else:
+        streamer = PythonExecOutputStreamer(on_output) if python_exec_streaming else None
+        try:
+            with (
+                logfire.set_baggage(python_exec="true"),
+                python_exec_router.context(),
+            ):
+                result = python_exec_impl(
+                    code, streamer.write if streamer is not None else None
+                )
+                image_attachment_files = helpers.drain_image_attachments()
+        finally:
+            if streamer is not None:
+                streamer.close()
+
+    image_attachments = read_image_attachments(image_attachment_files)
+
+    result.image_attachments = image_attachments
+
+    dspq.put(
+        {
+            "type": "data-python-exec-call-end",
+            "id": call_id,
+            "status": result.status,
+            "stdout": result.stdout,
+            "stderr": result.stderr,
+            "image_attachments": image_attachments,
+        }
+    )
+    dspq.join()
+
+    span = opentelemetry.trace.get_current_span()
+    span.set_attribute("len_code", len(code))
+    span.set_attribute("len_output", len(result.stdout) + len(result.stderr))
+    span.set_attribute("len_stdout", len(result.stdout))
+    span.set_attribute("len_stderr", len(result.stderr))
+    span.set_attribute("num_image_attachments", len(image_attachments))
+    image_attachment_sizes = {
+        path: blob_path(blob_parse_ref(ref)[1]).stat().st_size
+        for path, ref in image_attachments
+    }
+    span.set_attribute(
+        "sum_len_image_attachments", sum(image_attachment_sizes.values())
+    )
+    span.set_attribute("len_image_attachments", json.dumps(image_attachment_sizes))
+    span.set_attribute("status", result.status)
+    span.set_attribute("stdout", result.stdout[:400000])
+    span.set_attribute("stderr", result.stderr[:400000])
+
+    return result
+
+
+# Opt-in: let the model make several tool calls per step and run the independent ones
+# concurrently. All calls share sandbox_globals, so a call waits for the earlier calls of the
+# step whose global names it could conflict with (one stores a name the other loads or stores),
+# counting the globals loaded by the functions and classes it calls. Only names are checked:
+# two calls mutating the same object in place still race.
+parallel_tool_calls = env_flag("PERSONALBOT_PARALLEL_TOOL_CALLS", False)
+
+GLOBAL_LOAD_OPS = {"LOAD_NAME", "LOAD_GLOBAL", "LOAD_FROM_DICT_OR_GLOBALS"}
+GLOBAL_STORE_OPS = {"STORE_NAME", "STORE_GLOBAL", "DELETE_NAME", "DELETE_GLOBAL"}
+
+
+def code_global_names(code: types.CodeType) -> tuple[set[str], set[str]]:
+    """The global names a compiled cell loads and stores, including in the functions it defines."""
+    loads: set[str] = set()
+    stores: set[str] = set()
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in GLOBAL_LOAD_OPS:
+            loads.add(instruction.argval)
+        elif instruction.opname in GLOBAL_STORE_OPS:
+            stores.add(instruction.argval)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            inner_loads, inner_stores = code_global_names(const)
+            loads |= inner_loads
+            stores |= inner_stores
+    return loads, stores
+
+
+def sandbox_value_loads(value: Any) -> set[str]:
+    """The global names a function or class (its methods) in sandbox_globals loads when called."""
+    if isinstance(value, (staticmethod, classmethod)):
+        value = value.__func__
+    if isinstance(value, types.FunctionType):
+        # only what was defined in a cell, an imported function's globals are its module's
+        if value.__globals__ is not sandbox_globals:
+            return set()
+        return code_global_names(value.__code__)[0]
+    if isinstance(value, type):
+        return set().union(*(sandbox_value_loads(member) for member in vars(value).values()))
+    return set()
+
+
+def sandbox_transitive_loads(loads: set[str]) -> set[str]:
+    """loads, plus what the functions and classes they name load, recursively."""
+    seen = set(loads)
+    todo = list(loads)
+    while todo:
+        value = sandbox_globals.get(todo.pop())
+        for name in sandbox_value_loads(value) - seen:
+            seen.add(name)
+            todo.append(name)
+    return seen
+
+
+def python_exec_names(code: str) -> tuple[set[str], set[str]]:
+    """The global names a call loads (through the functions it calls too) and stores."""
+    try:
+        loads, stores = code_global_names(compile(code, "<input>", "exec"))
+    except (OverflowError, SyntaxError, ValueError):
+        # fails the same way when it runs, without touching any state
+        return set(), set()
+    return sandbox_transitive_loads(loads), stores
+
+
+def python_exec_conflict(a: tuple[set[str], set[str]], b: tuple[set[str], set[str]]) -> bool:
+    """Whether two calls with these python_exec_names can't run concurrently."""
+    return bool(a[1] & (b[0] | b[1]) or a[0] & b[1])
+
+
+def python_exec_batches(codes: list[str], indices: list[int]) -> Iterator[list[int]]:
+    """
+    Split calls into consecutive batches whose calls don't conflict with each other. Lazily:
+    a call's names are resolved against sandbox_globals after the batches before it have run.
+    """
+    batch: list[int] = []
+    names: dict[int, tuple[set[str], set[str]]] = {}
+    for i in indices:
+        names[i] = python_exec_names(codes[i])
+        if batch and any(python_exec_conflict(names[i], names[j]) for j in batch):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def python_exec_many(
+    codes: list[str], speculative_keys: list[str] | None = None
+) -> list[PythonExecResponse]:
+    """
+    Run the python_exec calls of one step (concurrently in parallel mode), results in call order.
+    Calls that were already started speculatively while streaming (keyed by speculative_keys)
+    reuse that run.
+    """
+    results: list[PythonExecResponse | None] = [None] * len(codes)
+    if speculative_keys is not None:
+        for i, (key, code) in enumerate(zip(speculative_keys, codes, strict=True)):
+            results[i] = speculative_tool_exec.take(key, code)
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if len(pending) <= 1 or not parallel_tool_calls or python_exec_kernel is not None:
+        # the kernel runs one call at a time anyway
+        batches: Iterable[list[int]] = [[i] for i in pending]
+    else:
+        batches = python_exec_batches(codes, pending)
+    for batch in batches:
+        if len(batch) == 1:
+            results[batch[0]] = python_exec(code=codes[batch[0]])
+            continue
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(batch), thread_name_prefix="python-exec"
+        ) as executor:
+            # each call gets its own copy of the context so spans nest under the current step
+            futures = {
+                i: executor.submit(contextvars.copy_context().run, python_exec, codes[i])
+                for i in batch
+            }
+            for i, future in futures.items():
+                results[i] = future.result()
+    results = [result for result in results if result is not None]
+    for code, result in zip(codes, results, strict=True):
+        agent_loop_detector.observe(code, result)
+    return results
+
+
+# NOTE(hzuo-26-10-18-sun): Agent loop detection, for every provider. Each python_exec call of a turn
+# updates a few running streaks in O(1), instead of rescanning the history every step.
+# The turn is stopped when the model keeps going without making progress:
+# - no-op calls (empty output, or code that only prints/comments/passes) after enough calls
+# - the same code producing the same output, over and over
+# - the same error, over and over
+# The streaks restart with every user turn, since the user stepping in is what breaks a loop.
+class AgentLoopDetector:
+    MIN_CALLS_FOR_NOOPS = 20
+    MAX_NOOP_STREAK = 5
+    MAX_REPEAT_STREAK = 6
+    MAX_ERROR_STREAK = 6
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.noop_streak = 0
+        self.repeat_streak = 0
+        self.last_call: tuple[str, str] | None = None
+        self.error_streak = 0
+        self.last_error: str | None = None
+        self.tripped: str | None = None
+
+    @staticmethod
+    def is_print_only(code: str) -> bool:
+        """Check if code is just print/comments/pass (no side effects)"""
+        for line in code.strip().split("\n"):
+            line = line.strip()
+            if not line or line.startswith("#") or line == "pass":
+                continue
+            if line.startswith("print(") and line.endswith(")"):
+                continue
+            return False
+        return True
+
+    def observe(self, code: str, result: PythonExecResponse):
+        self.calls += 1
+        stdout = result.stdout.strip()
+        stderr = result.stderr.strip()
+
+        noop = (result.status == "ok" and not stdout and not stderr) or self.is_print_only(code)
+        self.noop_streak = self.noop_streak + 1 if noop else 0
+
+        call = (
+            hashlib.sha256(code.strip().encode()).hexdigest(),
+            hashlib.sha256(f"{result.status}\0{stdout}\0{stderr}".encode()).hexdigest(),
+        )
+        self.repeat_streak = self.repeat_streak + 1 if call == self.last_call else 1
+        self.last_call = call
+
+        if result.status == "ok":
+            self.error_streak = 0
+            self.last_error = None
+        else:
+            # the last line of a traceback is the exception itself
+            error = stderr.splitlines()[-1] if stderr else result.status
+            self.error_streak = self.error_streak + 1 if error == self.last_error else 1
+            self.last_error = error
+
+        if self.tripped:
+            return
+        if self.calls >= self.MIN_CALLS_FOR_NOOPS and self.noop_streak >= self.MAX_NOOP_STREAK:
+            self.tripped = f"{self.noop_streak} no-op python_exec calls in a row"
+        elif self.repeat_streak >= self.MAX_REPEAT_STREAK:
+            self.tripped = f"the same code and output {self.repeat_streak} times in a row"
+        elif self.error_streak >= self.MAX_ERROR_STREAK:
+            self.tripped = f"the same error {self.error_streak} times in a row: {self.last_error[:200]}"
+        if self.tripped:
+            logfire.warn(
+                "agent loop circuit breaker triggered",
+                reason=self.tripped,
+                calls=self.calls,
+                noop_streak=self.noop_streak,
+                repeat_streak=self.repeat_streak,
+                error_streak=self.error_streak,
+            )
+            dspq.put(
+                {
+                    "type": "error",
+                    "errorText": f"stopping the turn, the agent looks stuck: {self.tripped}",
+                }
+            )
+
+
+agent_loop_detector = AgentLoopDetector()
+
+
+# NOTE(hzuo-26-10-18-sun): Speculative tool execution. A tool call's arguments are final well before
+# the response is (the stream still has to finish, and the DSP queue has to drain), so in this
+# mode the streaming transports start python_exec as soon as a call's arguments are complete:
+# response.function_call_arguments.done for OpenAI, content_block_stop of a tool_use block for
+# Anthropic and each complete functionCall part for Gemini. Once the response completes,
+# python_exec_many picks up the running call instead of starting it again.
+# A call only starts once the step can't be retried any more: the stream has shown output (see
+# stream_output_guard), which also means it won any hedge race. Calls run one at a time, in
+# order, like python_exec_many runs them (in parallel mode a call only waits for the earlier
+# calls it conflicts with). The runs of a response that doesn't complete (the stream failed
+# midway) are waited for, or cancelled if they haven't started, before the next model call
+# can start any, but their side effects have already happened and the model never sees their
+# results, hence opt-in.
+speculative_tool_exec_enabled = env_flag("PERSONALBOT_SPECULATIVE_TOOL_EXEC", False)
+
+
+class SpeculativeToolExec:
+    MAX_PARALLEL_RUNS = 4
+
+    def __init__(self):
+        self.executor: concurrent.futures.ThreadPoolExecutor | None = None
+        # key -> (code, future, python_exec_names or None when runs are sequential)
+        self.runs: dict[str, tuple[str, concurrent.futures.Future, Any]] = {}
+        self.lock = threading.Lock()
+
+    def start(self, key: str, code: Any):
+        if not speculative_tool_exec_enabled or not isinstance(code, str):
+            return
+        output = stream_output_var.get()
+        if output is None or not output.shown:
+            # the step could still be retried
+            return
+        attempt = hedge_attempt_var.get()
+        if attempt is not None and not attempt.speculative:
+            # the response gets transcoded, so the session's provider would look for other keys
+            return
+        # the kernel runs one call at a time anyway
+        parallel = parallel_tool_calls and python_exec_kernel is None
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.MAX_PARALLEL_RUNS if parallel else 1,
+                    thread_name_prefix="python-exec-speculative",
+                )
+            if key in self.runs:
+                return
+            names = python_exec_names(code) if parallel else None
+            waits = [
+                future
+                for _, future, other in self.runs.values()
+                if names is not None and python_exec_conflict(names, other)
+            ]
+            future = self.executor.submit(
+                contextvars.copy_context().run, self.run, code, waits
+            )
+            self.runs[key] = (code, future, names)
+
+    @staticmethod
+    def run(code: str, waits: list[concurrent.futures.Future]) -> PythonExecResponse:
+        # the earlier calls this one conflicts with were submitted first, so they can't be
+        # waiting on this worker
+        concurrent.futures.wait(waits)
+        return python_exec(code)
+
+    def take(self, key: str, code: str) -> PythonExecResponse | None:
+        with self.lock:
+            run = self.runs.pop(key, None)
+        if run is None:
+            return None
+        speculative_code, future, _ = run
+        if speculative_code != code:
+            logfire.warn("speculative python_exec ran different code, running again", key=key)
+            future.result()  # don't let the two runs overlap
+            return None
+        return future.result()
+
+    def discard(self):
+        """
+        Drop the runs of a response that didn't complete: cancel the ones that haven't started
+        and wait for the rest, so they can't overlap with the runs of the next response.
+        """
+        attempt = hedge_attempt_var.get()
+        if attempt is not None and attempt.lost():
+            # the runs belong to the attempt that won the hedge race
+            return
+        with self.lock:
+            runs = self.runs
+            self.runs = {}
+        # latest first, so a cancelled run can't let a later one start in its place
+        for key, (_, future, _) in reversed(runs.items()):
+            cancelled = future.cancel()
+            logfire.warn("discarding speculative python_exec run", key=key, cancelled=cancelled)
+        concurrent.futures.wait([future for _, future, _ in runs.values()])
+
+
+speculative_tool_exec = SpeculativeToolExec()
+
+
+# NOTE(hzuo-26-10-18-sun): Image attachments live in a content-addressed blob store next to the
+# sessions, and history only holds a reference like "blob:image/png;sha256,<hex>". Every
+# provider encoder resolves references back into base64 when it builds the request (see
+# blob_resolve), so the bytes are never held in history or rewritten into session files.
+# Blobs are immutable, so resolved items can be memoized by identity like everything else.
+BLOBS_DIR = Path("~/.dataland/blobs").expanduser()
+BLOB_REF_RE = re.compile(r"^blob:([\w.+-]+/[\w.+-]+);sha256,([0-9a-f]{64})$")
+
+
+def blob_path(digest: str) -> Path:
+    return BLOBS_DIR / digest[:2] / digest
+
+
+def blob_put(data: bytes, media_type: str) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{digest}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+    return f"blob:{media_type};sha256,{digest}"
+
+
+def blob_parse_ref(ref: str) -> tuple[str, str]:
+    """Return (media_type, digest) for a blob reference."""
+    match = BLOB_REF_RE.match(ref)
+    assert match, f"Invalid blob reference: {ref[:100]}"
+    return match.group(1), match.group(2)
+
+
+def blob_get(ref: str) -> tuple[str, bytes]:
+    """Return (media_type, bytes) for a blob reference."""
+    media_type, digest = blob_parse_ref(ref)
+    path = blob_path(digest)
+    if not path.exists():
+        raise FileNotFoundError(
+            f"Blob {digest} is missing from {BLOBS_DIR} (pull it with `just s3-pull-agent-blobs`)"
+        )
+    return media_type, path.read_bytes()
+
+
+def blob_resolve(value: Any, key: str | None = None) -> Any:
+    """
+    Return value with every blob reference inside it replaced by the blob's base64 payload
+    ("data" fields: Anthropic image sources and Gemini inlineData) or by a data URL ("image_url"
+    fields: OpenAI input_image). Anything without references is returned as the same object,
+    so only the containers along the path to a reference get copied.
+    """
+    if isinstance(value, str):
+        if key not in ("data", "image_url") or not BLOB_REF_RE.match(value):
+            return value
+        media_type, data = blob_get(value)
+        b64 = base64.b64encode(data).decode("ascii")
+        return f"data:{media_type};base64,{b64}" if key == "image_url" else b64
+    if isinstance(value, dict):
+        out = None
+        for k, v in value.items():
+            resolved = blob_resolve(v, k)
+            if resolved is not v:
+                if out is None:
+                    out = dict(value)
+                out[k] = resolved
+        return value if out is None else out
+    if isinstance(value, list):
+        out = None
+        for i, v in enumerate(value):
+            resolved = blob_resolve(v, key)
+            if resolved is not v:
+                if out is None:
+                    out = list(value)
+                out[i] = resolved
+        return value if out is None else out
+    return value
+
+
+def read_image_attachments(image_attachment_files: list[str]) -> list[Tuple[str, str]]:
+    """Store each attached image in the blob store and return (file, blob reference) pairs."""
+    ret: list[Tuple[str, str]] = []
+    for file in image_attachment_files:
+        content_type, content_encoding = mimetypes.guess_type(file)
+        if not content_type:
+            console.print(f"[yellow]Unexpected image content_type: {file}[/yellow]")
+            continue
+        if content_encoding:
+            console.print(f"[yellow]Unexpected image content_encoding: {file}[/yellow]")
             continue
 
-        base64_data_url = f"data:{content_type};base64,{image_base64}"
-        ret.append((file, base64_data_url))
+        image_bytes = Path(file).read_bytes()
+        ret.append((file, blob_put(image_bytes, content_type)))
     return ret
 
 
@@ -937,12 +3098,42 @@ def dsp_console_print(event: dict):
         )
         console.print("[dim]</python_exec_call>[/dim]", highlight=False)
 
+    elif event_type == "data-python-exec-stdout-delta":
+        call_id = event["id"]
+        if _dsp_live_output_last["id"] != call_id:
+            if not _dsp_live_output_last["newline"]:
+                console.out("")
+            console.print("[dim]<live_output>[/dim]", highlight=False)
+            _dsp_live_output_last["id"] = call_id
+        delta = event["delta"]
+        shown = _dsp_live_output.setdefault(call_id, {"stdout": 0, "stderr": 0})
+        if event["skipped"] or shown[event["stream"]] is None:
+            shown[event["stream"]] = None
+        else:
+            shown[event["stream"]] += len(delta)
+        style = "dim red" if event["stream"] == "stderr" else "dim"
+        console.out(delta, style=style, highlight=False, end="")
+        _dsp_live_output_last["newline"] = delta.endswith("\n")
+
     elif event_type == "data-python-exec-call-end":
         status = event["status"]
         stdout = event["stdout"].strip()
         stderr = event["stderr"].strip()
         image_attachments = event["image_attachments"]
 
+        shown = _dsp_live_output.pop(event.get("id"), None)
+        if shown is not None:
+            if _dsp_live_output_last["id"] == event["id"]:
+                if not _dsp_live_output_last["newline"]:
+                    console.out("")
+                console.print("[dim]</live_output>[/dim]", highlight=False)
+                _dsp_live_output_last.update(id=None, newline=True)
+            # don't repeat what was all just shown live
+            if stdout and shown["stdout"] == len(event["stdout"]):
+                stdout = f"[{shown['stdout']:,} chars, shown above]"
+            if stderr and shown["stderr"] == len(event["stderr"]):
+                stderr = f"[{shown['stderr']:,} chars, shown above]"
+
         console.print("[dim]<python_exec_result>[/dim]", highlight=False)
         console.print(
             f"[dim]<status>[/dim][bold]{status}[/bold][dim]</status>[/dim]",
@@ -973,8 +3164,8 @@ def dsp_console_print(event: dict):
                 return s if len(s) <= n else f"{s[:n]} [...{len(s) - n} more]"
 
             print_json = collections.OrderedDict()
-            for file, base64_data_url in image_attachments:
-                print_json[file] = trunc(base64_data_url)
+            for file, ref in image_attachments:
+                print_json[file] = trunc(ref)
             console.print("[dim]<image_attachments>[/dim]", highlight=False)
             console.print(
                 Syntax(
@@ -1074,6 +3265,22 @@ def dsp_console_print(event: dict):
     elif event_type == "tool-input-delta":
         _dsp_buffers["tool-input"] += event.get("delta", "")
 
+    elif event_type == "data-context-compaction":
+        console.print(
+            f"[dim]<context_compaction boundary={event['boundary_from']}->{event['boundary_to']}"
+            f" tokens={event['tokens_before']:,}->{event['tokens_after_estimate']:,}"
+            f" elided_tool_outputs={event['elided_tool_outputs']}"
+            f" dropped_reasoning={event['dropped_reasoning']} />[/dim]",
+            highlight=False,
+        )
+
+    elif event_type == "data-hedge":
+        console.print(
+            f"[dim]<hedge reason={event['reason']} provider={event['provider']}"
+            f" model={event['model']} after_seconds={event['after_seconds']:g} />[/dim]",
+            highlight=False,
+        )
+
     elif event_type == "error":
         error_text = event.get("errorText", "")
         console.print(f"\n[yellow]error: {error_text}[/yellow]")
@@ -1084,6 +3291,7 @@ def dsp_console_print(event: dict):
 
 
 def dsp_console_print_loop():
+    python_exec_router.never_capture_current_thread()
     while True:
         event = dspq.get()
         if event is None:  # stop indicator
@@ -1093,84 +3301,1007 @@ def dsp_console_print_loop():
         dspq.task_done()
 
 
+def sse_iter_events(response: requests.Response):
+    """
+    Parse a text/event-stream response into (event, data) pairs as the bytes arrive.
+    https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+    """
+    event = None
+    data_lines: list[str] = []
+    # chunk_size=None yields data as soon as it's received instead of waiting for a full chunk
+    for raw_line in response.iter_lines(chunk_size=None):
+        line = raw_line.decode("utf-8")
+        if not line:
+            # a blank line dispatches the event
+            if data_lines:
+                yield event, "\n".join(data_lines)
+                event = None
+                data_lines = []
+            continue
+        if line.startswith(":"):
+            continue  # comment / keep-alive
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            event = value
+        elif field == "data":
+            data_lines.append(value)
+    if data_lines:
+        yield event, "\n".join(data_lines)
+
+
+class IdentityMemo:
+    """
+    Memoize a per-item transform by object identity.
+
+    History items are never mutated once they're appended, so across the steps of a session
+    only the items that are new since the previous step actually get transformed.
+    Only the entries used by the latest map() call are retained.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.entries: dict[int, tuple[Any, Any]] = {}
+
+    def map(self, items: list) -> list:
+        entries: dict[int, tuple[Any, Any]] = {}
+        out = []
+        for item in items:
+            entry = self.entries.get(id(item))
+            # holding a reference to the item guarantees its id can't be reused by another object
+            if entry is None or entry[0] is not item:
+                entry = (item, self.fn(item))
+            entries[id(item)] = entry
+            out.append(entry[1])
+        self.entries = entries
+        return out
+
+
+def json_encode(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode("ascii")
+
+
+class JsonRequestBody:
+    """
+    A JSON request body kept as a list of pre-encoded chunks. requests sends it with a
+    Content-Length and streams the chunks as-is, so the (potentially 100+ MB) body is never
+    concatenated. Small chunks are coalesced to avoid a flood of tiny writes.
+    """
+
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+        self.length = sum(len(chunk) for chunk in chunks)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        pending: list[bytes] = []
+        pending_len = 0
+        for chunk in self.chunks:
+            if len(chunk) >= 65536:
+                if pending:
+                    yield b"".join(pending)
+                    pending, pending_len = [], 0
+                yield chunk
+            else:
+                pending.append(chunk)
+                pending_len += len(chunk)
+                if pending_len >= 65536:
+                    yield b"".join(pending)
+                    pending, pending_len = [], 0
+        if pending:
+            yield b"".join(pending)
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+def json_encode_request(req: dict, list_key: str, encoder: IdentityMemo) -> JsonRequestBody:
+    """
+    Serialize req to a JSON request body, encoding the (potentially huge) list at req[list_key]
+    item by item through the encoder memo so that unchanged items are never re-serialized.
+    """
+    head = json_encode({k: v for k, v in req.items() if k != list_key})
+    sep = b"" if head == b"{}" else b","
+    chunks = [head[:-1] + sep + json_encode(list_key) + b":["]
+    for i, encoded in enumerate(encoder.map(req[list_key])):
+        if i:
+            chunks.append(b",")
+        chunks.append(encoded)
+    chunks.append(b"]}")
+    return JsonRequestBody(chunks)
+
+
+# NOTE(hzuo-26-10-18-sun): Request body compression. Late in a session the request bodies are tens
+# of MB of base64 and repetitive tool JSON, which compresses several-fold, and on a slow uplink
+# the upload dominates the step latency. Bodies of at least GZIP_MIN_BYTES are sent with
+# Content-Encoding: gzip. For Anthropic and Gemini every chunk of the JsonRequestBody is
+# deflated on its own, memoized by identity like the encoders that produced it, and the raw
+# deflate streams are stitched into a single gzip member, so each step only compresses what's
+# new, and the gzip trailer's CRC32 picks up from the longest run of leading chunks that are
+# the same as the previous step's. The OpenAI SDK serializes its own bodies, those are
+# compressed whole by GzipTransport. None of the providers document compressed request bodies,
+# hence opt-in. A 415, or a 400 whose error names the encoding, to a compressed body means the
+# endpoint doesn't take them: that provider stops being compressed and the request is resent
+# uncompressed once. Any other 400 is a genuine error and is returned as is, so a bad request
+# isn't uploaded twice. Every compressed request logs its sizes and compression time to logfire.
+gzip_requests = env_flag("PERSONALBOT_GZIP_REQUESTS", False)
+GZIP_MIN_BYTES = 256 * 1024
+GZIP_LEVEL = 6
+# the whole-body path can't reuse earlier work, so it trades ratio for speed
+GZIP_WHOLE_BODY_LEVEL = 1
+# magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+# an empty final block, ending the deflate stream
+DEFLATE_END = b"\x03\x00"
+
+# providers whose endpoint rejected a compressed body
+_gzip_rejected: set[str] = set()
+GZIP_ERROR_RE = re.compile(r"gzip|content.encoding|decompress", re.IGNORECASE)
+
+
+def gzip_wanted(provider: str, length: int) -> bool:
+    return gzip_requests and provider not in _gzip_rejected and length >= GZIP_MIN_BYTES
+
+
+def gzip_rejected(provider: str, status_code: int, text: str) -> bool:
+    """Whether an error response to a compressed body is about the compression, if so stop compressing."""
+    if not (status_code == 415 or (status_code == 400 and GZIP_ERROR_RE.search(text))):
+        return False
+    _gzip_rejected.add(provider)
+    logfire.warn(
+        "{provider} rejected a gzip request body, sending uncompressed from now on",
+        provider=provider,
+        status_code=status_code,
+        text=text[:2000],
+    )
+    return True
+
+
+def deflate_chunk(chunk: bytes) -> bytes:
+    # a sync flush ends on a byte boundary without ending the stream, so independently
+    # deflated chunks can be concatenated
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class GzipRequestEncoder:
+    def __init__(self):
+        self.deflate = IdentityMemo(deflate_chunk)
+        # the previous body's chunks, each with the CRC32 of the body up to and including it
+        self.crcs: list[tuple[bytes, int]] = []
+
+    def crc32(self, chunks: list[bytes]) -> int:
+        crc = 0
+        n = 0
+        for chunk, (previous, previous_crc) in zip(chunks, self.crcs, strict=False):
+            # the head chunk is re-encoded every step, comparing it is cheap next to hashing
+            if chunk is not previous and chunk != previous:
+                break
+            crc = previous_crc
+            n += 1
+        crcs = self.crcs[:n]
+        for chunk in chunks[n:]:
+            crc = zlib.crc32(chunk, crc)
+            crcs.append((chunk, crc))
+        self.crcs = crcs
+        return crc
+
+    def encode(self, body: JsonRequestBody) -> JsonRequestBody:
+        crc = self.crc32(body.chunks)
+        trailer = struct.pack("<II", crc, body.length & 0xFFFFFFFF)
+        return JsonRequestBody(
+            [GZIP_HEADER, *self.deflate.map(body.chunks), DEFLATE_END, trailer]
+        )
+
+
+def post_json_request(
+    provider: str,
+    url: str,
+    headers: dict,
+    body: JsonRequestBody,
+    encoder: GzipRequestEncoder,
+    **kwargs,
+) -> requests.Response:
+    """POST a JSON request body, gzipped when it's large enough and the provider accepts it."""
+    session = http_session(url)
+    if not gzip_wanted(provider, len(body)):
+        return session.post(url, headers=headers, data=body, **kwargs)
+    t0 = time.perf_counter()
+    compressed = encoder.encode(body)
+    logfire.info(
+        "{provider} gzip request body",
+        provider=provider,
+        bytes=len(body),
+        gzip_bytes=len(compressed),
+        saved_bytes=len(body) - len(compressed),
+        compress_ms=round((time.perf_counter() - t0) * 1000, 1),
+    )
+    response = session.post(
+        url, headers={**headers, "Content-Encoding": "gzip"}, data=compressed, **kwargs
+    )
+    if response.status_code not in (400, 415) or not gzip_rejected(
+        provider, response.status_code, response.text
+    ):
+        return response
+    response.close()
+    return session.post(url, headers=headers, data=body, **kwargs)
+
+
+class GzipTransport(httpx.BaseTransport):
+    """An httpx transport that gzips large request bodies, for clients that serialize their own."""
+
+    def __init__(self, provider: str, transport: httpx.BaseTransport):
+        self.provider = provider
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method != "POST" or request.headers.get("content-encoding"):
+            return self.transport.handle_request(request)
+        content = request.read()
+        if not gzip_wanted(self.provider, len(content)):
+            return self.transport.handle_request(request)
+        t0 = time.perf_counter()
+        compressed = zlib.compress(content, GZIP_WHOLE_BODY_LEVEL, wbits=31)
+        logfire.info(
+            "{provider} gzip request body",
+            provider=self.provider,
+            bytes=len(content),
+            gzip_bytes=len(compressed),
+            saved_bytes=len(content) - len(compressed),
+            compress_ms=round((time.perf_counter() - t0) * 1000, 1),
+        )
+        headers = httpx.Headers(request.headers)
+        headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(compressed))
+        response = self.transport.handle_request(
+            httpx.Request(
+                request.method,
+                request.url,
+                headers=headers,
+                content=compressed,
+                extensions=request.extensions,
+            )
+        )
+        if response.status_code not in (400, 415):
+            return response
+        response.read()
+        if not gzip_rejected(self.provider, response.status_code, response.text):
+            return response
+        response.close()
+        return self.transport.handle_request(request)
+
+    def close(self):
+        self.transport.close()
+
+
+# NOTE(hzuo-26-10-18-sun): Images attached to tool results are only useful to the model for a few
+# steps, but without eviction they're re-sent on every request for the rest of the session.
+# At request-build time the images of all but the most recent tool results are replaced by a
+# text placeholder naming the path (the persisted history is never touched). Eviction happens
+# in batches of image_keep_tool_results, so the request prefix (and the provider's prompt cache)
+# only changes once every that many new images rather than on every one.
+# 0 keeps every image.
+image_keep_tool_results = int(os.environ.get("PERSONALBOT_IMAGE_KEEP_TOOL_RESULTS", "8"))
+
+
+class ImageEviction:
+    def __init__(self, has_images, evict_images):
+        self.has_images = IdentityMemo(has_images)
+        self.evict_images = IdentityMemo(evict_images)
+        self.cut = 0
+
+    def apply(self, history: list) -> list:
+        """Return history with the images of older tool results evicted (shares unevicted items)."""
+        cut = 0
+        keep = image_keep_tool_results
+        if keep > 0:
+            flags = self.has_images.map(history)
+            indices = [i for i, flag in enumerate(flags) if flag]
+            evict = (max(0, len(indices) - keep) // keep) * keep
+            if evict:
+                cut = indices[evict]
+        if cut != self.cut:
+            logfire.info(
+                "image eviction cut moved",
+                cut=cut,
+                previous_cut=self.cut,
+                len_history=len(history),
+            )
+            self.cut = cut
+        if not cut:
+            return list(history)
+        return self.evict_images.map(history[:cut]) + history[cut:]
+
+
+def evicted_image_placeholder(path: str | None) -> str:
+    name = f" ({path})" if path else ""
+    return f"[image{name} evicted from context to keep requests small; attach it again to look at it]\n"
+
+
+def image_path_from_text(text: Any) -> str | None:
+    # tool results label each image with a preceding "image path: <path>" text block
+    if isinstance(text, str) and text.startswith("image path: "):
+        return text[len("image path: ") :].strip()
+    return None
+
+
+# NOTE(hzuo-26-10-18-sun): Context compaction. Once the (estimated) history tokens exceed
+# compact_threshold_tokens, a request-time view of the history elides the middle of old tool
+# outputs (keeping a head/tail preview) and drops reasoning from completed turns, advancing a
+# compaction boundary far enough to get back under COMPACT_TARGET_RATIO of the threshold.
+# Everything before the boundary is compacted, everything after is sent as-is, and the
+# boundary only moves when the threshold is crossed again, so the request prefix (and the
+# provider's prompt cache) stays stable in between. The persisted history is never touched.
+# Every move of the boundary is logged to logfire and to <session_id>.compaction.jsonl.
+# 0 disables compaction.
+compact_threshold_tokens = int(
+    os.environ.get("PERSONALBOT_COMPACT_THRESHOLD_TOKENS", "150000")
+)
+COMPACT_TARGET_RATIO = 0.6
+COMPACT_KEEP_RECENT_ITEMS = 12
+COMPACT_PREVIEW_CHARS = 1000
+
+# NOTE(hzuo-26-10-18-sun): Reasoning pruning. Independently of the compaction threshold, the
+# request-time view drops reasoning (OpenAI reasoning items with their encrypted_content,
+# Anthropic thinking blocks, Gemini thought parts) from every turn before the latest user
+# message. The providers only use reasoning from the current turn (the tool-use loop in
+# progress), which is always sent as-is, so the older copies were just uploaded and
+# re-serialized on every request. The view only changes when the user sends a message,
+# the same moment the previous turn's prompt cache tail is read for the last time anyway.
+# The persisted history keeps the full record.
+prune_reasoning = env_flag("PERSONALBOT_PRUNE_REASONING", True)
+
+_tiktoken_encoding: Any = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with tiktoken's o200k_base. This is only an estimate for Anthropic and Gemini,
+    which is all compaction needs. Falls back to ~4 chars per token if the encoding can't load.
+    """
+    global _tiktoken_encoding
+    if _tiktoken_encoding is None:
+        try:
+            import tiktoken
+
+            _tiktoken_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            logfire.exception("failed to load tiktoken encoding, estimating tokens")
+            _tiktoken_encoding = False
+    if _tiktoken_encoding is False:
+        return len(text) // 4
+    return len(_tiktoken_encoding.encode(text, disallowed_special=()))
+
+
+def history_item_tokens(item: Any) -> int:
+    if item is None:
+        return 0
+    return count_tokens(json.dumps(item))
+
+
+def compaction_elide_text(text: str) -> str:
+    if len(text) <= 3 * COMPACT_PREVIEW_CHARS:
+        return text
+    head = text[:COMPACT_PREVIEW_CHARS]
+    tail = text[-COMPACT_PREVIEW_CHARS:]
+    elided = len(text) - 2 * COMPACT_PREVIEW_CHARS
+    return f"{head}\n[... {elided:,} chars elided by context compaction ...]\n{tail}"
+
+
+def compaction_elide_output(text: str) -> str:
+    """Elide a python_exec text output, field by field when it's the usual JSON object."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return compaction_elide_text(text)
+    if not isinstance(data, dict):
+        return compaction_elide_text(text)
+    elided = {
+        k: compaction_elide_text(v) if isinstance(v, str) else v for k, v in data.items()
+    }
+    if elided == data:
+        return text
+    return json.dumps(elided)
+
+
+def compaction_elide_blocks(blocks: list, text_type: str) -> list:
+    elided = [
+        {**block, "text": compaction_elide_text(block["text"])}
+        if block.get("type") == text_type
+        and len(block.get("text", "")) > 3 * COMPACT_PREVIEW_CHARS
+        else block
+        for block in blocks
+    ]
+    return blocks if all(a is b for a, b in zip(elided, blocks, strict=True)) else elided
+
+
+def compaction_turn_start(history: list) -> int:
+    """Index of the latest message typed by the user (0 if there is none)."""
+    for i in range(len(history) - 1, -1, -1):
+        if compaction_is_user_turn(history[i]):
+            return i
+    return 0
+
+
+def compaction_is_user_turn(item: dict) -> bool:
+    # a message typed by the user, as opposed to tool results sent back with the user role
+    if item.get("role") != "user":
+        return False
+    blocks = item.get("content", item.get("parts"))
+    if not isinstance(blocks, list):
+        return True
+    return not all(
+        block.get("type") == "tool_result" or "functionResponse" in block
+        for block in blocks
+    )
+
+
+class ContextCompaction:
+    def __init__(self, compact_output, compact_reasoning, prune: bool = True):
+        """
+        compact_output(item) elides tool outputs, compact_reasoning(item) drops reasoning
+        (or returns None to drop the whole item). Both return the item itself when there's
+        nothing to compact. prune=False opts out of reasoning pruning.
+        """
+        self.prune = prune
+        self.compact_reasoning = compact_reasoning
+        self.compact_output = IdentityMemo(compact_output)
+        self.compact_all = IdentityMemo(lambda item: compact_reasoning(compact_output(item)))
+        self.prune_reasoning = IdentityMemo(compact_reasoning)
+        self.view_tokens = IdentityMemo(history_item_tokens)
+        self.boundary = 0
+        self.reasoning_boundary = 0
+        self.anchor = None
+
+    def apply(self, history: list) -> list:
+        """Return the compacted view of history (shares uncompacted items)."""
+        if self.boundary and (
+            len(history) < self.boundary or history[self.boundary - 1] is not self.anchor
+        ):
+            # a different or edited history, start over
+            self.boundary = 0
+            self.reasoning_boundary = 0
+            self.anchor = None
+
+        turn_start = compaction_turn_start(history)
+        view = self.view(history, turn_start)
+        if compact_threshold_tokens > 0:
+            tokens = sum(self.view_tokens.map(view))
+            if tokens > compact_threshold_tokens and self.advance(history, turn_start, tokens):
+                view = self.view(history, turn_start)
+        return [item for item in view if item is not None]
+
+    def view(self, history: list, turn_start: int) -> list:
+        """The view aligned with history, None where an item is dropped."""
+        view = (
+            self.compact_all.map(history[: self.reasoning_boundary])
+            + self.compact_output.map(history[self.reasoning_boundary : self.boundary])
+            + history[self.boundary :]
+        )
+        if prune_reasoning and self.prune and turn_start > self.reasoning_boundary:
+            # compact_all already dropped the reasoning before reasoning_boundary
+            view = (
+                view[: self.reasoning_boundary]
+                + self.prune_reasoning.map(view[self.reasoning_boundary : turn_start])
+                + view[turn_start:]
+            )
+        return view
+
+    def advance(self, history: list, turn_start: int, tokens: int) -> bool:
+        """Move the boundary forward until the view is estimated to be under the target."""
+        view_tokens = self.view_tokens.map(self.view(history, turn_start))
+        limit = len(history) - COMPACT_KEEP_RECENT_ITEMS
+        target = int(compact_threshold_tokens * COMPACT_TARGET_RATIO)
+
+        estimate = tokens
+        boundary = self.boundary
+        elided_tool_outputs = 0
+        dropped_reasoning = 0
+        while boundary < limit and estimate > target:
+            item = history[boundary]
+            compacted = self.compact_output.fn(item)
+            if compacted is not item:
+                elided_tool_outputs += 1
+            # reasoning is only dropped from turns the user has already followed up on
+            if boundary < turn_start:
+                without_reasoning = self.compact_reasoning(compacted)
+                if without_reasoning is not compacted:
+                    dropped_reasoning += 1
+                compacted = without_reasoning
+            estimate -= view_tokens[boundary] - history_item_tokens(compacted)
+            boundary += 1
+
+        if boundary == self.boundary:
+            logfire.warn(
+                "context compaction has nothing left to compact",
+                tokens=tokens,
+                threshold=compact_threshold_tokens,
+                len_history=len(history),
+            )
+            return False
+
+        decision = {
+            "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "session_id": session_id,
+            "len_history": len(history),
+            "boundary_from": self.boundary,
+            "boundary_to": boundary,
+            "reasoning_boundary": max(self.reasoning_boundary, min(boundary, turn_start)),
+            "tokens_before": tokens,
+            "tokens_after_estimate": estimate,
+            "threshold": compact_threshold_tokens,
+            "target": target,
+            "elided_tool_outputs": elided_tool_outputs,
+            "dropped_reasoning": dropped_reasoning,
+        }
+        self.boundary = boundary
+        self.reasoning_boundary = decision["reasoning_boundary"]
+        self.anchor = history[boundary - 1]
+
+        logfire.info("context compaction", **decision)
+        dspq.put({"type": "data-context-compaction", **decision})
+        try:
+            audit_file = SESSIONS_DIR / f"{session_id}.compaction.jsonl"
+            audit_file.parent.mkdir(parents=True, exist_ok=True)
+            with audit_file.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(decision) + "\n")
+        except OSError:
+            logfire.exception("failed to write compaction audit log")
+        return True
+
+
 instructions = None
 
 anthropic_model = "claude-sonnet-4-5-20250929"
 
+# Stream the Messages API over SSE so thinking/text/tool_use deltas reach the console as they arrive.
+anthropic_streaming = env_flag("PERSONALBOT_ANTHROPIC_STREAMING", True)
+
+# overridable so the provider calls can be pointed at local mock servers
+ANTHROPIC_API_URL = os.environ.get(
+    "PERSONALBOT_ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages"
+)
+
 
-def anthropic_call(history: list):
+def anthropic_call(history: list, model: str | None = None):
     global instructions
     if instructions is None:
         instructions = assemble_system_prompt()
 
-    headers = {
-        "content-type": "application/json",
-        "x-api-key": os.environ["ANTHROPIC_API_KEY"],
-        "anthropic-version": "2023-06-01",
-        "anthropic-beta": "interleaved-thinking-2025-05-14",
-    }
+    headers = {
+        "content-type": "application/json",
+        "x-api-key": os.environ["ANTHROPIC_API_KEY"],
+        "anthropic-version": "2023-06-01",
+        "anthropic-beta": "interleaved-thinking-2025-05-14",
+    }
+
+    req = {
+        "model": model or anthropic_model,
+        "max_tokens": 64_000,
+        "thinking": {
+            "type": "enabled",
+            "budget_tokens": 31_999,
+        },
+        "tools": [
+            {
+                "name": "python_exec",
+                "description": PYTHON_EXEC_TOOL_DESCRIPTION,
+                "input_schema": {
+                    "type": "object",
+                    "properties": {
+                        "code": {
+                            "type": "string",
+                            "description": "The Python code to execute.",
+                        },
+                    },
+                    "required": ["code"],
+                    "additionalProperties": False,
+                },
+            }
+        ],
+        "tool_choice": {
+            "type": "auto",
+            "disable_parallel_tool_use": not parallel_tool_calls,
+        },
+        "system": [
+            {
+                "type": "text",
+                "text": instructions,
+                # always cache system prompt with 1h
+                "cache_control": {"type": "ephemeral", "ttl": "1h"},
+            }
+        ],
+        "messages": anthropic_request_messages(history),
+    }
+    if not anthropic_tool_loop_thinking(req["messages"]):
+        # a hedge to another provider answered a step of this turn (see hedged_call)
+        del req["thinking"]
+    if anthropic_streaming:
+        req["stream"] = True
+
+    body = json_encode_request(req, "messages", anthropic_message_encoder)
+    # a stream that fails before showing anything (an error event such as overloaded_error,
+    # a stall or a dropped connection) is retried along with the request
+    res = call_stream_with_retry(
+        "anthropic",
+        lambda: post_json_request(
+            "anthropic",
+            ANTHROPIC_API_URL,
+            headers,
+            body,
+            anthropic_request_gzip,
+            stream=anthropic_streaming,
+        ),
+        anthropic_stream_response if anthropic_streaming else lambda res: res.json(),
+    )
+    if isinstance(res, requests.Response):
+        dspq.put(
+            {
+                "type": "error",
+                "errorText": f"anthropic error! {res.text}",
+            }
+        )
+        res.raise_for_status()
+    return res
+
+
+def anthropic_tool_loop_thinking(messages: list) -> bool:
+    """
+    Whether every assistant message of the tool loop in progress starts with a thinking block,
+    which the API requires with thinking enabled. A response transcoded from another provider
+    has none, so the rest of its turn goes without thinking.
+    """
+    for message in reversed(messages):
+        if compaction_is_user_turn(message):
+            break
+        content = message["content"]
+        if message["role"] == "assistant" and not (
+            isinstance(content, list)
+            and content
+            and content[0].get("type") in ("thinking", "redacted_thinking")
+        ):
+            return False
+    return True
+
+
+def anthropic_encode_message(message: dict) -> bytes:
+    return json_encode(blob_resolve(message))
+
+
+anthropic_message_encoder = IdentityMemo(anthropic_encode_message)
+anthropic_request_gzip = GzipRequestEncoder()
+
+
+def anthropic_request_messages(history: list) -> list:
+    """
+    The messages as sent over the wire. This shares every message object with history,
+    except for overlay copies of the messages that carry cache breakpoints and of older
+    messages that were compacted or had their images evicted, so history itself is never
+    copied or mutated.
+    """
+    messages = anthropic_image_eviction.apply(anthropic_context_compaction.apply(history))
+    return anthropic_cache_placer.place(messages)
+
+
+# NOTE(hzuo-26-10-18-sun): Anthropic allows 4 cache breakpoints per request. The system prompt
+# always gets one (1h) and the latest user message always gets one (5m), which is what lets
+# each step read the previous step's cache. The other two go to manual <!-- CACHE_BREAKPOINT -->
+# markers (the latest ones win, older ones are stripped), and otherwise to automatic
+# checkpoints. While a slot is free, a checkpoint goes on the latest message where the
+# estimated cumulative tokens cross a multiple of ANTHROPIC_CACHE_CHECKPOINT_TOKENS, and from
+# then on it is pinned to that message (by identity, so token estimates shifting under
+# compaction or reasoning pruning don't move it) until the message leaves the request or is
+# rewritten. So when something earlier changes (compaction, image eviction, an edited history)
+# or the 5m tail entry has expired, the request still reads the cache up to the last intact
+# checkpoint instead of only the system prompt. The older checkpoint gets the 1h TTL so the bulk of a
+# long session survives the user stepping away; TTLs can't increase along the request, so
+# that only happens when no 5m breakpoint comes before it.
+ANTHROPIC_MAX_CACHE_BREAKPOINTS = 4
+ANTHROPIC_CACHE_CHECKPOINT_TOKENS = 16_000
+
+
+class AnthropicCachePlacer:
+    def __init__(self):
+        self.tokens = IdentityMemo(history_item_tokens)
+        # (id(message), modifications) -> (message, overlay), only the latest request's
+        self.overlays: dict[tuple, tuple[dict, dict]] = {}
+        self.breakpoints: list[tuple[int, str]] = []
+        # the messages (before overlays) holding automatic checkpoints, oldest first
+        self.pinned: list[dict] = []
+
+    def place(self, messages: list) -> list:
+        tail = max(i for i, message in enumerate(messages) if message["role"] == "user")
+        assert isinstance(messages[tail]["content"], list)
+        assert len(messages[tail]["content"]) > 0
+        assert isinstance(messages[tail]["content"][-1], dict)
+
+        manual = [
+            (i, j)
+            for i, message in enumerate(messages)
+            if isinstance(message["content"], list)
+            for j, block in enumerate(message["content"])
+            if isinstance(block, dict) and "cache_control" in block
+        ]
+        manual = [(i, j) for i, j in manual if (i, j) != (tail, len(messages[tail]["content"]) - 1)]
+        budget = ANTHROPIC_MAX_CACHE_BREAKPOINTS - 2  # system prompt + tail
+        kept_manual = manual[len(manual) - budget :] if budget else []
+        stripped = [pos for pos in manual if pos not in kept_manual]
+
+        slots = budget - len(kept_manual)
+        manual_messages = {i for i, _ in kept_manual}
+        positions = {id(message): i for i, message in enumerate(messages[:tail])}
+        checkpoints = [
+            positions[id(message)]
+            for message in self.pinned
+            if id(message) in positions
+            and messages[positions[id(message)]] is message
+            and positions[id(message)] not in manual_messages
+        ]
+        # manual markers take precedence over pinned checkpoints
+        checkpoints = checkpoints[-slots:] if slots else []
+
+        if len(checkpoints) < slots:
+            # new candidates after the last pinned checkpoint: where the cumulative tokens
+            # cross a multiple of the stride
+            candidates = []
+            cumulative = 0
+            for i, tokens in enumerate(self.tokens.map(messages[:tail])):
+                previous = cumulative
+                cumulative += tokens
+                last_block = (
+                    messages[i]["content"][-1]
+                    if isinstance(messages[i]["content"], list)
+                    else None
+                )
+                if (
+                    cumulative // ANTHROPIC_CACHE_CHECKPOINT_TOKENS
+                    > previous // ANTHROPIC_CACHE_CHECKPOINT_TOKENS
+                    and (not checkpoints or i > checkpoints[-1])
+                    and isinstance(last_block, dict)
+                    and last_block.get("type") not in ("thinking", "redacted_thinking")
+                    and i not in manual_messages
+                ):
+                    candidates.append(i)
+            free = slots - len(checkpoints)
+            checkpoints += candidates[-free:]
+        self.pinned = [messages[i] for i in checkpoints]
+
+        # modifications per message: block index -> ttl to set, or None to strip
+        mods: dict[int, dict[int, str | None]] = collections.defaultdict(dict)
+        for i, j in stripped:
+            mods[i][j] = None
+        self.breakpoints = []
+        for n, i in enumerate(checkpoints):
+            ttl = "1h" if n == 0 and not any(pos[0] < i for pos in kept_manual) else "5m"
+            mods[i][len(messages[i]["content"]) - 1] = ttl
+            self.breakpoints.append((i, ttl))
+        mods[tail][len(messages[tail]["content"]) - 1] = "5m"
+        self.breakpoints.append((tail, "5m"))
+
+        overlays = {}
+        messages = list(messages)
+        for i, blocks in mods.items():
+            message = messages[i]
+            key = (id(message), tuple(sorted(blocks.items())))
+            entry = self.overlays.get(key)
+            if entry is None or entry[0] is not message:
+                content = list(message["content"])
+                for j, ttl in blocks.items():
+                    block = {k: v for k, v in content[j].items() if k != "cache_control"}
+                    if ttl is not None:
+                        block["cache_control"] = {"type": "ephemeral", "ttl": ttl}
+                    content[j] = block
+                entry = (message, {**message, "content": content})
+            overlays[key] = entry
+            messages[i] = entry[1]
+        self.overlays = overlays
+        return messages
+
+
+anthropic_cache_placer = AnthropicCachePlacer()
+
+
+# https://docs.claude.com/en/api/errors
+ANTHROPIC_STREAM_ERROR_STATUS = {
+    "invalid_request_error": 400,
+    "request_too_large": 413,
+    "rate_limit_error": 429,
+    "api_error": 500,
+    "overloaded_error": 529,
+}
+
+
+def anthropic_stream_response(res: requests.Response) -> dict:
+    """
+    Consume a streaming Messages API response, emitting DSP events as deltas arrive.
+    Returns the reassembled message in the same shape as the non-streaming response.
+    https://docs.claude.com/en/docs/build-with-claude/streaming
+    """
+    message: dict = {}
+    blocks: dict[int, dict] = {}
+    partial_json: dict[int, str] = {}
+    stopped = False
+    # anything left over belongs to an earlier attempt that never completed
+    speculative_tool_exec.discard()
+
+    with contextlib.closing(res):
+        for _, data in sse_iter_events(res):
+            event = json.loads(data)
+            event_type = event.get("type")
+
+            if event_type == "message_start":
+                message = event["message"]
+                message["content"] = []
+                dspq.put(
+                    {
+                        "type": "data-response-start",
+                        "id": message.get("id"),
+                    }
+                )
+
+            elif event_type == "content_block_start":
+                index = event["index"]
+                block = event["content_block"]
+                blocks[index] = block
+                block_type = block.get("type")
+                if block_type in ("thinking", "redacted_thinking"):
+                    dspq.put(
+                        {
+                            "type": "reasoning-start",
+                            "id": index,
+                        }
+                    )
+                elif block_type == "text":
+                    dspq.put(
+                        {
+                            "type": "text-start",
+                            "id": index,
+                        }
+                    )
+                elif block_type == "tool_use":
+                    partial_json[index] = ""
+                    dspq.put(
+                        {
+                            "type": "tool-input-start",
+                            "toolCallId": block.get("id"),
+                            "toolName": block.get("name"),
+                        }
+                    )
+
+            elif event_type == "content_block_delta":
+                index = event["index"]
+                block = blocks[index]
+                delta = event["delta"]
+                delta_type = delta.get("type")
+                if delta_type == "thinking_delta":
+                    block["thinking"] = block.get("thinking", "") + delta["thinking"]
+                    dspq.put(
+                        {
+                            "type": "reasoning-delta",
+                            "id": index,
+                            "delta": delta["thinking"],
+                        }
+                    )
+                elif delta_type == "signature_delta":
+                    block["signature"] = block.get("signature", "") + delta["signature"]
+                elif delta_type == "text_delta":
+                    block["text"] = block.get("text", "") + delta["text"]
+                    dspq.put(
+                        {
+                            "type": "text-delta",
+                            "id": index,
+                            "delta": delta["text"],
+                        }
+                    )
+                elif delta_type == "input_json_delta":
+                    partial_json[index] += delta["partial_json"]
+                    dspq.put(
+                        {
+                            "type": "tool-input-delta",
+                            "toolCallId": block.get("id"),
+                            "delta": delta["partial_json"],
+                        }
+                    )
+                elif delta_type == "citations_delta":
+                    block.setdefault("citations", []).append(delta["citation"])
+
+            elif event_type == "content_block_stop":
+                index = event["index"]
+                block = blocks[index]
+                block_type = block.get("type")
+                if block_type in ("thinking", "redacted_thinking"):
+                    dspq.put(
+                        {
+                            "type": "reasoning-end",
+                            "id": index,
+                        }
+                    )
+                elif block_type == "text":
+                    dspq.put(
+                        {
+                            "type": "text-end",
+                            "id": index,
+                        }
+                    )
+                elif block_type == "tool_use":
+                    raw_input = partial_json.pop(index)
+                    block["input"] = json.loads(raw_input) if raw_input else {}
+                    dspq.put(
+                        {
+                            "type": "tool-input-end",
+                            "id": block.get("id"),
+                        }
+                    )
+                    speculative_tool_exec.start(block["id"], block["input"].get("code"))
+
+            elif event_type == "message_delta":
+                message.update(event.get("delta") or {})
+                # message_delta usage is cumulative, so it supersedes the message_start usage
+                message["usage"] = {**message.get("usage", {}), **event.get("usage", {})}
+
+            elif event_type == "message_stop":
+                stopped = True
+                break
+
+            elif event_type == "ping":
+                pass
+
+            elif event_type == "error":
+                dspq.put(
+                    {
+                        "type": "error",
+                        "errorText": f"anthropic stream error! {data}",
+                    }
+                )
+                error_type = (event.get("error") or {}).get("type")
+                raise StreamError(
+                    f"anthropic stream error: {data}",
+                    ANTHROPIC_STREAM_ERROR_STATUS.get(error_type),
+                )
+
+    if not stopped:
+        raise RuntimeError("anthropic stream ended before message_stop")
+
+    message["content"] = [blocks[index] for index in sorted(blocks)]
+
+    usage = message.get("usage", {})
+    if usage:
+        usage_copy = anthropic_usage_copy(usage, message.get("model"))
+        logfire.info("llm_usage", usage=usage_copy)
+    else:
+        usage_copy = None
+    dspq.put(
+        {
+            "type": "data-response-end",
+            "id": message.get("id"),
+            "usage": usage_copy,
+        }
+    )
+
+    return message
 
-    messages2 = copy.deepcopy(history)
-    for message in reversed(messages2):
-        if message["role"] == "user":
-            assert isinstance(message["content"], list)
-            assert len(message["content"]) > 0
-            assert isinstance(message["content"][-1], dict)
-            message["content"][-1]["cache_control"] = {"type": "ephemeral", "ttl": "5m"}
-            break  # only add to the latest one
-    req = {
-        "model": anthropic_model,
-        "max_tokens": 64_000,
-        "thinking": {
-            "type": "enabled",
-            "budget_tokens": 31_999,
-        },
-        "tools": [
-            {
-                "name": "python_exec",
-                "description": PYTHON_EXEC_TOOL_DESCRIPTION,
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "code": {
-                            "type": "string",
-                            "description": "The Python code to execute.",
-                        },
-                    },
-                    "required": ["code"],
-                    "additionalProperties": False,
-                },
-            }
-        ],
-        "tool_choice": {
-            "type": "auto",
-            "disable_parallel_tool_use": True,
-        },
-        "system": [
-            {
-                "type": "text",
-                "text": instructions,
-                # always cache system prompt with 1h
-                "cache_control": {"type": "ephemeral", "ttl": "1h"},
-            }
-        ],
-        "messages": messages2,
-    }
 
-    res = requests.post(
-        "https://api.anthropic.com/v1/messages",
-        headers=headers,
-        json=req,
+def anthropic_usage_copy(usage: dict, model: str | None) -> dict:
+    usage_copy = dict(usage)
+    usage_copy["provider"] = "anthropic"
+    usage_copy["model"] = model
+    # share of the prompt that was read from cache rather than (re)processed
+    prompt_tokens = (
+        (usage.get("input_tokens") or 0)
+        + (usage.get("cache_creation_input_tokens") or 0)
+        + (usage.get("cache_read_input_tokens") or 0)
     )
-    if not res.ok:
-        dspq.put(
-            {
-                "type": "error",
-                "errorText": f"anthropic error! {res.text}",
-            }
+    if prompt_tokens:
+        usage_copy["cache_read_ratio"] = round(
+            (usage.get("cache_read_input_tokens") or 0) / prompt_tokens, 3
         )
-    res.raise_for_status()
-    return res.json()
+    usage_copy["cache_breakpoints"] = [
+        [i, ttl] for i, ttl in anthropic_cache_placer.breakpoints
+    ]
+    return usage_copy
 
 
 def anthropic_dsp_write(res: dict):
@@ -1256,9 +4387,7 @@ def anthropic_dsp_write(res: dict):
 
     usage = res.get("usage", {})
     if usage:
-        usage_copy = dict(usage)
-        usage_copy["provider"] = "anthropic"
-        usage_copy["model"] = res.get("model")
+        usage_copy = anthropic_usage_copy(usage, res.get("model"))
         dspq.put(
             {
                 "type": "data-response-end",
@@ -1298,7 +4427,7 @@ def anthropic_construct_tool_result_content(result: PythonExecResponse) -> str |
             "text": "<image_output>\n",
         }
     )
-    for file, base64_data_url in result.image_attachments:
+    for file, ref in result.image_attachments:
         content_blocks.append(
             {
                 "type": "text",
@@ -1306,15 +4435,7 @@ def anthropic_construct_tool_result_content(result: PythonExecResponse) -> str |
             }
         )
 
-        header, b64 = base64_data_url.split(",", 1)
-        assert header.startswith("data:"), "Invalid data URL: missing 'data:' prefix"
-        assert header.endswith(";base64"), (
-            "Invalid data URL header: must end with ';base64'"
-        )
-        media_type = header[len("data:") : -len(";base64")]
-        assert media_type, "Invalid data URL: missing media_type"
-        assert b64, "Invalid data URL: missing base64 payload"
-        # base64.b64decode(b64, validate=True)
+        media_type, _ = blob_parse_ref(ref)
 
         content_blocks.append(
             {
@@ -1322,7 +4443,8 @@ def anthropic_construct_tool_result_content(result: PythonExecResponse) -> str |
                 "source": {
                     "type": "base64",
                     "media_type": media_type,
-                    "data": b64,
+                    # resolved to the base64 payload when the request is built
+                    "data": ref,
                 },
             }
         )
@@ -1336,8 +4458,90 @@ def anthropic_construct_tool_result_content(result: PythonExecResponse) -> str |
     return content_blocks
 
 
+def anthropic_tool_result_images(message: dict) -> bool:
+    if message["role"] != "user" or not isinstance(message["content"], list):
+        return False
+    return any(
+        block.get("type") == "tool_result"
+        and isinstance(block.get("content"), list)
+        and any(b.get("type") == "image" for b in block["content"])
+        for block in message["content"]
+    )
+
+
+def anthropic_evict_images(message: dict) -> dict:
+    if not anthropic_tool_result_images(message):
+        return message
+    content = []
+    for block in message["content"]:
+        if block.get("type") == "tool_result" and isinstance(block.get("content"), list):
+            result_content = []
+            path = None
+            for b in block["content"]:
+                if b.get("type") == "image":
+                    b = {"type": "text", "text": evicted_image_placeholder(path)}
+                path = image_path_from_text(b.get("text"))
+                result_content.append(b)
+            block = {**block, "content": result_content}
+        content.append(block)
+    return {**message, "content": content}
+
+
+anthropic_image_eviction = ImageEviction(
+    anthropic_tool_result_images, anthropic_evict_images
+)
+
+
+def anthropic_compact_tool_outputs(message: dict) -> dict:
+    if message["role"] != "user" or not isinstance(message["content"], list):
+        return message
+    content = []
+    for block in message["content"]:
+        if block.get("type") == "tool_result":
+            result = block.get("content")
+            if isinstance(result, str):
+                elided = compaction_elide_output(result)
+            elif isinstance(result, list):
+                elided = compaction_elide_blocks(result, "text")
+            else:
+                elided = result
+            if elided is not result:
+                block = {**block, "content": elided}
+        content.append(block)
+    if all(a is b for a, b in zip(content, message["content"], strict=True)):
+        return message
+    return {**message, "content": content}
+
+
+def anthropic_compact_reasoning(message: dict) -> dict:
+    if message["role"] != "assistant" or not isinstance(message["content"], list):
+        return message
+    content = [
+        block
+        for block in message["content"]
+        if block.get("type") not in ("thinking", "redacted_thinking")
+    ]
+    if not content or len(content) == len(message["content"]):
+        return message
+    return {**message, "content": content}
+
+
+anthropic_context_compaction = ContextCompaction(
+    anthropic_compact_tool_outputs, anthropic_compact_reasoning
+)
+
+
+def anthropic_step_call(history: list, model: str | None = None) -> dict:
+    res = anthropic_call(history, model)
+    if not anthropic_streaming:
+        # without streaming we just emit all the DSP events at once here
+        anthropic_dsp_write(res)
+    return res
+
+
 @logfire.instrument(extract_args=["turn_number"], record_return=True)
 def anthropic_run_turn(history: list, turn_number: int):
+    agent_loop_detector.reset()
     step_number = 0
     while True:
         step_number += 1
@@ -1357,10 +4561,7 @@ def anthropic_run_turn(history: list, turn_number: int):
                 }
             )
 
-            res = anthropic_call(history)
-
-            # we don't do streaming for anthropic so we just emit all the DSP events at once here
-            anthropic_dsp_write(res)
+            res = hedged_call("anthropic", history, anthropic_step_call)
             dspq.join()
 
             history.append({"role": "assistant", "content": res["content"]})
@@ -1368,22 +4569,29 @@ def anthropic_run_turn(history: list, turn_number: int):
             write_history(history)
 
             if res["stop_reason"] == "tool_use":
+                tool_uses = [
+                    block for block in res["content"] if block.get("type") == "tool_use"
+                ]
+                codes = []
+                for block in tool_uses:
+                    code = (block.get("input") or {}).get("code")
+                    assert isinstance(code, str)
+                    codes.append(code)
                 tool_results = []
-                for block in res["content"]:
-                    if block.get("type") == "tool_use":
-                        code = (block.get("input") or {}).get("code")
-                        assert isinstance(code, str)
-                        python_exec_res = python_exec(code=code)
-                        tool_result_content = anthropic_construct_tool_result_content(
-                            python_exec_res
-                        )
-                        tool_results.append(
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": block.get("id"),
-                                "content": tool_result_content,
-                            }
-                        )
+                python_exec_results = python_exec_many(
+                    codes, [block["id"] for block in tool_uses]
+                )
+                for block, python_exec_res in zip(tool_uses, python_exec_results, strict=True):
+                    tool_result_content = anthropic_construct_tool_result_content(
+                        python_exec_res
+                    )
+                    tool_results.append(
+                        {
+                            "type": "tool_result",
+                            "tool_use_id": block.get("id"),
+                            "content": tool_result_content,
+                        }
+                    )
                 history.append({"role": "user", "content": tool_results})
 
             dspq.put(
@@ -1406,7 +4614,9 @@ def anthropic_run_turn(history: list, turn_number: int):
                 res_text = "\n".join(res_text_blocks)
                 return res_text
             elif res["stop_reason"] == "tool_use":
-                pass
+                if agent_loop_detector.tripped:
+                    dspq.join()
+                    return "[AGENT_LOOP_CIRCUIT_BREAKER]"
             else:
                 raise RuntimeError(f"Bad stop_reason: {res['stop_reason']}")
 
@@ -1415,6 +4625,7 @@ def anthropic_append_user_message(history: list, message: str):
     # Anthropic supports up to 4 cache breakpoints.
     # We automatically use 1 for the system prompt and 1 for the tail of the conversation.
     # This leaves 2 available for use within the user message via <!-- CACHE_BREAKPOINT --> (case-insensitive).
+    # Slots not taken by manual markers go to automatic checkpoints (see AnthropicCachePlacer).
     parts = re.split(
         r"^\s*<!--\s*(?i:cache_breakpoint)\s*-->\s*$", message, flags=re.MULTILINE
     )
@@ -1488,9 +4699,87 @@ openai_reasoning_effort: Literal["low", "medium", "high", "xhigh"] | None = None
 openai_verbosity: Literal["low", "medium", "high"] | None = None
 
 
+# only items that carry blob references (image attachments) are copied
+openai_input_resolver = IdentityMemo(blob_resolve)
+
+# NOTE(hzuo-26-10-18-sun): OpenAI server-side conversation state, opt-in. Responses are stored
+# (store=True) and each step only sends the items that are new since the previous response,
+# chained with previous_response_id, so the upload per step stays constant instead of growing
+# with the session. The chain is only followed while the request view still starts with
+# exactly what the server has: the previous request's input followed by its output items.
+# Anything else (/continue, an edited history, a compaction or image eviction move, a hedge to
+# another model, an expired stored response) replays the full history, which starts a new chain.
+# Reasoning from earlier turns isn't pruned from the view in this mode: the server already
+# holds it, and pruning it would break the chain on every user message.
+# Not available to zero data retention organizations, which can't use store=True.
+openai_server_state = env_flag("PERSONALBOT_OPENAI_SERVER_STATE", False)
+
+
+class OpenAIResponseChain:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.response_id: str | None = None
+        self.model: str | None = None
+        self.input: list = []
+        self.output_ids: list = []
+
+    def follow(self, view: list, model: str) -> tuple[str | None, list]:
+        """Return (previous_response_id, input items) for a request of view."""
+        if not openai_server_state or self.response_id is None:
+            return None, view
+        start = len(self.input)
+        end = start + len(self.output_ids)
+        reason = None
+        if model != self.model:
+            reason = "model changed"
+        elif len(view) < end or any(a is not b for a, b in zip(view, self.input, strict=False)):
+            reason = "history changed"
+        elif [item.get("id") for item in view[start:end]] != self.output_ids:
+            reason = "output items changed"
+        if reason:
+            logfire.info(
+                "openai response chain broken, replaying full history",
+                reason=reason,
+                previous_response_id=self.response_id,
+                len_view=len(view),
+            )
+            self.reset()
+            return None, view
+        return self.response_id, view[end:]
+
+    def record(self, response: Any, model: str, view: list):
+        if not openai_server_state:
+            return
+        self.response_id = response.id
+        self.model = model
+        self.input = view
+        self.output_ids = [getattr(item, "id", None) for item in response.output]
+
+
+openai_response_chain = OpenAIResponseChain()
+
+_openai_client: openai.OpenAI | None = None
+
+
+def openai_client() -> openai.OpenAI:
+    """Return the shared client for model calls (the session's, or a hedge's secondary)."""
+    global _openai_client
+    if _openai_client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        assert api_key, "OPENAI_API_KEY is not set"
+        # call_with_retry owns retries, the SDK's own would multiply the attempts
+        _openai_client = openai.OpenAI(
+            api_key=api_key, http_client=openai_http_client(), max_retries=0
+        )
+    return _openai_client
+
+
 def openai_call(
     client: openai.OpenAI,
     history: list,
+    model: str | None = None,
 ) -> Any:
     global instructions
     global openai_service_tier
@@ -1499,6 +4788,7 @@ def openai_call(
 
     if instructions is None:
         instructions = assemble_system_prompt()
+    model = model or openai_model
 
     if openai_service_tier is None:
         if os.environ.get("OPENAI_SERVICE_TIER") == "priority" or sys.stdin.isatty():
@@ -1509,27 +4799,36 @@ def openai_call(
     effort = (
         openai_reasoning_effort
         if openai_reasoning_effort
-        else ("xhigh" if openai_model == "gpt-5.2" else "high")
+        else ("xhigh" if model == "gpt-5.2" else "high")
     )
     response_text_config = (
         {"verbosity": openai_verbosity} if openai_verbosity else openai.omit
     )
 
+    # anything left over belongs to an earlier attempt that never completed
+    speculative_tool_exec.discard()
+
+    view = openai_input_resolver.map(
+        openai_image_eviction.apply(openai_context_compaction.apply(history))
+    )
+    previous_response_id, input_items = openai_response_chain.follow(view, model)
+
     with client.responses.stream(
-        model=openai_model,
+        model=model,
         reasoning={"effort": effort, "summary": "detailed"},
         instructions=instructions,
         tools=[openai_python_exec_tool],
         tool_choice="auto",
-        input=history,
+        input=input_items,
         include=["reasoning.encrypted_content"],
-        parallel_tool_calls=False,
-        previous_response_id=None,
-        store=False,
+        parallel_tool_calls=parallel_tool_calls,
+        previous_response_id=previous_response_id,
+        store=openai_server_state,
         service_tier=openai_service_tier,
         prompt_cache_retention="24h",
         text=response_text_config,
     ) as stream:
+        hedge_track(stream)
         current_tool_call_id = None
         for event in stream:
             dspq.put(
@@ -1648,7 +4947,11 @@ def openai_call(
                     }
                 )
             elif event.type == "response.function_call_arguments.done":
-                pass
+                try:
+                    code = json.loads(event.arguments).get("code")
+                except ValueError:
+                    code = None
+                speculative_tool_exec.start(event.item_id, code)
             elif event.type == "response.error":
                 dspq.put(
                     {
@@ -1673,7 +4976,9 @@ def openai_call(
                     "event": event,
                 }
             )
-        return stream.get_final_response()
+        final = stream.get_final_response()
+        openai_response_chain.record(final, model, view)
+        return final
 
 
 # NOTE(25-09-26-fri): This relies on new API surface that OpenAI released on Friday 25-09-26:
@@ -1699,7 +5004,7 @@ def openai_construct_function_call_output(result: PythonExecResponse) -> str | l
             "text": "<image_output>\n",
         }
     )
-    for file, base64_data_url in result.image_attachments:
+    for file, ref in result.image_attachments:
         content_blocks.append(
             {
                 "type": "input_text",
@@ -1710,7 +5015,8 @@ def openai_construct_function_call_output(result: PythonExecResponse) -> str | l
             {
                 "type": "input_image",
                 "detail": "high",
-                "image_url": base64_data_url,
+                # resolved to a data URL when the request is built
+                "image_url": ref,
             }
         )
     content_blocks.append(
@@ -1723,12 +5029,94 @@ def openai_construct_function_call_output(result: PythonExecResponse) -> str | l
     return content_blocks
 
 
+def openai_function_call_output_images(item: dict) -> bool:
+    return (
+        item.get("type") == "function_call_output"
+        and isinstance(item.get("output"), list)
+        and any(b.get("type") == "input_image" for b in item["output"])
+    )
+
+
+def openai_evict_images(item: dict) -> dict:
+    if not openai_function_call_output_images(item):
+        return item
+    output = []
+    path = None
+    for b in item["output"]:
+        if b.get("type") == "input_image":
+            b = {"type": "input_text", "text": evicted_image_placeholder(path)}
+        path = image_path_from_text(b.get("text"))
+        output.append(b)
+    return {**item, "output": output}
+
+
+openai_image_eviction = ImageEviction(
+    openai_function_call_output_images, openai_evict_images
+)
+
+
+def openai_compact_tool_outputs(item: dict) -> dict:
+    if item.get("type") != "function_call_output":
+        return item
+    output = item.get("output")
+    if isinstance(output, str):
+        elided = compaction_elide_output(output)
+    elif isinstance(output, list):
+        elided = compaction_elide_blocks(output, "input_text")
+    else:
+        return item
+    return item if elided is output else {**item, "output": elided}
+
+
+def openai_compact_reasoning(item: dict) -> dict | None:
+    # reasoning items are optional in the input
+    return None if item.get("type") == "reasoning" else item
+
+
+openai_context_compaction = ContextCompaction(
+    openai_compact_tool_outputs,
+    openai_compact_reasoning,
+    prune=not openai_server_state,
+)
+
+
+def openai_step_call(
+    client: openai.OpenAI, history: list, model: str | None = None
+) -> Any:
+    # the server occasionally drops the connection mid-stream ("peer closed connection
+    # without sending complete message body"), that is retried like any other connection error
+    # unless the stream has shown output already
+    def send():
+        with stream_output_guard("openai"):
+            return openai_call(client, history=history, model=model)
+
+    try:
+        return call_with_retry("openai", send)
+    except openai.APIStatusError as e:
+        # the previous response can be gone (expired, deleted, another project's key),
+        # any other rejection is a genuine error and replaying would only send it twice
+        if (
+            openai_response_chain.response_id is None
+            or e.code != "previous_response_not_found"
+        ):
+            raise
+        logfire.warn(
+            "openai previous_response_id rejected, replaying full history",
+            previous_response_id=openai_response_chain.response_id,
+            status_code=e.status_code,
+            code=e.code,
+        )
+        openai_response_chain.reset()
+        return call_with_retry("openai", send)
+
+
 @logfire.instrument(extract_args=["turn_number"], record_return=True)
 def openai_run_turn(
     client: openai.OpenAI,
     history: list,
     turn_number: int,
 ) -> Any:
+    agent_loop_detector.reset()
     step_number = 0
     while True:
         step_number += 1
@@ -1748,30 +5136,11 @@ def openai_run_turn(
                 }
             )
 
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    final = openai_call(
-                        client,
-                        history=history,
-                    )
-                    break
-                except httpx.RemoteProtocolError as e:
-                    # OpenAI server occasionally drops connection mid-stream:
-                    # "peer closed connection without sending complete message body (incomplete chunked read)"
-                    if attempt < max_retries - 1:
-                        delay = 5.0 * (2**attempt)  # 5s, 10s, 20s
-                        with logfire.span(
-                            "openai retryable error - sleeping",
-                            exception_type=type(e).__name__,
-                            exception_message=str(e),
-                            delay_seconds=delay,
-                            attempt=attempt + 1,
-                            max_retries=max_retries,
-                        ):
-                            time.sleep(delay)
-                    else:
-                        raise
+            final = hedged_call(
+                "openai",
+                history,
+                lambda history, model: openai_step_call(client, history, model),
+            )
 
             dspq.join()
 
@@ -1794,14 +5163,18 @@ def openai_run_turn(
             ]
 
             if function_calls:
-                tool_outputs = []
                 for fc in function_calls:
                     if fc.name != "python_exec":
                         raise ValueError(
                             f"openai tried to call unknown tool: {fc.name}"
                         )
 
-                    result = python_exec(fc.parsed_arguments.code)
+                results = python_exec_many(
+                    [fc.parsed_arguments.code for fc in function_calls],
+                    [fc.id for fc in function_calls],
+                )
+                tool_outputs = []
+                for fc, result in zip(function_calls, results, strict=True):
                     output = openai_construct_function_call_output(result)
                     wrapper = {
                         "type": "function_call_output",
@@ -1827,6 +5200,10 @@ def openai_run_turn(
 
                 return final.output_text
 
+            if agent_loop_detector.tripped:
+                dspq.join()
+                return "[AGENT_LOOP_CIRCUIT_BREAKER]"
+
 
 def openai_append_user_message(history: list, message: str):
     parts = re.split(
@@ -1866,98 +5243,204 @@ def openai_validate_history(history: list):
     )
 
 
-def _gemini_death_loop_circuit_breaker(history: list) -> bool:
-    """
-    Check if we should circuit break due to death loop.
+def gemini_speculative_key(index: int) -> str:
+    # Gemini function calls have no id, so they're keyed by their order in the response
+    return f"gemini-function-call-{index}"
 
-    Rule: >= 20 python_exec calls AND >= 5 consecutive no-op turns
 
-    A no-op turn is where either:
-    1. stdout and stderr are both empty
-    2. code is just print()/comments/pass
-    """
+def gemini_extract_function_calls(candidate: dict) -> list[dict]:
+    calls: list[dict] = []
+    content = candidate.get("content") or {}
+    for part in content.get("parts", []):
+        fc = part.get("functionCall")
+        if fc:
+            calls.append(fc)
+    return calls
 
-    def _is_print_only(code: str) -> bool:
-        """Check if code is just print/comments/pass (no side effects)"""
-        code = code.strip()
-        if not code:
-            return True
-        for line in code.split("\n"):
-            line = line.strip()
-            if not line or line.startswith("#") or line == "pass":
-                continue
-            if line.startswith("print(") and line.endswith(")"):
-                continue
-            return False
-        return True
 
-    def _is_noop_turn(code: str, response: dict) -> bool:
-        """Check if a function call/response pair is a no-op"""
-        # Empty response is a no-op
-        stdout = response.get("stdout", "").strip()
-        stderr = response.get("stderr", "").strip()
-        if response.get("status") == "ok" and stdout == "" and stderr == "":
-            return True
-        # Print-only code is a no-op
-        return _is_print_only(code)
+gemini_model = "gemini-3-pro-preview"
 
-    # Count python_exec calls and track consecutive no-ops
-    call_count = 0
-    consecutive_noops = 0
-    max_consecutive_noops = 0
+# gemini_web_search is the default lookup helper regardless of the model, so its host is always worth warming.
+# Overridable so gemini_call can be pointed at a local mock server.
+GEMINI_API_URL = os.environ.get(
+    "PERSONALBOT_GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta/models"
+)
 
-    pending_code = None
+# Use :streamGenerateContent?alt=sse so reasoning/text reach the console incrementally.
+gemini_streaming = env_flag("PERSONALBOT_GEMINI_STREAMING", True)
 
-    for item in history:
-        if item.get("role") == "model":
-            parts = item.get("parts", [])
-            for p in parts:
-                if "functionCall" in p:
-                    pending_code = p["functionCall"].get("args", {}).get("code", "")
-
-        elif item.get("role") == "user":
-            parts = item.get("parts", [])
-            if parts and "functionResponse" in parts[0]:
-                call_count += 1
-                resp = parts[0]["functionResponse"].get("response", {})
-
-                if pending_code is not None:
-                    if _is_noop_turn(pending_code, resp):
-                        consecutive_noops += 1
-                        max_consecutive_noops = max(
-                            max_consecutive_noops, consecutive_noops
-                        )
-                    else:
-                        consecutive_noops = 0
-                    pending_code = None
 
-    should_break = call_count >= 20 and max_consecutive_noops >= 5
+def gemini_encode_content(content: dict) -> bytes:
+    return json_encode(blob_resolve(content))
 
-    if should_break:
-        logfire.warn(
-            "gemini death loop circuit breaker triggered",
-            call_count=call_count,
-            max_consecutive_noops=max_consecutive_noops,
-            history=history,
-        )
 
-    return should_break
+gemini_content_encoder = IdentityMemo(gemini_encode_content)
+gemini_request_gzip = GzipRequestEncoder()
 
 
-def gemini_extract_function_calls(candidate: dict) -> list[dict]:
-    calls: list[dict] = []
-    content = candidate.get("content") or {}
-    for part in content.get("parts", []):
-        fc = part.get("functionCall")
-        if fc:
-            calls.append(fc)
-    return calls
+# NOTE(hzuo-26-10-18-sun): Explicit context caching. Without it every step re-processes the
+# systemInstruction (the full prompt, including the helpers source) and the whole history.
+# In this mode the stable prefix (system instruction, tools and all contents but the latest)
+# is stored as a cachedContents resource, and generateContent references it by name and only
+# sends the contents after it. The cache is recreated whenever the uncached tail grows past
+# max(GEMINI_CACHE_REFRESH_MIN_TOKENS, GEMINI_CACHE_REFRESH_RATIO * cached tokens), so the
+# tokens written to caches stay linear in the session length. Anything that changes the cached
+# prefix (compaction, image eviction, an edited or different history) also recreates it.
+# The replaced cache is deleted right away and the last one at exit.
+# https://ai.google.dev/gemini-api/docs/caching
+gemini_explicit_cache = env_flag("PERSONALBOT_GEMINI_EXPLICIT_CACHE", False)
+GEMINI_CACHE_TTL_SECONDS = 3600
+GEMINI_CACHE_REFRESH_MIN_TOKENS = 32_000
+GEMINI_CACHE_REFRESH_RATIO = 0.25
+GEMINI_CACHED_CONTENTS_URL = "https://generativelanguage.googleapis.com/v1beta/cachedContents"
 
 
-gemini_model = "gemini-3-pro-preview"
+class GeminiContextCache:
+    def __init__(self):
+        self.name: str | None = None
+        self.items: list = []  # the contents covered by the cache
+        self.key: str | None = None  # model + systemInstruction + tools the cache was created with
+        self.estimated_tokens = 0
+        self.expires_at = 0.0
+        self.next_attempt_tokens = 0  # after a failed create, wait for the prefix to grow
+        self.api_key: str | None = None
+        self.system_key: str | None = None
+        self.system_tokens = 0
+        self.encoder = IdentityMemo(gemini_encode_content)
+        self.tokens = IdentityMemo(history_item_tokens)
+
+    def prepare(self, request_json: dict, api_key: str) -> dict:
+        """Return the request to send, referencing the cache when there is a usable one."""
+        self.api_key = api_key
+        contents = request_json["contents"]
+        key = hashlib.sha256(
+            json_encode(
+                [
+                    gemini_model,
+                    request_json["systemInstruction"],
+                    request_json["tools"],
+                    request_json["toolConfig"],
+                ]
+            )
+        ).hexdigest()
+
+        if self.name is not None and not (
+            self.key == key
+            and time.time() < self.expires_at - 120
+            and len(contents) > len(self.items)
+            and all(a is b for a, b in zip(self.items, contents, strict=False))
+        ):
+            self.invalidate()
+
+        if key != self.system_key:
+            self.system_key = key
+            self.system_tokens = history_item_tokens(request_json["systemInstruction"])
+        prefix = contents[:-1]
+        estimated_tokens = self.system_tokens + sum(self.tokens.map(prefix))
+        if self.name is None:
+            if estimated_tokens >= self.next_attempt_tokens:
+                self.create(request_json, prefix, key, estimated_tokens)
+        elif estimated_tokens - self.estimated_tokens >= max(
+            GEMINI_CACHE_REFRESH_MIN_TOKENS,
+            GEMINI_CACHE_REFRESH_RATIO * self.estimated_tokens,
+        ):
+            self.create(request_json, prefix, key, estimated_tokens)
+
+        if self.name is None:
+            return request_json
+        return {
+            "cachedContent": self.name,
+            "generationConfig": request_json["generationConfig"],
+            "contents": contents[len(self.items) :],
+        }
+
+    def create(self, request_json: dict, items: list, key: str, estimated_tokens: int):
+        body = {
+            "model": f"models/{gemini_model}",
+            "systemInstruction": request_json["systemInstruction"],
+            "tools": request_json["tools"],
+            "toolConfig": request_json["toolConfig"],
+            "ttl": f"{GEMINI_CACHE_TTL_SECONDS}s",
+        }
+        if items:
+            body["contents"] = items
+            data = json_encode_request(body, "contents", self.encoder)
+        else:
+            data = json_encode(body)
+
+        with logfire.span(
+            "gemini create cachedContents",
+            num_items=len(items),
+            estimated_tokens=estimated_tokens,
+            replaces=self.name,
+        ) as span:
+            try:
+                res = http_session(GEMINI_CACHED_CONTENTS_URL).post(
+                    GEMINI_CACHED_CONTENTS_URL,
+                    headers={
+                        "Content-Type": "application/json",
+                        "x-goog-api-key": self.api_key,
+                    },
+                    data=data,
+                    timeout=180,
+                )
+            except requests.exceptions.RequestException:
+                logfire.exception("gemini cachedContents create failed")
+                res = None
+            if res is None or not res.ok:
+                if res is not None:
+                    # e.g. the prefix is still below the model's minimum cacheable size
+                    logfire.warn(
+                        "gemini cachedContents create failed",
+                        status_code=res.status_code,
+                        text=res.text[:2000],
+                    )
+                self.next_attempt_tokens = estimated_tokens + GEMINI_CACHE_REFRESH_MIN_TOKENS
+                return
+
+            created = res.json()
+            previous = self.name
+            self.name = created["name"]
+            self.items = list(items)
+            self.key = key
+            self.estimated_tokens = estimated_tokens
+            self.expires_at = time.time() + GEMINI_CACHE_TTL_SECONDS
+            self.next_attempt_tokens = 0
+            span.set_attribute("name", self.name)
+            span.set_attribute(
+                "cached_tokens", created.get("usageMetadata", {}).get("totalTokenCount")
+            )
+        if previous:
+            self.delete(previous)
+
+    def invalidate(self):
+        if self.name is not None:
+            self.delete(self.name)
+        self.name = None
+        self.items = []
+        self.estimated_tokens = 0
+
+    def delete(self, name: str):
+        url = f"https://generativelanguage.googleapis.com/v1beta/{name}"
+        try:
+            http_session(url).delete(
+                url, headers={"x-goog-api-key": self.api_key}, timeout=30
+            )
+        except requests.exceptions.RequestException:
+            # it expires on its own anyway
+            logfire.exception("gemini cachedContents delete failed", name=name)
+
+    def close(self):
+        if self.name is not None:
+            self.delete(self.name)
+            self.name = None
+
+
+gemini_context_cache = GeminiContextCache()
+atexit.register(gemini_context_cache.close)
 
 
-def gemini_call(history: list) -> dict:
+def gemini_call(history: list, model: str | None = None) -> dict:
     global instructions
     if instructions is None:
         instructions = assemble_system_prompt()
@@ -2004,86 +5487,244 @@ def gemini_call(history: list) -> dict:
                 }
             ]
         },
-        "contents": history,
+        "contents": gemini_image_eviction.apply(
+            gemini_context_compaction.apply(history)
+        ),
     }
+    model = model or gemini_model
+    call_json = (
+        gemini_context_cache.prepare(request_json, api_key)
+        # the cache is created for the session's model, a different model can't use it
+        if gemini_explicit_cache and model == gemini_model
+        else request_json
+    )
 
-    max_retries = 10
-    for attempt in range(max_retries):
-        is_final_attempt = attempt == max_retries - 1
+    if gemini_streaming:
+        url = f"{GEMINI_API_URL}/{model}:streamGenerateContent?alt=sse"
+    else:
+        url = f"{GEMINI_API_URL}/{model}:generateContent"
 
-        # Set baggage for non-final attempts so auto-instrumented HTTP errors are filterable
-        with logfire.set_baggage(
-            **({"is_retryable_attempt": "true"} if not is_final_attempt else {})
+    def send() -> requests.Response:
+        nonlocal call_json
+        response = post_json_request(
+            "gemini",
+            url,
+            {
+                "Content-Type": "application/json",
+                "x-goog-api-key": api_key,
+            },
+            json_encode_request(call_json, "contents", gemini_content_encoder),
+            gemini_request_gzip,
+            # when streaming this bounds the gap between chunks rather than the whole response
+            timeout=180,
+            stream=gemini_streaming,
+        )
+        if (
+            call_json is not request_json
+            and response.status_code in {400, 403, 404}
+            and "cachedcontent" in response.text.lower()
         ):
-            try:
-                response = requests.post(
-                    f"https://generativelanguage.googleapis.com/v1beta/models/{gemini_model}:generateContent",
-                    headers={
-                        "Content-Type": "application/json",
-                        "x-goog-api-key": api_key,
-                    },
-                    timeout=180,
-                    json=request_json,
+            # the cache expired or went away underneath us, resend the whole request
+            logfire.warn(
+                "gemini cachedContents rejected, retrying without it",
+                status_code=response.status_code,
+                text=response.text[:2000],
+            )
+            gemini_context_cache.invalidate()
+            call_json = request_json
+            return send()
+        return response
+
+    # a stream that fails before showing anything is retried along with the request
+    res = call_stream_with_retry(
+        "gemini",
+        send,
+        gemini_stream_response if gemini_streaming else lambda response: response.json(),
+    )
+    if isinstance(res, requests.Response):
+        dspq.put(
+            {
+                "type": "error",
+                "errorText": f"gemini error! {res.text}",
+            }
+        )
+        res.raise_for_status()
+    return res
+
+
+def gemini_usage_copy(usage: dict, model: str) -> dict:
+    usage_copy = dict(usage)
+    usage_copy["provider"] = "gemini"
+    usage_copy["model"] = model
+    if usage.get("promptTokenCount"):
+        # share of the prompt served from the (implicit or explicit) context cache
+        usage_copy["cache_read_ratio"] = round(
+            (usage.get("cachedContentTokenCount") or 0) / usage["promptTokenCount"], 3
+        )
+    return usage_copy
+
+
+def gemini_stream_response(response: requests.Response) -> dict:
+    """
+    Consume a :streamGenerateContent SSE response, emitting DSP events as chunks arrive.
+    Returns the reassembled response in the same shape as :generateContent, so that
+    gemini_run_turn sees a single candidate with all text, thought and functionCall parts.
+    """
+    res: dict = {}
+    candidate: dict = {}
+    role = "model"
+    parts: list[dict] = []
+    num_function_calls = 0
+    # anything left over belongs to an earlier attempt that never completed
+    speculative_tool_exec.discard()
+
+    started = False
+    open_kind = None  # "reasoning" | "text" | None
+    open_id = None
+
+    def close_open_block():
+        nonlocal open_kind, open_id
+        if open_kind == "reasoning":
+            dspq.put({"type": "reasoning-end", "id": open_id})
+        elif open_kind == "text":
+            dspq.put({"type": "text-end", "id": open_id})
+        open_kind = None
+        open_id = None
+
+    with contextlib.closing(response):
+        for _, data in sse_iter_events(response):
+            chunk = json.loads(data)
+
+            if "error" in chunk:
+                close_open_block()
+                dspq.put(
+                    {
+                        "type": "error",
+                        "errorText": f"gemini stream error! {data}",
+                    }
                 )
-            except (
-                requests.exceptions.ReadTimeout,
-                requests.exceptions.ConnectionError,
-            ) as e:
-                if not is_final_attempt:
-                    # Same backoff logic as HTTP status codes
-                    base_delay = min(30.0 + 5.0 * (2**attempt), 600.0)
-                    jitter = random.uniform(0, 120)
-                    total_delay = base_delay + jitter
-                    with logfire.span(
-                        "gemini retryable error - sleeping",
-                        site=1,
-                        exception_type=type(e).__name__,
-                        exception_message=str(e),
-                        total_delay_seconds=total_delay,
-                        base_delay_seconds=base_delay,
-                        jitter_seconds=jitter,
-                        attempt=attempt + 1,
-                        max_retries=max_retries,
-                    ):
-                        time.sleep(total_delay)
-                    continue
-                else:
-                    raise
+                raise StreamError(f"gemini stream error: {data}", chunk["error"].get("code"))
 
-            # Retry on transient HTTP errors
-            if (
-                response.status_code in {408, 413, 429, 500, 502, 503, 504, 529}
-                and not is_final_attempt
-            ):
-                # 30s base + exponential backoff, capped at 600s
-                # 35s, 40s, 50s, 70s, 110s, 190s, 350s, 600s (capped at 8th attempt)
-                base_delay = min(30.0 + 5.0 * (2**attempt), 600.0)
-                jitter = random.uniform(0, 120)
-                total_delay = base_delay + jitter
-                with logfire.span(
-                    "gemini retryable error - sleeping",
-                    site=2,
-                    status_code=response.status_code,
-                    total_delay_seconds=total_delay,
-                    base_delay_seconds=base_delay,
-                    jitter_seconds=jitter,
-                    attempt=attempt + 1,
-                    max_retries=max_retries,
-                ):
-                    time.sleep(total_delay)
+            if not started:
+                started = True
+                dspq.put(
+                    {
+                        "type": "data-response-start",
+                        "id": chunk.get("responseId"),
+                    }
+                )
+            for key in ("responseId", "modelVersion", "usageMetadata", "promptFeedback"):
+                if key in chunk:
+                    res[key] = chunk[key]
+
+            candidates = chunk.get("candidates") or []
+            if not candidates:
                 continue
+            for key, value in candidates[0].items():
+                if key != "content":
+                    candidate[key] = value
+            content = candidates[0].get("content") or {}
+            role = content.get("role", role)
+
+            for part in content.get("parts") or []:
+                if part.get("functionCall"):
+                    close_open_block()
+                    parts.append(part)
+                    call = part["functionCall"]
+                    call_id = (
+                        call.get("id")
+                        or part.get("thoughtSignature")
+                        or str(uuid.uuid4())
+                    )
+                    dspq.put(
+                        {
+                            "type": "tool-input-start",
+                            "toolCallId": call_id,
+                            "toolName": call.get("name"),
+                        }
+                    )
+                    args = call.get("args") or {}
+                    if args:
+                        dspq.put(
+                            {
+                                "type": "tool-input-delta",
+                                "toolCallId": call_id,
+                                "delta": json.dumps(args, indent=2),
+                            }
+                        )
+                    dspq.put(
+                        {
+                            "type": "tool-input-end",
+                            "id": call_id,
+                        }
+                    )
+                    speculative_tool_exec.start(
+                        gemini_speculative_key(num_function_calls), args.get("code")
+                    )
+                    num_function_calls += 1
+                    continue
+
+                text = part.get("text")
+                if not isinstance(text, str) or not text:
+                    # e.g. a trailing empty text part that only carries a thoughtSignature
+                    parts.append(part)
+                    continue
 
-            if not response.ok:
+                kind = "reasoning" if part.get("thought") else "text"
+                prev = parts[-1] if parts else None
+                if (
+                    kind == open_kind
+                    and prev is not None
+                    and isinstance(prev.get("text"), str)
+                    and "thoughtSignature" not in prev
+                ):
+                    # same block continues: merge the chunk into the previous part
+                    prev["text"] += text
+                    if "thoughtSignature" in part:
+                        prev["thoughtSignature"] = part["thoughtSignature"]
+                else:
+                    close_open_block()
+                    parts.append(dict(part))
+                    open_kind = kind
+                    open_id = part.get("thoughtSignature") or str(uuid.uuid4())
+                    dspq.put(
+                        {
+                            "type": f"{kind}-start",
+                            "id": open_id,
+                        }
+                    )
                 dspq.put(
                     {
-                        "type": "error",
-                        "errorText": f"gemini error! {response.text}",
+                        "type": f"{kind}-delta",
+                        "id": open_id,
+                        "delta": text,
                     }
                 )
-            break
 
-    response.raise_for_status()
-    return response.json()
+    close_open_block()
+
+    if candidate or parts:
+        candidate["content"] = {"role": role, "parts": parts}
+        res["candidates"] = [candidate]
+    else:
+        res["candidates"] = []
+
+    usage = res.get("usageMetadata")
+    if usage:
+        usage_copy = gemini_usage_copy(usage, res.get("modelVersion") or gemini_model)
+        logfire.info("llm_usage", usage=usage_copy)
+    else:
+        usage_copy = None
+
+    dspq.put(
+        {
+            "type": "data-response-end",
+            "id": res.get("responseId"),
+            "usage": usage_copy,
+        }
+    )
+
+    return res
 
 
 def gemini_dsp_write(res: dict):
@@ -2176,9 +5817,9 @@ def gemini_dsp_write(res: dict):
 
     usage = res.get("usageMetadata")
     if usage:
-        usage_copy = dict(usage)
-        usage_copy["provider"] = "gemini"
-        usage_copy["model"] = res.get("modelVersion") or "maybe-gemini-3-pro-preview"
+        usage_copy = gemini_usage_copy(
+            usage, res.get("modelVersion") or "maybe-gemini-3-pro-preview"
+        )
     else:
         usage_copy = None
 
@@ -2205,16 +5846,14 @@ def gemini_construct_function_response(result: PythonExecResponse) -> dict:
     if result.image_attachments:
         inline_parts = []
         image_refs = []
-        for file_path, data_url in result.image_attachments:
-            header, b64 = data_url.split(",", 1)
-            assert header.startswith("data:"), "Invalid data URL"
-            assert header.endswith(";base64"), "Invalid data URL header"
-            media_type = header[len("data:") : -len(";base64")]
+        for file_path, ref in result.image_attachments:
+            media_type, _ = blob_parse_ref(ref)
             inline_parts.append(
                 {
                     "inlineData": {
                         "mimeType": media_type,
-                        "data": b64,
+                        # resolved to the base64 payload when the request is built
+                        "data": ref,
                         "displayName": file_path,
                     },
                 }
@@ -2248,8 +5887,86 @@ def gemini_construct_function_response(result: PythonExecResponse) -> dict:
     return function_response
 
 
+def gemini_function_response_images(content: dict) -> bool:
+    return any(
+        "functionResponse" in part and part["functionResponse"].get("parts")
+        for part in content.get("parts", [])
+    )
+
+
+def gemini_evict_images(content: dict) -> dict:
+    if not gemini_function_response_images(content):
+        return content
+    parts = []
+    for part in content["parts"]:
+        if "functionResponse" in part and part["functionResponse"].get("parts"):
+            function_response = dict(part["functionResponse"])
+            paths = [
+                p["inlineData"].get("displayName")
+                for p in function_response.pop("parts")
+                if "inlineData" in p
+            ]
+            response = dict(function_response["response"])
+            response["image_refs"] = [
+                {"image_path": path, "evicted": evicted_image_placeholder(path).strip()}
+                for path in paths
+            ]
+            function_response["response"] = response
+            part = {**part, "functionResponse": function_response}
+        parts.append(part)
+    return {**content, "parts": parts}
+
+
+gemini_image_eviction = ImageEviction(
+    gemini_function_response_images, gemini_evict_images
+)
+
+
+def gemini_compact_tool_outputs(content: dict) -> dict:
+    parts = []
+    for part in content.get("parts", []):
+        if "functionResponse" in part:
+            response = part["functionResponse"].get("response")
+            if isinstance(response, dict):
+                elided = {
+                    k: compaction_elide_text(v) if isinstance(v, str) else v
+                    for k, v in response.items()
+                }
+                if elided != response:
+                    part = {
+                        **part,
+                        "functionResponse": {**part["functionResponse"], "response": elided},
+                    }
+        parts.append(part)
+    if all(a is b for a, b in zip(parts, content.get("parts", []), strict=True)):
+        return content
+    return {**content, "parts": parts}
+
+
+def gemini_compact_reasoning(content: dict) -> dict:
+    if content.get("role") != "model":
+        return content
+    parts = [part for part in content.get("parts", []) if not part.get("thought")]
+    if not parts or len(parts) == len(content.get("parts", [])):
+        return content
+    return {**content, "parts": parts}
+
+
+gemini_context_compaction = ContextCompaction(
+    gemini_compact_tool_outputs, gemini_compact_reasoning
+)
+
+
+def gemini_step_call(history: list, model: str | None = None) -> dict:
+    res = gemini_call(history, model)
+    if not gemini_streaming:
+        gemini_dsp_write(res)
+    return res
+
+
 @logfire.instrument(extract_args=["turn_number"], record_return=True)
 def gemini_run_turn(history: list, turn_number: int) -> str:
+    agent_loop_detector.reset()
     step_number = 0
     while True:
         step_number += 1
@@ -2269,9 +5986,7 @@ def gemini_run_turn(history: list, turn_number: int) -> str:
                 }
             )
 
-            res = gemini_call(history)
-
-            gemini_dsp_write(res)
+            res = hedged_call("gemini", history, gemini_step_call)
             dspq.join()
 
             candidates = res.get("candidates") or []
@@ -2318,16 +6033,19 @@ def gemini_run_turn(history: list, turn_number: int) -> str:
                 ]
                 return "\n".join(text_blocks).strip()
 
-            response_parts = []
-            for call in function_calls:
+            codes = []
+            speculative_keys = []
+            for i, call in enumerate(function_calls):
                 args = call.get("args") or {}
                 code = args.get("code")
                 if not isinstance(code, str):
                     continue
-                python_exec_result = python_exec(code=code)
-                response_parts.append(
-                    gemini_construct_function_response(python_exec_result)
-                )
+                codes.append(code)
+                speculative_keys.append(gemini_speculative_key(i))
+            response_parts = [
+                gemini_construct_function_response(python_exec_result)
+                for python_exec_result in python_exec_many(codes, speculative_keys)
+            ]
 
             if not response_parts:
                 dspq.put(
@@ -2358,8 +6076,9 @@ def gemini_run_turn(history: list, turn_number: int) -> str:
                 }
             )
 
-            if _gemini_death_loop_circuit_breaker(history):
-                return "[GEMINI_DEATH_LOOP_CIRCUIT_BREAKER]"
+            if agent_loop_detector.tripped:
+                dspq.join()
+                return "[AGENT_LOOP_CIRCUIT_BREAKER]"
 
 
 def gemini_append_user_message(history: list, message: str):
@@ -2395,6 +6114,713 @@ def gemini_validate_history(history: list):
         raise ValueError("history is unlikely to be gemini history")
 
 
+# NOTE(hzuo-26-10-18-sun): Canonical view of history. History is stored, on disk and in memory,
+# in the session provider's own format, the only one that keeps reasoning signatures and cache
+# markers. Canonical events are derived from it, incrementally, where code has to look across
+# formats: a hedged step sent to another provider is transcoded there and back (see
+# hedged_call), and calc_turn_number counts user events instead of special-casing each format.
+# Only what every provider understands makes the trip: user text, assistant text, python_exec
+# calls and their results (with image attachments). Reasoning is signed or encrypted by the
+# provider that produced it, so it's dropped.
+#
+#   {"type": "user", "text": ...}
+#   {"type": "text", "text": ...}  (assistant text)
+#   {"type": "tool_call", "id": ..., "code": ...}
+#   {"type": "tool_result", "id": ..., "result": {"status", "stdout", "stderr"}, "image_attachments": [[path, ref], ...]}
+CANONICAL_ASSISTANT_EVENTS = ("text", "tool_call")
+
+# off while decoding events that are only counted (see CanonicalDecoder)
+canonical_images_var: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "canonical_images", default=True
+)
+
+
+def canonical_image_ref(data: str, media_type: str | None) -> str:
+    """Blob reference for an image in history (already a reference, a data URL or base64)."""
+    if BLOB_REF_RE.match(data):
+        return data
+    if not canonical_images_var.get():
+        # don't decode the image and write it to the blob store just to count events
+        return ""
+    if data.startswith("data:"):
+        header, _, data = data.partition(",")
+        media_type = header.removeprefix("data:").split(";")[0]
+    return blob_put(base64.b64decode(data), media_type or "image/png")
+
+
+def canonical_result(result: Any) -> dict:
+    return {key: str(result.get(key, "")) for key in ("status", "stdout", "stderr")}
+
+
+def canonical_text_output(text: str) -> dict:
+    try:
+        result = json.loads(text)
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        return {"status": "ok", "stdout": text, "stderr": ""}
+    return canonical_result(result)
+
+
+def canonical_tool_result(call_id: str, content: Any, text_type: str, image_ref) -> dict:
+    """Parse tool result content built by the *_construct_* functions back into an event."""
+    event = {
+        "type": "tool_result",
+        "id": call_id,
+        "result": {"status": "ok", "stdout": "", "stderr": ""},
+        "image_attachments": [],
+    }
+    if isinstance(content, str):
+        event["result"] = canonical_text_output(content)
+        return event
+    path = None
+    for block in content or []:
+        if block.get("type") == text_type:
+            text = block.get("text", "")
+            if text.startswith("<text_output>\n"):
+                event["result"] = canonical_text_output(
+                    text.removeprefix("<text_output>\n").removesuffix("\n</text_output>\n")
+                )
+            elif text.startswith("image path: "):
+                path = text.removeprefix("image path: ").strip()
+        else:
+            ref = image_ref(block)
+            if ref:
+                event["image_attachments"].append([path or "image", ref])
+                path = None
+    return event
+
+
+def canonical_python_exec_response(event: dict) -> PythonExecResponse:
+    return PythonExecResponse(
+        **event["result"],
+        image_attachments=[tuple(image) for image in event["image_attachments"]],
+    )
+
+
+def canonical_groups(events: list[dict]) -> list[list[dict]]:
+    """Split events into alternating runs of user-side and assistant-side events."""
+    groups: list[list[dict]] = []
+    for event in events:
+        assistant = event["type"] in CANONICAL_ASSISTANT_EVENTS
+        if groups and (groups[-1][0]["type"] in CANONICAL_ASSISTANT_EVENTS) == assistant:
+            groups[-1].append(event)
+        else:
+            groups.append([event])
+    return groups
+
+
+def anthropic_image_ref(block: dict) -> str | None:
+    if block.get("type") != "image":
+        return None
+    source = block.get("source") or {}
+    return canonical_image_ref(source.get("data", ""), source.get("media_type"))
+
+
+def anthropic_canonical_events(message: dict, index: int) -> list[dict]:
+    content = message.get("content")
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    events = []
+    texts = []
+    for block in content or []:
+        block_type = block.get("type")
+        if block_type == "text" and block.get("text"):
+            if message["role"] == "user":
+                texts.append(block["text"])
+            else:
+                events.append({"type": "text", "text": block["text"]})
+        elif block_type == "tool_use":
+            code = (block.get("input") or {}).get("code", "")
+            events.append({"type": "tool_call", "id": block["id"], "code": code})
+        elif block_type == "tool_result":
+            events.append(
+                canonical_tool_result(
+                    block["tool_use_id"], block.get("content"), "text", anthropic_image_ref
+                )
+            )
+    if texts:
+        events.append({"type": "user", "text": "".join(texts).strip()})
+    return events
+
+
+def anthropic_canonical_group(events: list[dict]) -> list[dict]:
+    if events[0]["type"] in CANONICAL_ASSISTANT_EVENTS:
+        content = [
+            (
+                {"type": "text", "text": event["text"]}
+                if event["type"] == "text"
+                else {
+                    "type": "tool_use",
+                    "id": event["id"],
+                    "name": "python_exec",
+                    "input": {"code": event["code"]},
+                }
+            )
+            for event in events
+        ]
+        return [{"role": "assistant", "content": content}]
+    # tool results have to come first in the user message
+    content = [
+        {
+            "type": "tool_result",
+            "tool_use_id": event["id"],
+            "content": anthropic_construct_tool_result_content(
+                canonical_python_exec_response(event)
+            ),
+        }
+        for event in events
+        if event["type"] == "tool_result"
+    ]
+    content += [
+        {"type": "text", "text": event["text"]}
+        for event in events
+        if event["type"] == "user"
+    ]
+    return [{"role": "user", "content": content}]
+
+
+def anthropic_canonical_response(events: list[dict]) -> dict:
+    content = anthropic_canonical_group(events)[0]["content"] if events else []
+    tool_use = any(event["type"] == "tool_call" for event in events)
+    return {
+        "type": "message",
+        "role": "assistant",
+        "content": content,
+        "stop_reason": "tool_use" if tool_use else "end_turn",
+    }
+
+
+def openai_image_ref(block: dict) -> str | None:
+    if block.get("type") != "input_image":
+        return None
+    return canonical_image_ref(block.get("image_url", ""), None)
+
+
+def openai_canonical_events(item: dict, index: int) -> list[dict]:
+    item_type = item.get("type")
+    if item_type == "function_call":
+        try:
+            code = json.loads(item.get("arguments") or "{}").get("code", "")
+        except ValueError:
+            code = ""
+        return [{"type": "tool_call", "id": item["call_id"], "code": code}]
+    if item_type == "function_call_output":
+        return [
+            canonical_tool_result(
+                item["call_id"], item.get("output"), "input_text", openai_image_ref
+            )
+        ]
+    if item.get("role") not in ("user", "assistant") or item_type not in (None, "message"):
+        # reasoning and anything else provider-specific
+        return []
+    content = item.get("content")
+    if isinstance(content, str):
+        text = content
+    else:
+        text = "".join(
+            part.get("text", "")
+            for part in content or []
+            if part.get("type") in ("input_text", "output_text")
+        )
+    if not text:
+        return []
+    return [{"type": "user" if item["role"] == "user" else "text", "text": text}]
+
+
+def openai_canonical_group(events: list[dict]) -> list[dict]:
+    items = []
+    for event in events:
+        if event["type"] == "user":
+            items.append(
+                {"role": "user", "content": [{"type": "input_text", "text": event["text"]}]}
+            )
+        elif event["type"] == "text":
+            items.append({"role": "assistant", "content": event["text"]})
+        elif event["type"] == "tool_call":
+            items.append(
+                {
+                    "type": "function_call",
+                    "call_id": event["id"],
+                    "name": "python_exec",
+                    "arguments": json.dumps({"code": event["code"]}),
+                }
+            )
+        else:
+            items.append(
+                {
+                    "type": "function_call_output",
+                    "call_id": event["id"],
+                    "output": openai_construct_function_call_output(
+                        canonical_python_exec_response(event)
+                    ),
+                }
+            )
+    return items
+
+
+def openai_canonical_response(events: list[dict]) -> Any:
+    """Build the final response object openai_run_turn expects from openai_call."""
+    types = openai.types.responses
+    output: list[Any] = []
+    for event in events:
+        if event["type"] == "text":
+            output.append(
+                types.ParsedResponseOutputMessage.model_construct(
+                    id=f"msg_{uuid.uuid4().hex}",
+                    type="message",
+                    role="assistant",
+                    status="completed",
+                    content=[
+                        types.ParsedResponseOutputText.model_construct(
+                            type="output_text", text=event["text"], annotations=[]
+                        )
+                    ],
+                )
+            )
+        elif event["type"] == "tool_call":
+            output.append(
+                types.ParsedResponseFunctionToolCall.model_construct(
+                    type="function_call",
+                    call_id=event["id"],
+                    name="python_exec",
+                    arguments=json.dumps({"code": event["code"]}),
+                    parsed_arguments=OpenAIPythonExecArgs(code=event["code"]),
+                )
+            )
+    return types.ParsedResponse.model_construct(output=output)
+
+
+def gemini_image_ref(part: dict) -> str | None:
+    inline_data = part.get("inlineData")
+    if not inline_data:
+        return None
+    return canonical_image_ref(inline_data.get("data", ""), inline_data.get("mimeType"))
+
+
+def gemini_canonical_events(content: dict, index: int) -> list[dict]:
+    # Gemini function calls have no ids; the responses in the next content answer them in order
+    events = []
+    texts = []
+    num_calls = 0
+    for part in content.get("parts", []):
+        if "functionCall" in part:
+            call = part["functionCall"]
+            code = (call.get("args") or {}).get("code", "")
+            call_id = call.get("id") or f"gemini_{index}_{num_calls}"
+            events.append({"type": "tool_call", "id": call_id, "code": code})
+            num_calls += 1
+        elif "functionResponse" in part:
+            response = part["functionResponse"]
+            call_id = response.get("id") or f"gemini_{index - 1}_{num_calls}"
+            num_calls += 1
+            image_attachments = [
+                [inline_part["inlineData"].get("displayName") or "image", ref]
+                for inline_part in response.get("parts") or []
+                if (ref := gemini_image_ref(inline_part))
+            ]
+            events.append(
+                {
+                    "type": "tool_result",
+                    "id": call_id,
+                    "result": canonical_result(response.get("response") or {}),
+                    "image_attachments": image_attachments,
+                }
+            )
+        elif part.get("text") and not part.get("thought"):
+            if content.get("role") == "user":
+                texts.append(part["text"])
+            else:
+                events.append({"type": "text", "text": part["text"]})
+    if texts:
+        events.append({"type": "user", "text": "\n\n".join(texts)})
+    return events
+
+
+def gemini_canonical_group(events: list[dict]) -> list[dict]:
+    if events[0]["type"] in CANONICAL_ASSISTANT_EVENTS:
+        parts = [
+            (
+                {"text": event["text"]}
+                if event["type"] == "text"
+                else {
+                    "functionCall": {"name": "python_exec", "args": {"code": event["code"]}},
+                    # Gemini 3 validates the thought signatures of function calls, calls it
+                    # didn't make are exempted with this documented placeholder
+                    "thoughtSignature": "skip_thought_signature_validator",
+                }
+            )
+            for event in events
+        ]
+        return [{"role": "model", "parts": parts}]
+    parts = [
+        gemini_construct_function_response(canonical_python_exec_response(event))
+        for event in events
+        if event["type"] == "tool_result"
+    ]
+    parts += [{"text": event["text"]} for event in events if event["type"] == "user"]
+    return [{"role": "user", "parts": parts}]
+
+
+def gemini_canonical_response(events: list[dict]) -> dict:
+    content = (
+        gemini_canonical_group(events)[0] if events else {"role": "model", "parts": []}
+    )
+    return {"candidates": [{"content": content, "finishReason": "STOP"}]}
+
+
+CANONICAL_DECODERS = {
+    "anthropic": anthropic_canonical_events,
+    "openai": openai_canonical_events,
+    "gemini": gemini_canonical_events,
+}
+CANONICAL_GROUP_ENCODERS = {
+    "anthropic": anthropic_canonical_group,
+    "openai": openai_canonical_group,
+    "gemini": gemini_canonical_group,
+}
+CANONICAL_HISTORY_VALIDATORS = {
+    "anthropic": anthropic_validate_history,
+    "openai": openai_validate_history,
+    "gemini": gemini_validate_history,
+}
+CANONICAL_RESPONSE_ENCODERS = {
+    "anthropic": anthropic_canonical_response,
+    "openai": openai_canonical_response,
+    "gemini": gemini_canonical_response,
+}
+
+
+def canonical_response_events(provider: str, res: Any, index: int) -> list[dict]:
+    """Decode a step's response (as returned by the provider's *_step_call) into events."""
+    if provider == "anthropic":
+        return anthropic_canonical_events(
+            {"role": "assistant", "content": res.get("content") or []}, index
+        )
+    if provider == "openai":
+        return [
+            event
+            for item in res.output
+            for event in openai_canonical_events(item.model_dump(exclude_none=True), index)
+        ]
+    candidates = res.get("candidates") or [{}]
+    content = candidates[0].get("content") or {}
+    return gemini_canonical_events({"role": "model", "parts": content.get("parts", [])}, index)
+
+
+class CanonicalDecoder:
+    """
+    Decode a provider's history into canonical events. Like IdentityMemo, only the items that
+    are new since the previous call get decoded, and their events are the same objects.
+    """
+
+    def __init__(self, provider: str, images: bool = True):
+        """images=False leaves the image references of inline images empty."""
+        self.decode = CANONICAL_DECODERS[provider]
+        self.images = images
+        self.entries: dict[int, tuple[Any, list[dict]]] = {}
+
+    def events(self, history: list) -> list[dict]:
+        entries: dict[int, tuple[Any, list[dict]]] = {}
+        events: list[dict] = []
+        token = canonical_images_var.set(self.images)
+        try:
+            for index, item in enumerate(history):
+                entry = self.entries.get(id(item))
+                # holding a reference to the item guarantees its id can't be reused by another
+                # object
+                if entry is None or entry[0] is not item:
+                    entry = (item, self.decode(item, index))
+                entries[id(item)] = entry
+                events.extend(entry[1])
+        finally:
+            canonical_images_var.reset(token)
+        self.entries = entries
+        return events
+
+
+class HistoryTranscoder:
+    """
+    Transcode history from one provider's format to another's. Only items that are new since
+    the previous call get decoded, and runs of events that didn't change map to the same
+    encoded items, so the target provider's own memos keep hitting.
+    """
+
+    def __init__(self, source: str, target: str):
+        self.decoder = CanonicalDecoder(source)
+        self.encode = CANONICAL_GROUP_ENCODERS[target]
+        self.encoded: dict[tuple[int, ...], tuple[list[dict], list]] = {}
+
+    def transcode(self, history: list) -> list:
+        events = self.decoder.events(history)
+        encoded: dict[tuple[int, ...], tuple[list[dict], list]] = {}
+        out: list = []
+        for group in canonical_groups(events):
+            key = tuple(id(event) for event in group)
+            # holding the group keeps its events alive, so the ids in the key can't be reused
+            entry = self.encoded.get(key) or (group, self.encode(group))
+            encoded[key] = entry
+            out.extend(entry[1])
+        self.encoded = encoded
+        return out
+
+
+# NOTE(hzuo-26-10-18-sun): Hedged requests. With PERSONALBOT_HEDGE_MODEL set ("<provider>:<model>",
+# e.g. "gemini:gemini-3-flash-preview" or "anthropic:claude-haiku-4-5-20251001"), a step whose
+# call hasn't produced its first token within PERSONALBOT_HEDGE_AFTER_SECONDS, or that failed
+# before producing one with an error the secondary might not have (a 5xx, 429 or 529, or a
+# network error, not a rejected request), is also sent to the secondary (transcoded if it's
+# another provider). The first attempt to start a reasoning/text/tool block wins. Its DSP
+# events are shown, and the loser's are dropped; the loser is cancelled at its next event or
+# retry. A Ctrl-C cancels both attempts and closes their responses. A response from the
+# secondary is transcoded back, so the session history stays in the session's format; it has
+# no reasoning of the session's provider, so e.g. Anthropic thinking is off for the rest of
+# that turn (see anthropic_tool_loop_thinking).
+hedge_model = os.environ.get("PERSONALBOT_HEDGE_MODEL", "").strip() or None
+hedge_after_seconds = float(os.environ.get("PERSONALBOT_HEDGE_AFTER_SECONDS", "30"))
+
+HEDGE_FIRST_TOKEN_EVENTS = ("reasoning-start", "text-start", "tool-input-start")
+
+
+class HedgeCancelled(Exception):
+    pass
+
+
+class HedgeAttempt:
+    def __init__(self, race: "HedgeRace", provider: str, model: str | None, speculative: bool):
+        self.race = race
+        self.provider = provider
+        self.model = model
+        # whether speculative python_exec runs can be keyed like the session provider's
+        self.speculative = speculative
+        self.pending: list[dict] = []
+        self.done = False
+        self.result: Any = None
+        self.error: BaseException | None = None
+        self.cancelled = False
+        self.response: Any = None
+
+    def lost(self) -> bool:
+        return self.race.winner is not None and self.race.winner is not self
+
+    def check(self):
+        if self.cancelled:
+            raise HedgeCancelled(f"{self.provider} hedge attempt cancelled")
+        if self.lost():
+            raise HedgeCancelled(f"{self.provider} lost the hedge race")
+
+    def track(self, response: Any):
+        self.response = response
+        if self.cancelled:
+            # cancelled while the request was being sent
+            self.close(response)
+
+    def cancel(self):
+        self.cancelled = True
+        response = self.response
+        if response is not None:
+            self.close(response)
+
+    @staticmethod
+    def close(response: Any):
+        # closing alone doesn't wake up the attempt's thread if it's blocked reading the socket,
+        # shutting the socket down does (requests' urllib3 response, urllib3 >= 2.3)
+        shutdown = getattr(getattr(response, "raw", None), "shutdown", None)
+        if shutdown is not None:
+            try:
+                shutdown()
+            except (OSError, RuntimeError, ValueError):
+                pass
+        response.close()
+
+    def gate(self, event: dict, put):
+        """Hold DSP events until the attempt's first token, then show them if it won."""
+        if self.cancelled:
+            # the events of a cancelled attempt are dropped, errors included
+            self.check()
+        if self.race.winner is not self:
+            if event.get("type") == "error":
+                put(event)
+                return
+            if event.get("type") not in HEDGE_FIRST_TOKEN_EVENTS:
+                self.check()
+                self.pending.append(event)
+                return
+            if not self.race.claim(self):
+                raise HedgeCancelled(f"{self.provider} lost the hedge race")
+        self.flush(put)
+        put(event)
+
+    def flush(self, put):
+        pending, self.pending = self.pending, []
+        for event in pending:
+            put(event)
+
+
+class HedgeRace:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.winner: HedgeAttempt | None = None
+        self.attempts: list[HedgeAttempt] = []
+
+    def claim(self, attempt: HedgeAttempt) -> bool:
+        with self.cond:
+            if self.winner is None:
+                self.winner = attempt
+                self.cond.notify_all()
+            return self.winner is attempt
+
+    def start(
+        self, provider: str, model: str | None, call: Callable[[], Any], speculative: bool
+    ) -> HedgeAttempt:
+        attempt = HedgeAttempt(self, provider, model, speculative)
+        self.attempts.append(attempt)
+
+        def run():
+            hedge_attempt_var.set(attempt)
+            result = error = None
+            try:
+                result = call()
+            except BaseException as e:
+                error = e
+            else:
+                # a response without any content blocks counts once it's complete
+                if not attempt.cancelled and self.claim(attempt):
+                    attempt.flush(lambda event: queue.Queue.put(dspq, event))
+            with self.cond:
+                attempt.result = result
+                attempt.error = error
+                attempt.done = True
+                self.cond.notify_all()
+
+        # each attempt gets its own copy of the context so spans nest under the current step
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(run,),
+            name=f"hedge-{provider}",
+            daemon=True,
+        ).start()
+        return attempt
+
+    def cancel(self):
+        """Stop every attempt: close its response and drop its events from then on."""
+        for attempt in self.attempts:
+            attempt.cancel()
+
+    def wait(self, timeout: float | None = None):
+        """Wait until an attempt wins or all of them are done."""
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.winner is not None or all(a.done for a in self.attempts),
+                timeout,
+            )
+
+
+_hedge_transcoders: dict[tuple[str, str], HistoryTranscoder] = {}
+
+
+def hedge_failover(error: BaseException | None) -> bool:
+    """Whether a primary that failed with this error should fail over to the secondary."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        # requests.HTTPError from raise_for_status
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return retry_error_class(None, error) is not None or isinstance(error, CircuitOpenError)
+
+
+def hedge_step_call(provider: str, history: list, model: str) -> Any:
+    if provider == "anthropic":
+        return anthropic_step_call(history, model)
+    if provider == "openai":
+        return openai_step_call(openai_client(), history, model)
+    if provider == "gemini":
+        return gemini_step_call(history, model)
+    raise ValueError(f"unknown hedge provider: {provider}")
+
+
+def hedged_call(provider: str, history: list, step_call: Callable[[list, str | None], Any]) -> Any:
+    """
+    Make a step's model call, step_call(history, model) for the session's provider and model,
+    hedged with the PERSONALBOT_HEDGE_MODEL secondary. Returns the response in the format of
+    the session's provider.
+    """
+    if not hedge_model:
+        return step_call(history, None)
+    hedge_provider, _, hedge_model_name = hedge_model.partition(":")
+    assert hedge_model_name, f"PERSONALBOT_HEDGE_MODEL should be <provider>:<model>, got {hedge_model}"
+
+    race = HedgeRace()
+    try:
+        primary = race.start(provider, None, lambda: step_call(history, None), speculative=True)
+        race.wait(hedge_after_seconds)
+
+        if race.winner is None and primary.done and not hedge_failover(primary.error):
+            # e.g. a rejected request, which the secondary would most likely reject too
+            assert primary.error is not None
+            raise primary.error
+        if race.winner is None:
+            reason = "error" if primary.done else "slow"
+            if hedge_provider == provider:
+                secondary_history = history
+            else:
+                transcoder = _hedge_transcoders.get((provider, hedge_provider))
+                if transcoder is None:
+                    transcoder = HistoryTranscoder(provider, hedge_provider)
+                    _hedge_transcoders[(provider, hedge_provider)] = transcoder
+                secondary_history = transcoder.transcode(history)
+            logfire.warn(
+                "hedging model call",
+                reason=reason,
+                provider=provider,
+                hedge_provider=hedge_provider,
+                hedge_model=hedge_model_name,
+                primary_error=repr(primary.error) if primary.error else None,
+            )
+            dspq.put(
+                {
+                    "type": "data-hedge",
+                    "reason": reason,
+                    "provider": hedge_provider,
+                    "model": hedge_model_name,
+                    "after_seconds": hedge_after_seconds,
+                }
+            )
+            race.start(
+                hedge_provider,
+                hedge_model_name,
+                lambda: hedge_step_call(hedge_provider, secondary_history, hedge_model_name),
+                speculative=hedge_provider == provider,
+            )
+            race.wait()
+
+        winner = race.winner
+        if winner is None:
+            # every attempt failed before producing anything
+            assert primary.error is not None
+            raise primary.error
+        with race.cond:
+            race.cond.wait_for(lambda: winner.done)
+        if winner is not primary:
+            logfire.info(
+                "hedge won",
+                provider=winner.provider,
+                model=winner.model,
+                primary_done=primary.done,
+            )
+        if winner.error is not None:
+            raise winner.error
+        if winner is primary or winner.provider == provider:
+            return winner.result
+        events = canonical_response_events(winner.provider, winner.result, len(secondary_history))
+        return CANONICAL_RESPONSE_ENCODERS[provider](events)
+    except KeyboardInterrupt:
+        # the attempts would keep streaming (and showing their output) in the background
+        race.cancel()
+        raise
+
+
 def get_model_interface():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -2465,16 +6891,16 @@ def get_model_interface():
         else:
             raise AssertionError
 
-        api_key = os.environ.get("OPENAI_API_KEY")
-        assert api_key, "OPENAI_API_KEY is not set"
-        client = openai.OpenAI(api_key=api_key)
+        client = openai_client()
 
         def run_turn(history: list, turn_number: int) -> Any:
             return openai_run_turn(client, history, turn_number)
 
         return {
             "model_type": model_type,
+            "provider": "openai",
             "session_namespace": "personalbot01",
+            "http_warmup_urls": ["https://api.openai.com/v1/responses", GEMINI_API_URL],
             "validate_history": openai_validate_history,
             "append_user_message": openai_append_user_message,
             "run_turn": run_turn,
@@ -2482,7 +6908,9 @@ def get_model_interface():
     elif args.model == "anthropic" or args.model == "sonnet":
         return {
             "model_type": "anthropic-sonnet",
+            "provider": "anthropic",
             "session_namespace": "personalbot02",
+            "http_warmup_urls": [ANTHROPIC_API_URL, GEMINI_API_URL],
             "validate_history": anthropic_validate_history,
             "append_user_message": anthropic_append_user_message,
             "run_turn": anthropic_run_turn,
@@ -2491,7 +6919,9 @@ def get_model_interface():
         anthropic_model = "claude-haiku-4-5-20251001"
         return {
             "model_type": "anthropic-haiku",
+            "provider": "anthropic",
             "session_namespace": "personalbot02",
+            "http_warmup_urls": [ANTHROPIC_API_URL, GEMINI_API_URL],
             "validate_history": anthropic_validate_history,
             "append_user_message": anthropic_append_user_message,
             "run_turn": anthropic_run_turn,
@@ -2500,7 +6930,9 @@ def get_model_interface():
         anthropic_model = "claude-opus-4-5-20251101"
         return {
             "model_type": "anthropic-opus",
+            "provider": "anthropic",
             "session_namespace": "personalbot02",
+            "http_warmup_urls": [ANTHROPIC_API_URL, GEMINI_API_URL],
             "validate_history": anthropic_validate_history,
             "append_user_message": anthropic_append_user_message,
             "run_turn": anthropic_run_turn,
@@ -2524,7 +6956,9 @@ def get_model_interface():
 
         return {
             "model_type": model_type,
+            "provider": "gemini",
             "session_namespace": "personalbot03",
+            "http_warmup_urls": [GEMINI_API_URL],
             "validate_history": gemini_validate_history,
             "append_user_message": gemini_append_user_message,
             "run_turn": gemini_run_turn,
@@ -2536,6 +6970,21 @@ def get_model_interface():
 model_interface = get_model_interface()
 
 SESSION_NAMESPACE = model_interface["session_namespace"]
+SESSION_PROVIDER = model_interface["provider"]
+
+# the session's history decoded into canonical events, kept up to date incrementally, only to
+# be counted (calc_turn_number), so without images
+session_canonical_decoder = CanonicalDecoder(SESSION_PROVIDER, images=False)
+
+
+def detect_history_provider(history: list) -> str:
+    for provider, validate_history in CANONICAL_HISTORY_VALIDATORS.items():
+        try:
+            validate_history(history)
+        except Exception:
+            continue
+        return provider
+    raise ValueError("history is unlikely to be anthropic, openai or gemini history")
 
 
 @logfire.instrument(extract_args=False, record_return=True)
@@ -2549,13 +6998,172 @@ def new_session_id():
 session_id = new_session_id()
 
 
+SESSIONS_DIR = Path("~/.dataland/sessions").expanduser()
+
+# "jsonl" is an append-only journal, "json" is the legacy format that rewrites the whole history every time.
+session_format: Literal["jsonl", "json"] = (
+    "json" if os.environ.get("PERSONALBOT_SESSION_FORMAT") == "json" else "jsonl"
+)
+
+
+def session_file_path(session_id: str) -> Path:
+    return SESSIONS_DIR / f"{session_id}.{session_format}"
+
+
+# NOTE(hzuo-26-10-18-sun): Session journal format (.jsonl), one record per line:
+#   {"op": "snapshot", "provider": ..., "history": [...]}  replaces the history with the given items
+#   {"op": "append", "items": [...]}                       appends items to the history
+# The provider names the wire format of the items ("anthropic", "openai" or "gemini"), so
+# /continue can tell a session of another provider from a corrupt one. Older snapshots don't
+# have it.
+# History items are never mutated after they're appended, so each write only appends the
+# items that are new since the previous write. Anything else (e.g. a different session or
+# an edited history) writes a fresh snapshot. Once the items appended since the last snapshot
+# outnumber the items in it, the journal is compacted into a single snapshot, which keeps
+# the total bytes written linear in the session size.
+class SessionJournalWriter:
+    COMPACT_MIN_APPENDED_ITEMS = 64
+
+    def __init__(self):
+        self.queue: queue.Queue = queue.Queue()
+        # session_id -> {"count", "last", "appended_items", "snapshot_items"}
+        self.sessions: dict[str, dict] = {}
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def submit(self, session_id: str, history: list):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.loop, name="session-journal", daemon=True
+                )
+                self.thread.start()
+        # a shallow copy is enough since the items themselves are never mutated
+        self.queue.put((session_id, list(history)))
+
+    def flush(self):
+        self.queue.join()
+
+    def loop(self):
+        while True:
+            session_id, history = self.queue.get()
+            try:
+                self.write(session_id, history)
+            except Exception as e:
+                logfire.exception("session journal write failed", session_id=session_id)
+                console.print(f"[yellow]Failed to write session {session_id}: {e}[/yellow]")
+            finally:
+                self.queue.task_done()
+
+    def write(self, session_id: str, history: list):
+        path = session_file_path(session_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        if session_format == "json":
+            path.write_text(json.dumps(history, indent=2), encoding="utf-8")
+            return
+
+        state = self.sessions.get(session_id)
+        can_append = (
+            state is not None
+            and path.exists()
+            and len(history) >= state["count"]
+            and (state["count"] == 0 or history[state["count"] - 1] is state["last"])
+        )
+        if can_append:
+            new_items = history[state["count"] :]
+            if not new_items:
+                return
+            appended_items = state["appended_items"] + len(new_items)
+            if appended_items < max(self.COMPACT_MIN_APPENDED_ITEMS, state["snapshot_items"]):
+                with path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps({"op": "append", "items": new_items}) + "\n")
+                state["count"] = len(history)
+                state["last"] = history[-1]
+                state["appended_items"] = appended_items
+                return
+
+        # write a compacted snapshot atomically
+        tmp_path = path.with_name(path.name + ".tmp")
+        snapshot = {"op": "snapshot", "provider": SESSION_PROVIDER, "history": history}
+        tmp_path.write_text(json.dumps(snapshot) + "\n", encoding="utf-8")
+        os.replace(tmp_path, path)
+        self.sessions[session_id] = {
+            "count": len(history),
+            "last": history[-1],
+            "appended_items": 0,
+            "snapshot_items": len(history),
+        }
+
+
+session_journal_writer = SessionJournalWriter()
+atexit.register(session_journal_writer.flush)
+
+
 def write_history(history: list):
+    """Persist history under the current session id. The write happens on a background thread."""
     if not history:
         return
     global session_id
-    session_file = Path(f"~/.dataland/sessions/{session_id}.json").expanduser()
-    session_file.parent.mkdir(parents=True, exist_ok=True)
-    session_file.write_text(json.dumps(history, indent=2), encoding="utf-8")
+    session_journal_writer.submit(session_id, history)
+
+
+def read_history(session_file: Path) -> list:
+    """Read a session file in either the journal (.jsonl) or the legacy (.json) format."""
+    return read_session(session_file)[0]
+
+
+def read_session(session_file: Path) -> tuple[list, str | None]:
+    """Read a session file's history and its provider (None if the file doesn't record it)."""
+    session_journal_writer.flush()  # make sure our own pending writes have landed
+
+    if session_file.suffix != ".jsonl":
+        return json.loads(session_file.read_text(encoding="utf-8")), None
+
+    history: list = []
+    provider = None
+    lines = session_file.read_text(encoding="utf-8").splitlines()
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            if i == len(lines) - 1:
+                # a torn final line from a crash mid-write, everything before it is intact
+                console.print(f"[yellow]Ignoring truncated last line in {session_file}[/yellow]")
+                break
+            raise
+        if record["op"] == "snapshot":
+            history = record["history"]
+            provider = record.get("provider")
+        elif record["op"] == "append":
+            history.extend(record["items"])
+        else:
+            raise ValueError(f"unknown session journal op: {record['op']}")
+    return history, provider
+
+
+def resolve_session_file(arg: str) -> Path:
+    """Resolve a session id or path, preferring the journal format when both exist."""
+    if arg.endswith(".json") or arg.endswith(".jsonl"):
+        return Path(arg).expanduser().resolve()
+    journal_file = SESSIONS_DIR / f"{arg}.jsonl"
+    if journal_file.exists():
+        return journal_file.resolve()
+    return (SESSIONS_DIR / f"{arg}.json").resolve()
+
+
+def convert_session_file(json_file: Path) -> Path:
+    """Convert a legacy .json session file into a .jsonl journal next to it."""
+    history = json.loads(json_file.read_text(encoding="utf-8"))
+    journal_file = json_file.with_suffix(".jsonl")
+    tmp_path = journal_file.with_name(journal_file.name + ".tmp")
+    snapshot = {"op": "snapshot", "provider": detect_history_provider(history), "history": history}
+    tmp_path.write_text(json.dumps(snapshot) + "\n", encoding="utf-8")
+    os.replace(tmp_path, journal_file)
+    assert read_history(journal_file) == history
+    return journal_file
 
 
 class JsonRpcRequest(BaseModel):
@@ -2646,6 +7254,7 @@ def api_handler(request: JsonRpcRequest, state: dict) -> JsonRpcResponse:
             model_interface["append_user_message"](state["history"], params.prompt)
             write_history(state["history"])
             output_text = model_interface["run_turn"](state["history"], turn_number)
+            snapshot_kernel_state(session_id, background=True)
             result = RpcPromptResult(
                 session_id=session_id,
                 # this output_text value is synthesized by the openai sdk layer via:
@@ -2684,7 +7293,11 @@ def api_handler(request: JsonRpcRequest, state: dict) -> JsonRpcResponse:
                 status=result.status,
                 stdout=result.stdout,
                 stderr=result.stderr,
-                image_attachments=result.image_attachments,
+                # RPC clients get self-contained data URLs rather than blob references
+                image_attachments=[
+                    (file, blob_resolve(ref, "image_url"))
+                    for file, ref in result.image_attachments
+                ],
             )
             return JsonRpcResponse(result=result, id=request.id)
         elif request.method == "run_command":
@@ -2794,12 +7407,12 @@ def handle_slash_command(
 
         env = jinja2.Environment(undefined=jinja2.StrictUndefined)
         template = env.from_string(text)
-        return template.render(sandbox_globals["command_params"])
+        return template.render(sandbox_eval("command_params"))
 
     frontmatter, markdown_body = parse_frontmatter(raw_markdown)
     arg_dict = parse_args(argv[1:])
 
-    sandbox_globals["command_params"].update(arg_dict)
+    kernel_call("sandbox_update", "command_params", arg_dict)
 
     page_split_re = re.compile(r"(?m)^\\pagebreak\s*$|<!--\s*(?i:pagebreak)\s*-->")
     raw_pages: list[str] = [page.strip() for page in page_split_re.split(markdown_body)]
@@ -2914,8 +7527,8 @@ def handle_slash_command(
         if result.status != "ok":
             raise ValueError(f"Init page failed with status: {result.status}")
 
-        if "control_flow_object" in sandbox_globals:
-            assert inspect.isgenerator(sandbox_globals["control_flow_object"]), (
+        if sandbox_eval("'control_flow_object' in globals()"):
+            assert sandbox_eval("__import__('inspect').isgenerator(control_flow_object)"), (
                 "control_flow_object must be a generator"
             )
             control_flow_mode = True
@@ -3050,43 +7663,22 @@ def handle_slash_command(
 
 
 def calc_turn_number(history: list) -> int:
-    turn_number = 1
-
-    def openai_is_fake_user_turn(item: dict) -> bool:
-        return False
-
-    def anthropic_is_fake_user_turn(item: dict) -> bool:
-        content_blocks = item.get("content")
-        if not isinstance(content_blocks, list):
-            return False
-        if not content_blocks:
-            return True
-        return all(block.get("type") == "tool_result" for block in content_blocks)
-
-    def gemini_is_fake_user_turn(item: dict) -> bool:
-        part_blocks = item.get("parts")
-        if not isinstance(part_blocks, list):
-            return False
-        if not part_blocks:
-            return True
-        return all("functionResponse" in block for block in part_blocks)
-
-    for item in history:
-        if isinstance(item, dict) and item.get("role") == "user":
-            if (
-                openai_is_fake_user_turn(item)
-                or anthropic_is_fake_user_turn(item)
-                or gemini_is_fake_user_turn(item)
-            ):
-                continue
-            turn_number += 1
-    return turn_number
+    # every message the user typed starts a turn, tool results sent back as user messages don't
+    events = session_canonical_decoder.events(history)
+    return 1 + sum(1 for event in events if event["type"] == "user")
 
 
 def interactive_main():
     printer_thread = threading.Thread(target=dsp_console_print_loop, daemon=True)
     printer_thread.start()
 
+    http_warmup(model_interface["http_warmup_urls"])
+    if python_exec_kernel is not None:
+        # the kernel imports in the background while the first prompt is being written
+        python_exec_kernel.start()
+    else:
+        python_exec_prewarm()
+
     global session_id
 
     history: list = []
@@ -3202,11 +7794,21 @@ def interactive_main():
             elif user_input == "/id":
                 console.print(f"[green]{session_id}[/green]", highlight=False)
                 continue
+            elif user_input == "/restart-kernel":
+                if python_exec_kernel is None:
+                    console.print(
+                        "[yellow]python_exec runs in-process (PERSONALBOT_KERNEL=subprocess to use a kernel)[/yellow]"
+                    )
+                else:
+                    python_exec_kernel.restart()
+                    console.print("[green]python_exec kernel restarted[/green]")
+                continue
             elif user_input == "/fork" or user_input == "/save":
                 old_session_id = session_id
                 write_history(history)  # save under old session id
                 session_id = new_session_id()
                 write_history(history)  # also save under new session id
+                fork_kernel_snapshot(old_session_id, session_id)
                 console.print(
                     Syntax(
                         json.dumps(
@@ -3233,8 +7835,10 @@ def interactive_main():
                 arg = user_input.split(" ")[1]
 
                 if arg.startswith("s3://"):
-                    assert arg.endswith(".json"), "S3 session file must end with .json"
-                    dest_dir = Path("~/.dataland/sessions").expanduser()
+                    assert arg.endswith(".json") or arg.endswith(".jsonl"), (
+                        "S3 session file must end with .json or .jsonl"
+                    )
+                    dest_dir = SESSIONS_DIR
                     dest_dir.mkdir(parents=True, exist_ok=True)
                     filename = arg.split("/")[-1]
                     continue_session_file = (dest_dir / filename).resolve()
@@ -3244,12 +7848,8 @@ def interactive_main():
                         capture_output=True,
                         text=True,
                     )
-                elif arg.endswith(".json"):
-                    continue_session_file = Path(arg).expanduser().resolve()
                 else:
-                    continue_session_file = (
-                        Path(f"~/.dataland/sessions/{arg}.json").expanduser().resolve()
-                    )
+                    continue_session_file = resolve_session_file(arg)
 
                 if not continue_session_file.stem.startswith(SESSION_NAMESPACE):
                     console.print(
@@ -3259,14 +7859,19 @@ def interactive_main():
                 assert continue_session_file.exists(), (
                     f"Session file not found: {continue_session_file}"
                 )
-                history0 = continue_session_file.read_text(encoding="utf-8")
-
-                history0 = json.loads(history0)
+                history0, provider0 = read_session(continue_session_file)
+                if provider0 is not None and provider0 != SESSION_PROVIDER:
+                    raise ValueError(
+                        f"{continue_session_file.name} is {provider0} history, continue it with"
+                        f" a {provider0} model"
+                    )
                 model_interface["validate_history"](history0)
 
                 # save the existing history
                 old_session_id = session_id
                 write_history(history)
+                snapshot_kernel_state(old_session_id)
+                restore_kernel_state(continue_session_file)
 
                 # start a new session with the new history
                 history = history0
@@ -3325,7 +7930,11 @@ def interactive_main():
             write_history(history)
 
             model_interface["run_turn"](history, turn_number)
+            snapshot_kernel_state(session_id, background=True)
         except KeyboardInterrupt:
+            if python_exec_kernel is not None:
+                # e.g. a parallel call, running on another thread, is still going
+                python_exec_kernel.interrupt()
             console.print(
                 "\n[yellow]Use EOF, '/exit', or '/quit' to end the session.[/yellow]"
             )
@@ -3341,6 +7950,13 @@ def programmatic_main():
     printer_thread = threading.Thread(target=dsp_console_print_loop, daemon=True)
     printer_thread.start()
 
+    http_warmup(model_interface["http_warmup_urls"])
+    if python_exec_kernel is not None:
+        # the kernel imports in the background while the first prompt is being written
+        python_exec_kernel.start()
+    else:
+        python_exec_prewarm()
+
     state = {
         "history": [],
     }
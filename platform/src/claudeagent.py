@@ -2,6 +2,39 @@ import copy
 from typing import Any, Callable, Literal
 
 import requests
+from requests.adapters import HTTPAdapter, Retry
+
+
+class AnthropicRetry(Retry):
+    """urllib3 Retry that also honors Anthropic's millisecond retry-after-ms header."""
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                return max(0.0, float(retry_after_ms) / 1000)
+            except ValueError:
+                pass
+        return super().get_retry_after(response)
+
+
+def new_anthropic_session() -> requests.Session:
+    session = requests.Session()
+    retry = AnthropicRetry(
+        total=6,
+        connect=4,
+        read=2,
+        # the messages endpoint is POST, which urllib3 doesn't retry by default
+        allowed_methods=None,
+        status_forcelist=[408, 429, 500, 502, 503, 504, 529],
+        backoff_factor=1.0,
+        backoff_max=60,
+        backoff_jitter=1.0,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
 
 
 class ClaudeAgent:
@@ -27,6 +60,7 @@ class ClaudeAgent:
         self.tool_handlers = {}
         self.disable_parallel_tool_use = disable_parallel_tool_use
         self.progress_cb = progress_cb
+        self.session = new_anthropic_session()
 
     def set_system_prompt(self, system_prompt: str):
         self.system_prompt = system_prompt
@@ -92,7 +126,7 @@ class ClaudeAgent:
             }
         )
 
-        res = requests.post(self.api_url, headers=headers, json=req)
+        res = self.session.post(self.api_url, headers=headers, json=req)
         if not res.ok:
             print(f"anthropic error! {res.text}")
         res.raise_for_status()
@@ -1,4 +1,5 @@
 import base64
+import functools
 import json
 import os
 import tempfile
@@ -28,9 +29,15 @@ def new_requests_session_with_retry() -> requests.Session:
     return session
 
 
+@functools.cache
+def shared_requests_session() -> requests.Session:
+    # one keep-alive session per process, so repeated calls reuse connections instead of re-handshaking
+    return new_requests_session_with_retry()
+
+
 # https://docs.firecrawl.dev/api-reference/endpoint/scrape
 def firecrawl_scrape_url(url: str, include_tags: list[str] | None = None, exclude_tags: list[str] | None = None) -> str:
-    session = new_requests_session_with_retry()
+    session = shared_requests_session()
     api_key = os.environ["FIRECRAWL_API_KEY"]
     req = {
         "url": url,
@@ -96,7 +103,9 @@ def gdoc_md_get(
         algorithm="RS256",
     )
 
-    tok = requests.post(
+    session = shared_requests_session()
+
+    tok = session.post(
         token_uri,
         data={
             "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
@@ -107,7 +116,7 @@ def gdoc_md_get(
     tok.raise_for_status()
     access_token = tok.json()["access_token"]
 
-    r = requests.get(
+    r = session.get(
         f"https://www.googleapis.com/drive/v3/files/{file_id}/export",
         headers={"Authorization": f"Bearer {access_token}"},
         params={"mimeType": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"},
@@ -0,0 +1,124 @@
+#!/usr/bin/env -S uv run
+# /// script
+# requires-python = "~=3.13.9"
+# dependencies = [
+#     "logfire[requests,httpx]>=4.16.0",
+#     "openai>=2.8.0",
+#     "prompt-toolkit>=3.0.51",
+#     "pydantic>=2.11.7",
+#     "rich>=14.1.0",
+#     "pyyaml>=6.0.2",
+#     "requests>=2.32.5",
+#     "httpx>=0.28.1",
+#     "jinja2>=3.1.6",
+# ]
+# ///
+
+"""
+anthropic-request-builder-bench.py
+
+Measure the per-step client-side cost of building the Anthropic request body as a
+session's history grows past 100 MB, comparing:
+
+- baseline: copy.deepcopy(history) + cache marker + json.dumps of the whole request
+  (what anthropic_call used to do every step)
+- builder:  anthropic_request_messages + json_encode_request from personalbot.py
+  (the history is shared, only new messages get serialized, and the body is handed
+  to requests as chunks without being concatenated)
+
+Only the client-side build is timed; sending the bytes is the same for both.
+
+Each simulated step appends an assistant tool_use message and a user tool_result
+message with a large stdout, and every few steps a base64 image attachment.
+
+Usage:
+    uv run scripts/26-10-18-sun-anthropic-request-builder-bench.py
+    uv run scripts/26-10-18-sun-anthropic-request-builder-bench.py --steps 400 --stdout-kb 300
+"""
+
+import argparse
+import base64
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+from personalbot_loader import load_personalbot
+
+
+def baseline_body(req: dict, history: list) -> bytes:
+    messages2 = copy.deepcopy(history)
+    for message in reversed(messages2):
+        if message["role"] == "user":
+            message["content"][-1]["cache_control"] = {"type": "ephemeral", "ttl": "5m"}
+            break
+    return json.dumps({**req, "messages": messages2}).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--stdout-kb", type=int, default=200)
+    parser.add_argument("--image-every", type=int, default=10)
+    parser.add_argument("--image-kb", type=int, default=1024)
+    parser.add_argument("--baseline-every", type=int, default=50)
+    args = parser.parse_args()
+
+    pb = load_personalbot(("-m", "sonnet"))
+    # the baseline never evicted images, compacted or placed cache checkpoints, so compare like for like
+    pb.image_keep_tool_results = 0
+    pb.compact_threshold_tokens = 0
+    pb.prune_reasoning = False
+    pb.ANTHROPIC_CACHE_CHECKPOINT_TOKENS = sys.maxsize
+
+    req = {
+        "model": pb.anthropic_model,
+        "max_tokens": 64_000,
+        "system": [{"type": "text", "text": "x" * 50_000}],
+    }
+    history: list = [{"role": "user", "content": [{"type": "text", "text": "analyze the runs"}]}]
+    image_b64 = base64.b64encode(os.urandom(args.image_kb * 1024)).decode("ascii")
+
+    print(f"{'step':>5} {'history_mb':>10} {'builder_ms':>10} {'baseline_ms':>11}")
+    builder_ms_all = []
+    for step in range(1, args.steps + 1):
+        history.append(
+            {
+                "role": "assistant",
+                "content": [
+                    {"type": "thinking", "thinking": "t" * 2_000, "signature": "s" * 500},
+                    {"type": "tool_use", "id": f"toolu_{step}", "name": "python_exec", "input": {"code": f"print({step})"}},
+                ],
+            }
+        )
+        content: list = [{"type": "text", "text": f"<text_output>\n{'o' * (args.stdout_kb * 1024)}\n</text_output>\n"}]
+        if step % args.image_every == 0:
+            content.append({"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_b64}})
+        history.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"toolu_{step}", "content": content}]})
+
+        t0 = time.perf_counter()
+        body = pb.json_encode_request(
+            {**req, "messages": pb.anthropic_request_messages(history)},
+            "messages",
+            pb.anthropic_message_encoder,
+        )
+        builder_ms = (time.perf_counter() - t0) * 1000
+        builder_ms_all.append(builder_ms)
+
+        if step % args.baseline_every == 0 or step == args.steps:
+            t0 = time.perf_counter()
+            baseline = baseline_body(req, history)
+            baseline_ms = (time.perf_counter() - t0) * 1000
+            assert json.loads(body.getvalue()) == json.loads(baseline)
+            history_mb = len(body) / 1024 / 1024
+            print(f"{step:>5} {history_mb:>10.1f} {builder_ms:>10.1f} {baseline_ms:>11.1f}")
+
+    first = statistics.median(builder_ms_all[: args.baseline_every])
+    last = statistics.median(builder_ms_all[-args.baseline_every :])
+    print(f"builder median ms: first {args.baseline_every} steps {first:.1f}, last {args.baseline_every} steps {last:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env -S uv run
+# /// script
+# requires-python = "~=3.13.9"
+# dependencies = [
+#     "logfire[requests,httpx]>=4.16.0",
+#     "openai>=2.8.0",
+#     "prompt-toolkit>=3.0.51",
+#     "pydantic>=2.11.7",
+#     "rich>=14.1.0",
+#     "pyyaml>=6.0.2",
+#     "requests>=2.32.5",
+#     "httpx>=0.28.1",
+#     "jinja2>=3.1.6",
+# ]
+# ///
+
+"""
+gzip-request-bench.py
+
+Measure what gzip request bodies save per step on a slow uplink. A local server reads
+request bodies at a throttled rate (--uplink-mbps) and checks that every body, gzipped or
+not, decodes to the same JSON. Each simulated step appends an Anthropic tool_use message
+and a tool_result with JSON stdout, and every few steps a base64 image attachment,
+then posts the request body both ways through personalbot.post_json_request:
+
+- plain: the JsonRequestBody as-is
+- gzip:  GzipRequestEncoder, which only deflates the chunks that are new since the
+         previous step (compress_ms is that incremental cost)
+
+Upload times are wall clock for the whole POST against the throttled server.
+
+Usage:
+    uv run scripts/26-10-18-sun-gzip-request-bench.py
+    uv run scripts/26-10-18-sun-gzip-request-bench.py --steps 200 --uplink-mbps 20
+"""
+
+import argparse
+import base64
+import gzip
+import http.server
+import json
+import os
+import random
+import threading
+import time
+
+from personalbot_loader import load_personalbot
+
+UPLINK_BYTES_PER_SECOND = 0.0
+
+
+class ThrottledHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        remaining = int(self.headers["content-length"])
+        body = bytearray()
+        t0 = time.monotonic()
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 65536))
+            remaining -= len(chunk)
+            body += chunk
+            # hold the read back to the uplink's pace
+            lag = len(body) / UPLINK_BYTES_PER_SECOND - (time.monotonic() - t0)
+            if lag > 0:
+                time.sleep(lag)
+        if self.headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        json.loads(body)
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+def tool_stdout(step: int, kb: int) -> str:
+    # the kind of output the agent prints: records and dataframe reprs
+    rng = random.Random(step)
+    rows = []
+    while sum(len(row) for row in rows) < kb * 1024:
+        rows.append(
+            json.dumps(
+                {
+                    "id": rng.randrange(10**6),
+                    "name": rng.choice(["alpha", "beta", "gamma", "delta"]),
+                    "value": round(rng.random() * 1000, 3),
+                    "ok": rng.random() < 0.9,
+                }
+            )
+        )
+    return json.dumps({"status": "ok", "stdout": "\n".join(rows), "stderr": ""})
+
+
+def main():
+    global UPLINK_BYTES_PER_SECOND
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=120)
+    parser.add_argument("--stdout-kb", type=int, default=100)
+    parser.add_argument("--image-every", type=int, default=10)
+    parser.add_argument("--image-kb", type=int, default=512)
+    parser.add_argument("--uplink-mbps", type=float, default=50.0)
+    parser.add_argument("--report-every", type=int, default=20)
+    args = parser.parse_args()
+    UPLINK_BYTES_PER_SECOND = args.uplink_mbps * 1_000_000 / 8
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ThrottledHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/messages"
+
+    pb = load_personalbot(("-m", "sonnet"))
+    pb.GZIP_MIN_BYTES = 0
+    encoder = pb.GzipRequestEncoder()
+    message_encoder = pb.IdentityMemo(pb.anthropic_encode_message)
+    headers = {"content-type": "application/json"}
+    req = {"model": pb.anthropic_model, "max_tokens": 64_000, "system": [{"type": "text", "text": "x" * 20_000}]}
+    history: list = [{"role": "user", "content": [{"type": "text", "text": "analyze the runs"}]}]
+    # random bytes, like an already-compressed PNG, so base64 is all gzip can take off
+    image_b64 = base64.b64encode(os.urandom(args.image_kb * 1024)).decode("ascii")
+
+    print(f"{'step':>5} {'body_mb':>8} {'gzip_mb':>8} {'compress_ms':>11} {'plain_s':>8} {'gzip_s':>7} {'saved_s':>8}")
+    saved_all = []
+    for step in range(1, args.steps + 1):
+        history.append(
+            {
+                "role": "assistant",
+                "content": [{"type": "tool_use", "id": f"toolu_{step}", "name": "python_exec", "input": {"code": f"analyze({step})"}}],
+            }
+        )
+        content: list = [{"type": "text", "text": tool_stdout(step, args.stdout_kb)}]
+        if step % args.image_every == 0:
+            content.append({"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_b64}})
+        history.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"toolu_{step}", "content": content}]})
+
+        body = pb.json_encode_request({**req, "messages": history}, "messages", message_encoder)
+        t0 = time.perf_counter()
+        compressed = encoder.encode(body)
+        compress_ms = (time.perf_counter() - t0) * 1000
+        assert gzip.decompress(compressed.getvalue()) == body.getvalue()
+        if step % args.report_every and step != args.steps:
+            continue
+
+        pb.gzip_requests = False
+        t0 = time.perf_counter()
+        pb.post_json_request("anthropic", url, headers, body, encoder).raise_for_status()
+        plain_s = time.perf_counter() - t0
+        pb.gzip_requests = True
+        t0 = time.perf_counter()
+        # includes the (memoized, so nearly free) compression again
+        pb.post_json_request("anthropic", url, headers, body, encoder).raise_for_status()
+        gzip_s = time.perf_counter() - t0
+        saved_all.append(plain_s - gzip_s)
+        print(
+            f"{step:>5} {len(body) / 1e6:>8.1f} {len(compressed) / 1e6:>8.1f} {compress_ms:>11.1f}"
+            f" {plain_s:>8.2f} {gzip_s:>7.2f} {plain_s - gzip_s:>8.2f}"
+        )
+    print(f"uplink {args.uplink_mbps:g} Mbps, mean upload time saved per reported step: {sum(saved_all) / len(saved_all):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env -S uv run
+# /// script
+# requires-python = "~=3.13.9"
+# dependencies = [
+#     "logfire[requests,httpx]>=4.16.0",
+#     "openai>=2.8.0",
+#     "prompt-toolkit>=3.0.51",
+#     "pydantic>=2.11.7",
+#     "rich>=14.1.0",
+#     "pyyaml>=6.0.2",
+#     "requests>=2.32.5",
+#     "httpx>=0.28.1",
+#     "jinja2>=3.1.6",
+# ]
+# ///
+
+"""
+hedge-mock-providers.py
+
+Exercise personalbot's hedged model calls (PERSONALBOT_HEDGE_MODEL) against local mock
+Anthropic and Gemini servers, with an Anthropic session hedged to Gemini:
+
+- fast:     the primary streams right away, the hedge is never sent
+- slow:     the primary stalls before its first token, the Gemini hedge wins and its
+            functionCall comes back as an Anthropic tool_use response
+- down:     the primary keeps failing with a 503, the step fails over to Gemini
+- rejected: the primary rejects the request with a 400, which is raised without hedging
+- two-step: after the Gemini hedge answered a step, the next step goes back to Anthropic
+            with thinking off, since the transcoded tool_use has no thinking block before it
+- interrupt: a Ctrl-C while both attempts stall cancels both and closes their responses
+- history:  an Anthropic history with tool calls and an image attachment transcodes to
+            Gemini and OpenAI, memoized, and survives the round trip
+
+Usage:
+    uv run scripts/26-10-18-sun-hedge-mock-providers.py
+"""
+
+import http.server
+import json
+import os
+import signal
+import threading
+import time
+
+from personalbot_loader import load_personalbot
+
+MOCK = {
+    "anthropic": {"status": 200, "first_token_delay": 0.0},
+    "gemini": {"status": 200, "first_token_delay": 0.0},
+}
+HITS = {"anthropic": 0, "gemini": 0}
+REQUESTS: dict[str, dict] = {}
+
+
+def sse(obj: dict, event: str | None = None) -> bytes:
+    return ((f"event: {event}\n" if event else "") + f"data: {json.dumps(obj)}\n\n").encode()
+
+
+def anthropic_events() -> list[bytes]:
+    message = {
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "content": [],
+        "model": "claude-mock",
+        "stop_reason": None,
+        "usage": {"input_tokens": 10, "output_tokens": 1},
+    }
+    return [
+        sse({"type": "message_start", "message": message}, "message_start"),
+        sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start"),
+        sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "from anthropic"}}, "content_block_delta"),
+        sse({"type": "content_block_stop", "index": 0}, "content_block_stop"),
+        sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 5}}, "message_delta"),
+        sse({"type": "message_stop"}, "message_stop"),
+    ]
+
+
+def gemini_events() -> list[bytes]:
+    usage = {"promptTokenCount": 10, "candidatesTokenCount": 5, "totalTokenCount": 15}
+    return [
+        sse({"responseId": "r_mock", "modelVersion": "gemini-mock", "candidates": [{"content": {"role": "model", "parts": [{"text": "from gemini"}]}}]}),
+        sse(
+            {
+                "candidates": [
+                    {
+                        "content": {"role": "model", "parts": [{"functionCall": {"name": "python_exec", "args": {"code": "print(1)"}}}]},
+                        "finishReason": "STOP",
+                    }
+                ],
+                "usageMetadata": usage,
+            }
+        ),
+    ]
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+        provider = "anthropic" if self.path.startswith("/v1/messages") else "gemini"
+        HITS[provider] += 1
+        REQUESTS[provider] = req
+        mock = MOCK[provider]
+        status = mock["status"]
+        if provider == "anthropic" and "thinking" in req:
+            # like the real API: with thinking on, the last assistant message must start with it
+            assistant = [m for m in req["messages"] if m["role"] == "assistant"]
+            if assistant and assistant[-1]["content"][0]["type"] not in ("thinking", "redacted_thinking"):
+                status = 400
+        if status != 200:
+            body = json.dumps({"error": {"message": "mock failure"}}).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        try:
+            time.sleep(mock["first_token_delay"])
+            for chunk in anthropic_events() if provider == "anthropic" else gemini_events():
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def without_id(event: dict) -> dict:
+    return {key: value for key, value in event.items() if key != "id"}
+
+
+def scenario(name: str, anthropic: dict, gemini: dict):
+    MOCK["anthropic"] = {"status": 200, "first_token_delay": 0.0, **anthropic}
+    MOCK["gemini"] = {"status": 200, "first_token_delay": 0.0, **gemini}
+    HITS.update(anthropic=0, gemini=0)
+    print(f"--- {name}")
+
+
+def main():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    os.environ["PERSONALBOT_ANTHROPIC_API_URL"] = f"{base_url}/v1/messages"
+    os.environ["PERSONALBOT_GEMINI_API_URL"] = f"{base_url}/v1beta/models"
+    os.environ["PERSONALBOT_HEDGE_MODEL"] = "gemini:gemini-mock"
+    os.environ["PERSONALBOT_HEDGE_AFTER_SECONDS"] = "0.5"
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock")
+    os.environ.setdefault("GEMINI_API_KEY", "mock")
+    pb = load_personalbot(("-m", "sonnet"))
+    pb.instructions = "mock instructions"
+    threading.Thread(target=pb.dsp_console_print_loop, daemon=True).start()
+
+    history = [{"role": "user", "content": [{"type": "text", "text": "hello"}]}]
+
+    scenario("fast", {}, {})
+    res = pb.hedged_call("anthropic", history, pb.anthropic_step_call)
+    pb.dspq.join()
+    assert res["content"][0]["text"] == "from anthropic", res
+    assert HITS == {"anthropic": 1, "gemini": 0}, HITS
+
+    scenario("slow", {"first_token_delay": 3.0}, {})
+    t0 = time.monotonic()
+    res = pb.hedged_call("anthropic", history, pb.anthropic_step_call)
+    pb.dspq.join()
+    elapsed = time.monotonic() - t0
+    assert elapsed < 2.5, elapsed
+    assert res["stop_reason"] == "tool_use", res
+    assert [block["type"] for block in res["content"]] == ["text", "tool_use"], res
+    assert res["content"][1]["input"] == {"code": "print(1)"}, res
+    assert HITS == {"anthropic": 1, "gemini": 1}, HITS
+    print(f"hedge won after {elapsed:.2f}s")
+
+    scenario("down", {"status": 503}, {})
+    t0 = time.monotonic()
+    res = pb.hedged_call("anthropic", history, pb.anthropic_step_call)
+    pb.dspq.join()
+    assert res["content"][0]["text"] == "from gemini", res
+    print(f"failed over after {time.monotonic() - t0:.2f}s")
+
+    scenario("rejected", {"status": 400}, {})
+    try:
+        pb.hedged_call("anthropic", history, pb.anthropic_step_call)
+    except pb.requests.HTTPError as e:
+        assert e.response.status_code == 400, e
+    else:
+        raise AssertionError("a 400 should be raised")
+    pb.dspq.join()
+    assert HITS == {"anthropic": 1, "gemini": 0}, HITS
+
+    scenario("two-step", {"first_token_delay": 3.0}, {})
+    res = pb.hedged_call("anthropic", history, pb.anthropic_step_call)
+    pb.dspq.join()
+    assert res["content"][1]["type"] == "tool_use", res
+    turn = history + [
+        {"role": "assistant", "content": res["content"]},
+        {
+            "role": "user",
+            "content": [{"type": "tool_result", "tool_use_id": res["content"][1]["id"], "content": "1"}],
+        },
+    ]
+    MOCK["anthropic"]["first_token_delay"] = 0.0
+    res = pb.hedged_call("anthropic", turn, pb.anthropic_step_call)
+    pb.dspq.join()
+    assert res["content"][0]["text"] == "from anthropic", res
+    assert "thinking" not in REQUESTS["anthropic"], REQUESTS["anthropic"].keys()
+    # the next turn starts with a message typed by the user, thinking is back on
+    turn += [
+        {"role": "assistant", "content": res["content"]},
+        {"role": "user", "content": [{"type": "text", "text": "again"}]},
+    ]
+    MOCK["anthropic"]["status"] = 200
+    pb.hedged_call("anthropic", turn[:1] + turn[-1:], pb.anthropic_step_call)
+    pb.dspq.join()
+    assert "thinking" in REQUESTS["anthropic"], REQUESTS["anthropic"].keys()
+
+    scenario("interrupt", {"first_token_delay": 3.0}, {"first_token_delay": 3.0})
+    before = set(threading.enumerate())
+    attempts: list[threading.Thread] = []
+
+    def interrupt():
+        attempts.extend(t for t in set(threading.enumerate()) - before if t.name.startswith("hedge-"))
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Timer(1.0, interrupt).start()
+    t0 = time.monotonic()
+    try:
+        pb.hedged_call("anthropic", history, pb.anthropic_step_call)
+    except KeyboardInterrupt:
+        pass
+    else:
+        raise AssertionError("the call should be interrupted")
+    assert len(attempts) == 2, attempts
+    for t in attempts:
+        t.join(1.0)
+        assert not t.is_alive(), t
+    assert time.monotonic() - t0 < 2.0
+    print("both attempts cancelled")
+
+    print("--- history")
+    image_ref = pb.blob_put(b"\x89PNG mock", "image/png")
+    result = pb.PythonExecResponse(status="ok", stdout="1\n", stderr="", image_attachments=[("plot.png", image_ref)])
+    history = [
+        {"role": "user", "content": [{"type": "text", "text": "plot it"}]},
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "thinking", "thinking": "hmm", "signature": "sig"},
+                {"type": "tool_use", "id": "toolu_1", "name": "python_exec", "input": {"code": "plot()"}},
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "tool_result", "tool_use_id": "toolu_1", "content": pb.anthropic_construct_tool_result_content(result)}
+            ],
+        },
+        {"role": "assistant", "content": [{"type": "text", "text": "done"}]},
+    ]
+    events = [event for i, item in enumerate(history) for event in pb.anthropic_canonical_events(item, i)]
+    for target in ("gemini", "openai"):
+        transcoder = pb.HistoryTranscoder("anthropic", target)
+        out = transcoder.transcode(history)
+        again = transcoder.transcode(history + [{"role": "user", "content": [{"type": "text", "text": "next"}]}])
+        assert all(a is b for a, b in zip(out, again[: len(out)], strict=True)), "unchanged items should be shared"
+        back = pb.HistoryTranscoder(target, "anthropic").transcode(out)
+        round_trip = [event for i, item in enumerate(back) for event in pb.anthropic_canonical_events(item, i)]
+        # Gemini function calls have no ids, they come back positional
+        assert [without_id(e) for e in round_trip] == [without_id(e) for e in events], (round_trip, events)
+        print(f"anthropic -> {target} -> anthropic: {len(out)} items, round trip ok")
+
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
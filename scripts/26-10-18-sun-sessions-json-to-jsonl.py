@@ -0,0 +1,67 @@
+#!/usr/bin/env -S uv run
+# /// script
+# requires-python = "~=3.13.9"
+# dependencies = [
+#     "logfire[requests,httpx]>=4.16.0",
+#     "openai>=2.8.0",
+#     "prompt-toolkit>=3.0.51",
+#     "pydantic>=2.11.7",
+#     "rich>=14.1.0",
+#     "pyyaml>=6.0.2",
+#     "requests>=2.32.5",
+#     "httpx>=0.28.1",
+#     "jinja2>=3.1.6",
+# ]
+# ///
+
+"""
+sessions-json-to-jsonl.py
+
+Convert legacy personalbot session files (~/.dataland/sessions/<id>.json, the whole
+history rewritten on every write) into the append-only journal format (<id>.jsonl).
+Conversion goes through personalbot.convert_session_file, which verifies that the
+journal reads back to the exact same history.
+
+personalbot reads both formats, so conversion is optional; it just makes the session
+resumable with the journal writer's cheap appends and shrinks the indent=2 JSON.
+
+Usage:
+    uv run scripts/26-10-18-sun-sessions-json-to-jsonl.py                # every .json in ~/.dataland/sessions
+    uv run scripts/26-10-18-sun-sessions-json-to-jsonl.py a.json b.json
+    uv run scripts/26-10-18-sun-sessions-json-to-jsonl.py --delete       # remove each .json after converting
+"""
+
+import argparse
+from pathlib import Path
+
+from personalbot_loader import load_personalbot
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", type=Path)
+    parser.add_argument("--delete", action="store_true")
+    parser.add_argument("--force", action="store_true", help="overwrite existing .jsonl files")
+    args = parser.parse_args()
+
+    pb = load_personalbot()
+
+    files = args.files or sorted(pb.SESSIONS_DIR.glob("*.json"))
+    converted = 0
+    for json_file in files:
+        json_file = json_file.expanduser().resolve()
+        if json_file.with_suffix(".jsonl").exists() and not args.force:
+            print(f"skip (already converted): {json_file}")
+            continue
+        journal_file = pb.convert_session_file(json_file)
+        before = json_file.stat().st_size
+        after = journal_file.stat().st_size
+        print(f"{json_file.name} -> {journal_file.name} ({before:,} -> {after:,} bytes)")
+        if args.delete:
+            json_file.unlink()
+        converted += 1
+    print(f"converted {converted} of {len(files)} session files")
+
+
+if __name__ == "__main__":
+    main()
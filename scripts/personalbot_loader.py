@@ -0,0 +1,23 @@
+"""
+personalbot_loader.py
+
+Shared by the scripts in this directory: import ../personalbot.py as a module.
+"""
+
+import importlib.util
+import sys
+from pathlib import Path
+
+
+def load_personalbot(argv=()):
+    # personalbot.py parses argv at import time to pick a model
+    saved = sys.argv
+    sys.argv = [saved[0], *argv]
+    try:
+        path = Path(__file__).resolve().parent.parent / "personalbot.py"
+        spec = importlib.util.spec_from_file_location("personalbot", path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    finally:
+        sys.argv = saved
+    return mod